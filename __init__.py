@@ -22,47 +22,160 @@ This only works for 32-bit architecture and needs the following files installed
 """
 
 import logging
-import gpib_ct as pysicl
+import time
+from Electronics.Interfaces.GPIB import gpib_ct as pysicl
+from Electronics.Interfaces.GPIB.cache import QueryCache
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.policy import DevicePolicy
+from Electronics.Interfaces.GPIB.registry import registry
+from Electronics.Interfaces.GPIB.ieee488 import block_array, \
+     parse_block_header, response_array
+from Electronics.Interfaces.GPIB.scanner import BusScanner
+from Electronics.Interfaces.GPIB.snapshot import snapshot
+from Electronics.Interfaces.GPIB.srq import srq_dispatcher
 
 module_logger = logging.getLogger(__name__)
 
+query_cache = None
+
+def enable_cache(cache=None):
+    """
+    Answer repeated queries from a cache.
+
+    @param cache : the cache to use; default a new QueryCache with the default
+                   rules
+    @type  cache : cache.QueryCache
+
+    @return: the cache
+    """
+    global query_cache
+    query_cache = cache if cache is not None else QueryCache()
+    return query_cache
+
+def disable_cache():
+    """
+    Stop answering queries from the cache.
+    """
+    global query_cache
+    query_cache = None
+
+def enable_policy(policy=None):
+    """
+    Apply adaptive timeouts, retries and circuit breakers to the session pool.
+
+    @param policy : the policy to use; default a new DevicePolicy
+    @type  policy : policy.DevicePolicy
+
+    @return: the policy
+    """
+    if policy is None:
+        policy = DevicePolicy(pool=session_pool)
+    session_pool.policy = policy
+    return policy
+
+def disable_policy():
+    """
+    Go back to the fixed timeout and a single retry.
+
+    Idle sessions are closed, so that none keeps a timeout the policy set.
+    """
+    policy, session_pool.policy = session_pool.policy, None
+    if policy is not None:
+        policy.stop()
+        session_pool.close_all()
+
 def ask(device, request):
     """
     Send 'request' to 'device' and obtain 'response'.
+
+    The device session is taken from the shared session pool.  If the cache is
+    enabled, the response may come from it instead.
     """
+    def prompt(request):
+        return session_pool.call(device, pysicl.gpib_prompt, request)
     try:
-        instr = pysicl.gpib_open(device)
-        resp = pysicl.gpib_prompt(instr, request)
-        pysicl.gpib_close(instr)
+        if query_cache is None:
+            resp = prompt(request)
+        else:
+            resp = query_cache.ask(registry.address(device), request, prompt)
     except:
         return "No response due to error"
     return resp
 
+def _ask_many(instr, commands, join):
+    """
+    Send queries to an open session while it is locked.
+    """
+    pysicl.gpib_lock(instr)
+    try:
+        if join and len(commands) > 1:
+            response = pysicl.gpib_prompt(instr, ";".join(commands))
+            responses = [r.strip() for r in response.strip().split(";")]
+            if len(responses) == len(commands):
+                return responses
+            module_logger.debug("_ask_many: %d responses to %d queries",
+                                len(responses), len(commands))
+        return pysicl.gpib_prompt_many(instr, commands)
+    finally:
+        pysicl.gpib_unlock(instr)
+
+def ask_many(device, commands, join=False):
+    """
+    Send several queries to 'device' and obtain their responses.
+
+    The session is locked for the whole batch.  If 'join' is True the queries
+    are sent as one SCPI compound query, e.g. ':FREQ?;:POW?', and the reply is
+    split at ';'.  Only use this with instruments that accept compound queries;
+    if the number of replies does not match, the queries are sent one by one.
+
+    @param device : device name or address
+    @type  device : str
+
+    @param commands : queries
+    @type  commands : list of str
+
+    @param join : send the queries as one compound query
+    @type  join : bool
+
+    @return: list of responses
+    """
+    commands = list(commands)
+    try:
+        return session_pool.call(device, _ask_many, commands, join)
+    except:
+        return ["No response due to error"]*len(commands)
+
 def dev_status(device):
     """
     Returns the status byte of the device.
+
+    The device session is taken from the shared session pool.
     """
     try:
-        instr = pysicl.gpib_open(device)
-        status = pysicl.gpib_dev_status(instr)
-        pysicl.gpib_close(instr)
+        status = session_pool.call(device, pysicl.gpib_dev_status)
     except:
         return -1
     return status
 
-def find_devices(controller):
+def find_devices(controller, timeout=500, identify=True):
     """
     Find the GPIB addresses of devices attached to the controller
+
+    All addresses are probed concurrently.  See scanner.BusScanner for scanning
+    several buses at once.
+
+    @param controller : bus address, e.g. devices.controller
+    @type  controller : str
+
+    @param timeout : probe timeout in milliseconds
+    @type  timeout : int
+
+    @return: {primary address: scanner.ProbeResult} for responding devices
     """
-    pysicl.gpib_timeout(500)
-    for addr in range(1,31):
-        print addr
-        if addr != 21:
-            status = dev_status(controller+str(addr))
-            print addr,status
-            if status > -1:
-                print addr,":",status
-    pysicl.gpib_timeout(10000)
+    results = BusScanner(timeout=timeout, identify=identify,
+                         driver=pysicl).scan_bus(controller)
+    return dict((addr, result) for addr, result in results.items()
+                if result.alive)
     
 #============================= Python Gpib Emulation ==========================
 
@@ -107,17 +220,97 @@ class Gpib:
               'info': 'HP437B PM K1',
               'type': '437'}
   """
-  def __init__(self, name=None):
+  def __init__(self, name=None, pool=None, cache=None):
     """
     Create an instance of a GPIB interface or device.
 
-    In this emulation we are only concerned with devices.
+    In this emulation we are only concerned with devices.  The device session
+    is checked out of 'pool' (by default the shared session pool) and held
+    until close() is called.  Queries are answered from 'cache' if given, or
+    else from the module's cache if it is enabled.
     """
     self.count = 0
+    self.throughput = None
+    self.stb = None
+    self.cache = cache
+    self.pool = pool or session_pool
+    self.session = None
+    self._closed = False
+    self._timeout = None
+    self._previous_timeout = None
     if name:
-      self.instrument = pysicl.gpib_open(name)
+      self.name = name
+      self._checkout()
+      self.address = self.session.name
     else:
-      raise RuntimeError, "instrument name required"
+      raise RuntimeError("instrument name required")
+
+  def _checkout(self):
+    """
+    Check a session out of the pool, with the timeout set by tmo().
+    """
+    session = self.pool.checkout(self.name)
+    if self._timeout is not None:
+      try:
+        self._previous_timeout = self.pool.set_timeout(session, self._timeout)
+      except Exception:
+        self.pool.checkin(session, broken=True)
+        raise
+    self.session = session
+
+  @property
+  def instrument(self):
+    """
+    SICL session ID, of a new session if the last one failed.
+    """
+    if self.session is None:
+      if self._closed:
+        raise RuntimeError("%s has been closed" % self.name)
+      self._checkout()
+    return self.session.instr
+
+  def _call(self, func, *args):
+    """
+    Call func(self.instrument, *args), replacing the session if it fails.
+
+    The exception is re-raised as a RuntimeError so that the caller decides
+    whether to repeat the operation on the new session.  If a new session
+    cannot be opened now, the next call tries again.
+    """
+    try:
+      return func(self.instrument, *args)
+    except Exception as details:
+      session, self.session = self.session, None
+      if session is not None:
+        self.pool.checkin(session, broken=True)
+      try:
+        self._checkout()
+      except Exception as reopen:
+        module_logger.debug("Gpib._call: reopening %s failed; %s",
+                            self.name, reopen)
+      raise RuntimeError(details)
+
+  def close(self):
+    """
+    Return the device session to the pool, with its timeout as it was.
+    """
+    self._closed = True
+    session, self.session = self.session, None
+    if session is None:
+      return
+    if self._timeout is not None:
+      try:
+        self.pool.restore_timeout(session, self._previous_timeout)
+      except Exception:
+        self.pool.checkin(session, broken=True)
+        return
+    self.pool.checkin(session)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
 
   def clear(self):
     """
@@ -138,10 +331,7 @@ class Gpib:
     """
     Get status
     """
-    try:
-      return gpib_dev_status(self.instrument)
-    except Exception, details:
-      raise RuntimeError, details
+    return self._call(pysicl.gpib_dev_status)
 
   def read(self, length=512):
     """
@@ -149,18 +339,18 @@ class Gpib:
     """
     module_logger.debug("Gpib.read: entered")
     try:
-      response = pysicl.gpib_rcv(self.instrument,10)
+      response = self._call(pysicl.gpib_rcv, 10)
       module_logger.debug("Gpib.read: response: %s", response)
       module_logger.debug("Gpib.read: response type is %s", type(response))
-    except Exception, details:
+    except Exception as details:
       module_logger.debug("Gpib.read: failed; "+str(details))
-      raise RuntimeError, details
+      raise RuntimeError(details)
     try:
       self.count = len(response)
       module_logger.debug("Gpib.read: got %d bytes", self.count)
-    except Exception, details:
+    except Exception as details:
       module_logger.debug("Gpib.read: getting count failed; "+str(details))
-      raise RuntimeError, details
+      raise RuntimeError(details)
     return response
 
   def readbin(self, len=512):
@@ -170,60 +360,265 @@ class Gpib:
     response = pysicl.gpib_read(self.instrument, len)
     return response
 
+  def readbin_into(self, buffer, offset=0, nbytes=None):
+    """
+    Read raw data directly into 'buffer', without copying.
+
+    'buffer' is any writable object with the buffer protocol, such as a
+    bytearray, memoryview or numpy array.
+
+    @return: (number of bytes read, termination reason)
+    """
+    count, reason = self._call(pysicl.gpib_read_into, buffer, offset, nbytes)
+    self.count = count
+    return count, reason
+
+  def iter_read(self, chunk_size=65536):
+    """
+    Generator which reads a long response in chunks.
+
+    iread is called repeatedly until the END indicator or the termination
+    character ends the response.  Each chunk is yielded as a memoryview of the
+    same buffer, so it is only valid until the next chunk is requested; copy
+    it or write it out before then.  When the response is complete, 'count'
+    holds the total bytes read and 'throughput' the rate in bytes/s.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    total = 0
+    start = time.time()
+    reason = pysicl.I_TERM_MAXCNT
+    while reason not in (pysicl.I_TERM_END, pysicl.I_TERM_CHR):
+      count, reason = self.readbin_into(buffer)
+      total += count
+      if count:
+        yield view[:count]
+      elif reason == pysicl.I_TERM_MAXCNT:
+        break
+    elapsed = time.time() - start
+    self.count = total
+    self.throughput = total/elapsed if elapsed > 0 else float("inf")
+    module_logger.debug("Gpib.iter_read: %d bytes at %.0f bytes/s",
+                        total, self.throughput)
+
+  def readblock_into(self, buffer, dtype="<f4"):
+    """
+    Read an IEEE-488.2 arbitrary block into 'buffer'.
+
+    Reads until the whole block has arrived and returns its data as a numpy
+    array of 'dtype' which shares memory with 'buffer'.
+    """
+    view = memoryview(buffer).cast("B")
+    total, reason = self.readbin_into(view)
+    while reason != pysicl.I_TERM_END:
+      header, length = parse_block_header(view[:total])
+      if length is not None and total >= header + length:
+        break
+      if total == len(view):
+        raise ValueError("%d byte buffer is too small for block" % len(view))
+      count, reason = self.readbin_into(view, total)
+      total += count
+    self.count = total
+    return block_array(view, dtype, total)
+
+  def read_array(self, dtype="f8", byteorder=None, size=65536):
+    """
+    Read a numeric response into a numpy array.
+
+    The response is read with iread into a buffer, which grows if it is too
+    small, and converted there: an arbitrary block as binary data of 'dtype'
+    in 'byteorder', sharing memory with the buffer; anything else as a list
+    of NR1, NR2 or NR3 numbers separated by commas or white space.
+
+    @param dtype : element type
+    @type  dtype : str or numpy.dtype
+
+    @param byteorder : byte order of a block, e.g. '>' or 'normal'; default
+                       that of 'dtype'
+    @type  byteorder : str
+
+    @param size : initial buffer size in bytes
+    @type  size : int
+
+    @return: numpy.ndarray
+    """
+    buffer = bytearray(size)
+    total = 0
+    while True:
+      if total == len(buffer):
+        buffer.extend(bytes(len(buffer)))
+      count, reason = self.readbin_into(buffer, total)
+      total += count
+      if buffer[:1] == b"#":
+        header, length = parse_block_header(buffer[:min(total, 11)])
+        if length is None:
+          done = reason == pysicl.I_TERM_END
+        else:
+          # the data may contain the termination character
+          done = total >= header + length
+          if header + length > len(buffer):
+            buffer.extend(bytes(header + length - len(buffer)))
+      else:
+        done = reason in (pysicl.I_TERM_END, pysicl.I_TERM_CHR)
+      if done or not count:
+        break
+    self.count = total
+    return response_array(buffer, dtype, total, byteorder)
+
+  def ask_array(self, command, dtype="f8", byteorder=None, size=65536):
+    """
+    Send a query and read its numeric response into a numpy array.
+
+    The query is sent with iwrite, terminated and with END, since iread
+    does not flush the formatted write buffer.  See read_array for the
+    arguments.
+    """
+    if not isinstance(command, bytes):
+      command = command.encode("latin-1")
+    if not command.endswith(b"\n"):
+      command += b"\n"
+    self._call(pysicl.gpib_write_raw, command)
+    return self.read_array(dtype, byteorder, size)
+
   def ren(self, val):
     """
     set remote enable
     """
-    raise RuntimeError, "Gpib:ren not implemented"
+    raise RuntimeError("Gpib:ren not implemented")
 
   def rsp(self):
     """
-    Returns the serial poll byte from the instrument trigger()
+    Returns the serial poll byte from the instrument
     """
-    raise RuntimeError, "Gpib:rsp not implemented"
+    return self._call(pysicl.gpib_dev_status)
 
   def tmo(self, value):
     """
     adjust I/O timeout
 
-    This affects the entire interface
+    The timeout, in ms, applies to this object's session until close(),
+    which puts back the timeout the session had in the pool.
     """
     try:
-      return pysicl.gpib_timeout(self.instrument, value)
-    except Exception, details:
-      raise RuntimeError, details
+      self.instrument # opens a new session if the last one failed
+      previous = self.pool.set_timeout(self.session, value)
+    except Exception as details:
+      raise RuntimeError(details)
+    if self._timeout is None:
+      self._previous_timeout = previous
+    self._timeout = value
   
   def trigger(self):
     """
     trigger device
     """
-    raise RuntimeError, "Gpib:trigger not implemented"
+    return self._call(pysicl.gpib_trigger)
   
-  def wait(self, mask):
+  def wait(self, mask, timeout=None):
     """
     wait for event
+
+    Waits for the device to request service if 'mask' includes RQS or SRQ;
+    the device is then serial polled and its status byte left in 'stb'.  The
+    SRQ is detected by the shared srq_dispatcher, so no polling is done.
+
+    @param mask : events to wait for, from RQS, SRQ and TIMO
+    @type  mask : int
+
+    @param timeout : seconds to wait; None waits for ever
+    @type  timeout : float
+
+    @return: RQS if the device requested service, TIMO if the time ran out
     """
-    raise RuntimeError, "Gpib.wait not implemented"
+    if not mask & (RQS | SRQ):
+      return 0
+    self.stb = srq_dispatcher.wait(self.address, timeout=timeout)
+    if self.stb is None:
+      return TIMO
+    return RQS
   
   def write(self, command):
     """
     write data bytes
     """
+    cache = self._cache()
     try:
-      return pysicl.gpib_send(self.instrument, command)
-    except Exception, details:
-      raise RuntimeError, details
+      return self._call(pysicl.gpib_send, command)
+    finally:
+      if cache is not None:
+        cache.written(self.address, command)
 
-  def writebin(self, str, len):
-    raise RuntimeError, "Gpib.writebin not implemented"
+  def _sent(self, method, total, elapsed):
+    self.count = total
+    self.throughput = total/elapsed if elapsed > 0 else float("inf")
+    module_logger.debug("Gpib.%s: %d bytes at %.0f bytes/s",
+                        method, total, self.throughput)
+    return total
+
+  def write_many(self, commands, terminator="\n"):
+    """
+    Send several commands with one flush of the write buffer.
+
+    The commands are put in the SICL formatted write buffer, enlarged with
+    isetbuf if necessary, and sent together, which on a LAN gateway is one
+    network exchange rather than one per command.  'count' holds the bytes
+    sent and 'throughput' the rate in bytes/s.
+
+    @return: number of bytes sent
+    """
+    commands = list(commands)
+    cache = self._cache()
+    start = time.time()
+    try:
+      total = self._call(pysicl.gpib_send_many, commands, terminator)
+    finally:
+      if cache is not None and not all(
+          cache.is_neutral(self.address, command) for command in commands):
+        cache.invalidate(self.address)
+    return self._sent("write_many", total, time.time() - start)
+
+  def writebin(self, data, len=None):
+    """
+    Send binary data unbuffered, with END asserted on the last byte.
+
+    'data' is any object with the buffer protocol, such as bytes, a bytearray
+    or a numpy array; only its first 'len' bytes are sent if given.  'count'
+    holds the bytes sent and 'throughput' the rate in bytes/s.
+
+    @return: number of bytes sent
+    """
+    cache = self._cache()
+    if len is not None:
+      data = memoryview(data).cast("B")[:len]
+    start = time.time()
+    try:
+      total = self._call(pysicl.gpib_write_raw, data)
+    finally:
+      if cache is not None:
+        cache.invalidate(self.address)
+    return self._sent("writebin", total, time.time() - start)
 
   #================================ additional commands =======================
 
+  def _cache(self):
+    if self.cache is not None:
+      return self.cache
+    return query_cache
+
   def ask(self, command):
-    try:
-      return pysicl.gpib_prompt(self.instrument, command)
-    except Exception, details:
-      raise RuntimeError, details
+    cache = self._cache()
+    if cache is None:
+      return self._call(pysicl.gpib_prompt, command)
+    return cache.ask(self.address, command,
+                     lambda command: self._call(pysicl.gpib_prompt, command))
+
+  def ask_many(self, commands, join=False):
+    """
+    Send several queries and return the responses.
+
+    See the module function ask_many for 'join'.
+    """
+    return self._call(_ask_many, list(commands), join)
     
   
 RQS = 2048
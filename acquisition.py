@@ -0,0 +1,344 @@
+"""
+Continuous acquisition of readings into a ring buffer
+
+An Acquisition sends one query to one device over and over on a background
+thread and stores each reading, with the time it arrived, in a preallocated
+numpy ring buffer::
+
+  >>> from Electronics.Interfaces.GPIB.acquisition import Acquisition
+  >>> acq = Acquisition("pm 13-1", "TR2", capacity=100000)
+  >>> acq.start()
+  >>> times, values = acq.buffer.read()       # everything not yet read
+  >>> acq.stats()
+  {'samples': 5210, 'rate': 520.7, 'dropped': 0, 'errors': 0, ...}
+  >>> acq.stop()
+
+The device session is held for the whole run and every response is read into
+the same buffer and converted to float directly from its bytes, so no str
+objects are made per sample.  When the consumer falls behind, the ring
+buffer's policy decides what happens: 'overwrite' drops the oldest unread
+samples, 'drop' discards new ones and 'block' stops acquiring until there is
+room.  Samples lost either way are counted as dropped.  Given a
+sink.TimeSeriesSink, the acquisition also stores every reading in it.
+"""
+import logging
+import threading
+import time
+
+import numpy
+
+from Electronics.Interfaces.GPIB.pool import session_pool
+
+module_logger = logging.getLogger(__name__)
+
+policies = ("overwrite", "drop", "block")
+"""What a full RingBuffer does with a new sample"""
+
+class RingBuffer(object):
+  """
+  Fixed-size buffer of timestamped readings
+
+  Public attributes::
+    capacity - number of samples held
+    policy   - one of 'policies'
+    times    - sample times, seconds since the epoch
+    values   - sample values
+    written  - number of samples ever stored
+    dropped  - number of samples lost because the buffer was full
+  """
+  def __init__(self, capacity, policy="overwrite"):
+    """
+    @param capacity : number of samples held
+    @type  capacity : int
+
+    @param policy : 'overwrite', 'drop' or 'block'
+    @type  policy : str
+    """
+    if policy not in policies:
+      raise ValueError("policy must be one of %s" % ", ".join(policies))
+    self.capacity = capacity
+    self.policy = policy
+    self.times = numpy.zeros(capacity)
+    self.values = numpy.zeros(capacity)
+    self.written = 0
+    self.dropped = 0
+    self._read = 0
+    self._condition = threading.Condition()
+    self._closed = False
+
+  def __len__(self):
+    """
+    Number of samples not yet read.
+    """
+    return self.written - self._read
+
+  def put(self, when, value):
+    """
+    Store a sample.
+
+    @return: False if the sample was dropped or the buffer was closed
+    """
+    with self._condition:
+      if self.written - self._read >= self.capacity:
+        if self.policy == "drop":
+          self.dropped += 1
+          return False
+        if self.policy == "block":
+          while (self.written - self._read >= self.capacity and
+                 not self._closed):
+            self._condition.wait()
+          if self._closed:
+            return False
+        else:
+          self._read += 1
+          self.dropped += 1
+      index = self.written % self.capacity
+      self.times[index] = when
+      self.values[index] = value
+      self.written += 1
+      self._condition.notify_all()
+      return True
+
+  def read(self, count=None, timeout=None):
+    """
+    Remove and return the oldest unread samples.
+
+    @param count : most samples to return; default all unread
+    @type  count : int
+
+    @param timeout : seconds to wait for a sample if there are none
+    @type  timeout : float
+
+    @return: (times, values) as new arrays
+    """
+    with self._condition:
+      if timeout and self.written == self._read and not self._closed:
+        self._condition.wait(timeout)
+      available = self.written - self._read
+      if count is None or count > available:
+        count = available
+      indices = numpy.arange(self._read, self._read + count) % self.capacity
+      self._read += count
+      self._condition.notify_all()
+      return self.times[indices], self.values[indices]
+
+  def latest(self, count):
+    """
+    The newest samples, read or not, without removing them.
+
+    @return: (times, values) as new arrays
+    """
+    with self._condition:
+      count = min(count, self.written, self.capacity)
+      indices = numpy.arange(self.written - count, self.written) \
+                % self.capacity
+      return self.times[indices], self.values[indices]
+
+  def close(self):
+    """
+    Release a producer waiting for room.
+    """
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+
+  def reopen(self):
+    """
+    Accept samples again after close(), keeping those unread.
+    """
+    with self._condition:
+      self._closed = False
+
+class Acquisition(object):
+  """
+  Background acquisition of one query's readings
+
+  Public attributes::
+    device   - device name or SICL address
+    query    - command sent for each reading
+    buffer   - the RingBuffer
+    interval - minimum seconds between queries; 0 for as fast as possible
+    samples  - readings acquired
+    errors   - readings which failed
+    error    - the last failure
+    retry_delay - seconds to wait before reopening a session which failed,
+                  or before querying again after a response which is not a
+                  number when 'interval' is 0
+    sink     - sink.TimeSeriesSink given each reading too, or None
+    channel  - channel name of the readings in the sink
+  """
+  def __init__(self, device, query, capacity=65536, policy="overwrite",
+               interval=0., response_size=64, pool=None, sink=None,
+               channel=None):
+    """
+    @param device : device name or SICL address
+    @type  device : str
+
+    @param query : command which makes the device send one reading
+    @type  query : str
+
+    @param capacity : samples held by the ring buffer
+    @type  capacity : int
+
+    @param policy : what to do when the buffer is full; see RingBuffer
+    @type  policy : str
+
+    @param interval : minimum seconds between queries
+    @type  interval : float
+
+    @param response_size : bytes allowed for one response
+    @type  response_size : int
+
+    @param pool : session pool; default the shared pool
+    @type  pool : pool.SessionPool
+
+    @param sink : also store each reading in this sink
+    @type  sink : sink.TimeSeriesSink
+
+    @param channel : channel name in the sink; default the query
+    @type  channel : str
+    """
+    self.device = device
+    self.query = query
+    self.buffer = RingBuffer(capacity, policy)
+    self.interval = interval
+    self.pool = pool or session_pool
+    self.sink = sink
+    self.channel = query if channel is None else channel
+    self.samples = 0
+    self.errors = 0
+    self.error = None
+    self.retry_delay = 1.
+    self._response = bytearray(b" "*response_size)
+    self._blank = memoryview(b" "*response_size)
+    self._command = None
+    self._thread = None
+    self._running = False
+    self._started = None
+    self._stopped = None
+
+  @property
+  def running(self):
+    return self._running
+
+  def start(self):
+    """
+    Start acquiring on a background thread.
+    """
+    if self._running:
+      return
+    self._running = True
+    self._started = time.time()
+    self._stopped = None
+    query = self.query
+    if not isinstance(query, bytes):
+      query = query.encode("latin-1")
+    self._command = query if query.endswith(b"\n") else query + b"\n"
+    self.buffer.reopen()
+    self._thread = threading.Thread(target=self._run,
+                                    name="acquire %s" % self.device)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """
+    Stop acquiring and return the session to the pool.
+    """
+    self._running = False
+    self.buffer.close()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _reading(self, driver, instr, used):
+    """
+    Send the query and parse the response; return (value, bytes used).
+
+    The query goes with iwrite rather than the formatted buffer, which
+    iread does not flush.  Bytes left over from the previous response are
+    blanked so that float() can parse the whole buffer in place.
+    """
+    driver.gpib_write_raw(instr, self._command)
+    count, reason = driver.gpib_read_into(instr, self._response)
+    if count < used:
+      memoryview(self._response)[count:used] = self._blank[count:used]
+    if reason == driver.I_TERM_MAXCNT:
+      raise ValueError("response longer than %d bytes" % len(self._response))
+    return float(self._response), count
+
+  def _run(self):
+    driver = self.pool.driver
+    session = None
+    used = 0
+    try:
+      while self._running:
+        if session is None:
+          try:
+            session = self.pool.checkout(self.device)
+          except Exception as details:
+            self.errors += 1
+            self.error = details
+            module_logger.warning("Acquisition: cannot open %s: %s",
+                                  self.device, details)
+            time.sleep(self.retry_delay)
+            continue
+        start = time.time()
+        try:
+          value, used = self._reading(driver, session.instr, used)
+        except ValueError as details:
+          self.errors += 1
+          self.error = details
+          self._response[:] = self._blank
+          used = 0
+          module_logger.debug("Acquisition: %s: %s", self.device, details)
+          # the device answers, but not with a reading; querying it again at
+          # once would only keep the bus busy
+          elapsed = time.time() - start
+          time.sleep(max(0., self.interval - elapsed) if self.interval
+                     else self.retry_delay)
+          continue
+        except Exception as details:
+          self.errors += 1
+          self.error = details
+          module_logger.warning("Acquisition: %s: %s", self.device, details)
+          self.pool.checkin(session, broken=True)
+          session = None
+          continue
+        now = time.time()
+        self.samples += 1
+        self.buffer.put(now, value)
+        if self.sink is not None:
+          self.sink.put(now, self.device, self.channel, value)
+        if self.interval:
+          remaining = self.interval - (now - start)
+          if remaining > 0:
+            time.sleep(remaining)
+    finally:
+      self._stopped = time.time()
+      if session is not None:
+        self.pool.checkin(session)
+
+  def stats(self):
+    """
+    Progress of the acquisition.
+
+    @return: {'samples', 'rate' (samples/s), 'dropped', 'errors', 'buffered',
+              'elapsed' (s)}
+    """
+    if self._started is None:
+      elapsed = 0.
+    else:
+      elapsed = (self._stopped or time.time()) - self._started
+    return {"samples": self.samples,
+            "rate": self.samples/elapsed if elapsed else 0.,
+            "dropped": self.buffer.dropped,
+            "errors": self.errors,
+            "buffered": len(self.buffer),
+            "elapsed": elapsed}
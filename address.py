@@ -0,0 +1,114 @@
+"""
+Parsing of SICL device addresses
+
+A SICL address has the form::
+  [lan[<gateway>]:]<interface>[,<primary>[,<secondary>]]
+for example 'lan[137.228.236.90]:hpib,11' or 'gpib0,19'.  The gateway and
+interface together identify a bus, which can carry one transaction at a time.
+
+A controller addresses devices on a bus with command bytes sent with ATN
+asserted; listen_commands() makes those which address a group of devices to
+listen, as before a group execute trigger.
+"""
+import re
+
+_address = re.compile(r"^(?:lan\[(?P<gateway>[^\]]+)\]:)?"
+                      r"(?P<interface>[^,]+)"
+                      r"(?:,(?P<primary>\d+))?"
+                      r"(?:,(?P<secondary>\d+))?$")
+
+def parse(address):
+  """
+  Split a SICL address into its parts.
+
+  @param address : SICL address
+  @type  address : str
+
+  @return: (gateway, interface, primary, secondary) with gateway None for a
+           local interface and primary, secondary None if absent
+  """
+  match = _address.match(address.strip().rstrip(","))
+  if not match:
+    raise ValueError("%r is not a SICL address" % address)
+  gateway, interface, primary, secondary = match.groups()
+  if primary is not None:
+    primary = int(primary)
+  if secondary is not None:
+    secondary = int(secondary)
+  return gateway, interface, primary, secondary
+
+def gateway_of(address):
+  """
+  The LAN gateway of an address, or 'local' for a local interface.
+  """
+  return parse(address)[0] or "local"
+
+def bus_of(address):
+  """
+  The bus (interface session address) that a device address is on.
+
+  >>> bus_of('lan[137.228.236.75]:gpib0,16')
+  'lan[137.228.236.75]:gpib0'
+  """
+  gateway, interface, primary, secondary = parse(address)
+  if gateway:
+    return "lan[%s]:%s" % (gateway, interface)
+  return interface
+
+def device_address(bus, primary, secondary=None):
+  """
+  The address of a device on a bus.
+  """
+  address = "%s,%d" % (bus.rstrip(","), primary)
+  if secondary is not None:
+    address += ",%d" % secondary
+  return address
+
+GET = 0x08
+"""Group execute trigger"""
+LISTEN, TALK, SECONDARY = 0x20, 0x40, 0x60
+"""Bases of the listen, talk and secondary address command bytes"""
+UNL, UNT = 0x3f, 0x5f
+"""Unlisten and untalk"""
+
+def listen_commands(addresses):
+  """
+  Command bytes which make exactly these devices listeners.
+
+  @param addresses : SICL addresses of devices on one bus
+  @type  addresses : list of str
+
+  @return: bytes: UNL, then each device's listen and secondary address
+  """
+  commands = bytearray([UNL])
+  for address in addresses:
+    gateway, interface, primary, secondary = parse(address)
+    if primary is None or not 0 <= primary <= 30:
+      raise ValueError("%r is not a device address" % address)
+    commands.append(LISTEN + primary)
+    if secondary is not None:
+      commands.append(SECONDARY + secondary)
+  return bytes(commands)
+
+def listeners(bus, commands, current=()):
+  """
+  Devices addressed to listen after command bytes are sent on a bus.
+
+  @param current : addresses of the devices listening before
+  @type  current : sequence of str
+
+  @return: list of device addresses
+  """
+  addressed = list(current)
+  listen = False
+  for byte in bytearray(commands):
+    byte &= 0x7f
+    if byte == UNL:
+      addressed = []
+    elif LISTEN <= byte < UNL:
+      addressed.append(device_address(bus, byte - LISTEN))
+    elif SECONDARY <= byte < 0x7f and listen:
+      addressed[-1] = device_address(bus, parse(addressed[-1])[2],
+                                     byte - SECONDARY)
+    listen = LISTEN <= byte < UNL
+  return addressed
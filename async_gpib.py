@@ -0,0 +1,198 @@
+"""
+asyncio interface to GPIB devices
+
+The SICL calls block, so AsyncGpib runs them on a bounded thread pool.  A GPIB
+bus carries one transaction at a time, so operations on devices which share a
+bus (gateway and interface) are serialized, while operations on different
+buses run concurrently::
+
+  >>> async def main():
+  ...   async with AsyncGpib("pm 13-1") as pm1, AsyncGpib("mms 14-1") as mms:
+  ...     power, freq = await asyncio.gather(pm1.ask("?ID"), mms.ask("CF?"))
+
+An operation may be given a timeout in seconds.  It is set on the session with
+itimeout for that operation only, so SICL abandons the transaction; if SICL
+does not return shortly afterwards, the awaiting task gets
+asyncio.TimeoutError anyway.  A timeout is at least 1 ms, since SICL takes 0
+to mean none.  A SICL call cannot be interrupted, so when an operation is
+cancelled or times out the bus stays locked until the call has returned.
+"""
+import asyncio
+import functools
+import logging
+import weakref
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+max_workers = 8
+"""Size of the thread pool shared by AsyncGpib objects"""
+
+timeout_slack = 0.5
+"""Seconds beyond the SICL timeout to wait before giving up on a call"""
+
+_executor = None
+_bus_locks = weakref.WeakKeyDictionary()
+
+def _default_executor():
+  global _executor
+  if _executor is None:
+    _executor = futures.ThreadPoolExecutor(max_workers)
+  return _executor
+
+def _bus_lock(bus):
+  """
+  The lock serializing transactions on a bus, for the running event loop.
+  """
+  locks = _bus_locks.setdefault(asyncio.get_running_loop(), {})
+  if bus not in locks:
+    locks[bus] = asyncio.Lock()
+  return locks[bus]
+
+def _release_when_done(future, lock):
+  """
+  Release 'lock' once the abandoned executor job 'future' finishes.
+  """
+  def done(future):
+    if not future.cancelled() and future.exception():
+      module_logger.debug("abandoned GPIB call failed; %s", future.exception())
+    lock.release()
+  future.add_done_callback(done)
+
+class AsyncGpib(object):
+  """
+  Awaitable GPIB device
+
+  Public attributes::
+    name     - device name as given to gpib_open
+    bus      - address of the bus the device is on
+    timeout  - default operation timeout in seconds, or None
+    count    - number of bytes in the last response
+  """
+  def __init__(self, name, timeout=None, pool=None, executor=None):
+    """
+    @param name : device name or SICL address
+    @type  name : str
+
+    @param timeout : default timeout in seconds for every operation
+    @type  timeout : float
+
+    @param pool : session pool; default the shared pool
+    @type  pool : pool.SessionPool
+
+    @param executor : thread pool for the SICL calls; default a shared pool
+                      of max_workers threads
+    @type  executor : concurrent.futures.Executor
+    """
+    from Electronics.Interfaces.GPIB import gpib_ct
+    self._pysicl = gpib_ct
+    self.name = name
+    self.bus = gpib_address.bus_of(registry.address(name))
+    self.timeout = timeout
+    self.pool = pool or session_pool
+    self.executor = executor or _default_executor()
+    self.count = 0
+    self.session = None
+
+  def _job(self, func, args, timeout):
+    """
+    Run func(instrument, *args) in an executor thread.
+    """
+    if self.session is None:
+      self.session = self.pool.checkout(self.name)
+    session = self.session
+    try:
+      if timeout is None:
+        return func(session.instr, *args)
+      # itimeout(0) would disable the timeout
+      previous = self.pool.set_timeout(session, max(1, int(timeout*1000)))
+      try:
+        return func(session.instr, *args)
+      finally:
+        self.pool.restore_timeout(session, previous)
+    except Exception as details:
+      self.pool.checkin(session, broken=True)
+      self.session = None
+      raise RuntimeError(details)
+
+  async def _run(self, func, *args, **kwargs):
+    timeout = kwargs.get("timeout")
+    if timeout is None:
+      timeout = self.timeout
+    loop = asyncio.get_running_loop()
+    lock = _bus_lock(self.bus)
+    await lock.acquire()
+    future = loop.run_in_executor(
+      self.executor, functools.partial(self._job, func, args, timeout))
+    try:
+      if timeout is None:
+        return await asyncio.shield(future)
+      return await asyncio.wait_for(asyncio.shield(future),
+                                    timeout + timeout_slack)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+      if not future.done():
+        _release_when_done(future, lock)
+        lock = None
+      raise
+    finally:
+      if lock:
+        lock.release()
+
+  async def ask(self, command, timeout=None):
+    """
+    Send a query and return the response.
+    """
+    return await self._run(self._pysicl.gpib_prompt, command,
+                           timeout=timeout)
+
+  async def write(self, command, timeout=None):
+    """
+    Send a command.
+    """
+    return await self._run(self._pysicl.gpib_send, command,
+                           timeout=timeout)
+
+  async def read(self, timeout=None):
+    """
+    Read a response up to the termination character.
+    """
+    response = await self._run(self._pysicl.gpib_rcv, 10,
+                               timeout=timeout)
+    self.count = len(response)
+    return response
+
+  async def readbin(self, length=512, timeout=None):
+    """
+    Read up to 'length' bytes of raw data.
+    """
+    response = await self._run(self._pysicl.gpib_read, length,
+                               timeout=timeout)
+    return response
+
+  async def ibsta(self, timeout=None):
+    """
+    Get the status byte.
+    """
+    return await self._run(self._pysicl.gpib_dev_status,
+                           timeout=timeout)
+
+  async def close(self):
+    """
+    Return the device session to the pool.
+
+    Waits for any transaction on the bus to finish first.
+    """
+    async with _bus_lock(self.bus):
+      if self.session:
+        self.pool.checkin(self.session)
+        self.session = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
@@ -0,0 +1,542 @@
+"""
+Backends which carry out GPIB operations for gpib_ct
+
+A backend provides the primitive operations on device sessions; gpib_ct adds
+name lookup and text conversion on top.  SiclBackend calls the SICL library
+through ctypes and NativeBackend through the C extension in src.  The
+sim.SimBackend simulates instruments in-process.
+
+A backend is chosen with the environment variable GPIB_BACKEND, or with
+gpib_ct.use_backend(), from one of:
+  * 'sicl' (the default), for /usr/lib/libsicl.so,
+  * 'native', for the C extension built from src/pysicl.c, which releases
+    the GIL during I/O,
+  * 'sim', for a SimBackend with the instruments in the device registry,
+  * the path of a shared library with the SICL entry points, or
+  * 'module:attribute', naming a Backend, or an object which has the SICL
+    entry points as attributes.
+"""
+import ctypes as ct
+import importlib
+import logging
+import os
+import threading
+
+module_logger = logging.getLogger(__name__)
+
+default_library = "/usr/lib/libsicl.so"
+
+# iread termination reasons, from sicl.h
+I_TERM_MAXCNT = 1
+I_TERM_END = 2
+I_TERM_CHR = 4
+
+# isetbuf and iflush masks, from sicl.h
+I_BUF_READ = 1
+I_BUF_WRITE = 2
+
+# error returned by iwaithdlr when no handler is called in time, from sicl.h
+I_ERR_TIMEOUT = 15
+
+class Backend(object):
+  """
+  Operations on GPIB device sessions
+
+  Sessions are identified by the integers returned by open().  Messages are
+  bytes.  Failures raise RuntimeError.
+  """
+  def open(self, address):
+    """
+    Open a session to the device at a SICL address; return its ID.
+    """
+    raise NotImplementedError
+
+  def close(self, instr):
+    """
+    Close a session.
+    """
+    raise NotImplementedError
+
+  def timeout(self, instr, milliseconds):
+    """
+    Set the I/O timeout of a session; 0 disables it.
+    """
+    raise NotImplementedError
+
+  def write(self, instr, data):
+    """
+    Send a message to the device.
+    """
+    raise NotImplementedError
+
+  def scan(self, instr, format=b"%t"):
+    """
+    Receive a message from the device, up to the termination character.
+    """
+    raise NotImplementedError
+
+  def read(self, instr, buffer):
+    """
+    Read raw data into a writable memoryview of bytes.
+
+    @return: (number of bytes read, termination reason)
+    """
+    raise NotImplementedError
+
+  def prompt(self, instr, data):
+    """
+    Send a message and receive the response.
+    """
+    raise NotImplementedError
+
+  def readstb(self, instr):
+    """
+    Serial poll the device; return its status byte.
+    """
+    raise NotImplementedError
+
+  def lock(self, instr):
+    """
+    Lock the device to this session.
+    """
+    raise NotImplementedError
+
+  def unlock(self, instr):
+    """
+    Unlock the device.
+    """
+    raise NotImplementedError
+
+  def clear(self, instr):
+    """
+    Send a device clear and discard buffered data.
+    """
+    raise NotImplementedError
+
+  def trigger(self, instr):
+    """
+    Send a group execute trigger to the device.
+    """
+    raise NotImplementedError
+
+  def sendcmd(self, instr, data):
+    """
+    Send bytes with ATN asserted on an interface session.
+    """
+    raise NotImplementedError
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    """
+    Set the size of a session's formatted I/O buffers.
+    """
+    raise NotImplementedError
+
+  def fwrite(self, instr, data, end=False):
+    """
+    Add bytes to the formatted write buffer, which is sent when it fills or
+    is flushed; 'end' asserts END with the last byte.
+
+    @return: number of bytes taken
+    """
+    raise NotImplementedError
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    """
+    Send the formatted write buffer to the device.
+    """
+    raise NotImplementedError
+
+  def write_raw(self, instr, data, end=True):
+    """
+    Send bytes to the device unbuffered, in one transfer.
+
+    @return: number of bytes sent
+    """
+    raise NotImplementedError
+
+  def onsrq(self, instr, handler):
+    """
+    Call handler(instr) when the device requests service; None removes it.
+    """
+    raise NotImplementedError
+
+  def waithdlr(self, milliseconds):
+    """
+    Wait for a handler to be called; with interrupts off, call it here.
+
+    @return: True if a handler was called, False if the time ran out
+    """
+    raise NotImplementedError
+
+  def introff(self):
+    """
+    Hold handlers until waithdlr is called.
+    """
+    raise NotImplementedError
+
+  def intron(self):
+    """
+    Call handlers as soon as their events happen.
+    """
+    raise NotImplementedError
+
+_srq_handler = ct.CFUNCTYPE(None, ct.c_int)
+"""C type of an SRQ handler, void handler(INST id)"""
+
+"""
+argtypes and restype of the SICL entry points used by SiclBackend.
+
+igeterrstr gets the textual explanation of an error code. Pass this function
+the error code you want and this function will return a human-readable string.
+"""
+_signatures = {
+  "iopen":      ([ct.c_char_p], ct.c_int),
+  "itimeout":   ([ct.c_int, ct.c_int], ct.c_void_p),
+  "iprintf":    ([ct.c_int, ct.c_char_p], ct.c_void_p),
+  "iscanf":     ([ct.c_int, ct.c_char_p, ct.c_char_p], ct.c_int),
+  "ipromptf":   ([ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_char_p],
+                 ct.c_void_p),
+  "iclose":     ([ct.c_int], ct.c_void_p),
+  "ilock":      ([ct.c_int], ct.c_void_p),
+  "iunlock":    ([ct.c_int], ct.c_void_p),
+  "ireadstb":   ([ct.c_int, ct.POINTER(ct.c_ubyte)], ct.c_int),
+  "iclear":     ([ct.c_int], ct.c_int),
+  "igeterrstr": ([ct.c_int], ct.c_char_p),
+  "iread":      ([ct.c_int, ct.c_char_p, ct.c_ulong,
+                  ct.POINTER(ct.c_int), ct.POINTER(ct.c_ulong)], ct.c_int),
+  "isetbuf":    ([ct.c_int, ct.c_int, ct.c_int], ct.c_int),
+  "ifwrite":    ([ct.c_int, ct.c_void_p, ct.c_ulong, ct.c_int,
+                  ct.POINTER(ct.c_ulong)], ct.c_int),
+  "iwrite":     ([ct.c_int, ct.c_void_p, ct.c_ulong, ct.c_int,
+                  ct.POINTER(ct.c_ulong)], ct.c_int),
+  "iflush":     ([ct.c_int, ct.c_int], ct.c_int),
+  "itrigger":   ([ct.c_int], ct.c_int),
+  "igpibsendcmd": ([ct.c_int, ct.c_char_p, ct.c_int], ct.c_int),
+  "ionsrq":     ([ct.c_int, _srq_handler], ct.c_int),
+  "iwaithdlr":  ([ct.c_long], ct.c_int),
+  "iintroff":   ([], ct.c_int),
+  "iintron":    ([], ct.c_int)}
+
+class _Symbol(object):
+  """
+  A SICL entry point which is looked up the first time it is called
+  """
+  def __init__(self, backend, name):
+    self.backend = backend
+    self.name = name
+    self.function = None
+
+  def __call__(self, *args):
+    function = self.function
+    if function is None:
+      function = getattr(self.backend.library(), self.name)
+      function.argtypes, function.restype = _signatures[self.name]
+      self.function = function
+    return function(*args)
+
+class SiclBackend(Backend):
+  """
+  Backend calling the SICL library through ctypes
+
+  The library is not loaded until the first operation, so that creating the
+  backend does not need SICL to be installed.
+
+  Public attributes::
+    path    - file name of the library, if it is loaded from a file
+    sicllib - the library, or None if not loaded yet
+  """
+  response_size = 2048
+  """Size of the buffer for formatted input"""
+
+  def __init__(self, path=default_library, library=None):
+    """
+    @param path : file name of the SICL shared library
+    @type  path : str
+
+    @param library : an object with the SICL entry points as attributes, used
+                     instead of loading 'path'
+    @type  library : object
+    """
+    self.path = path
+    self.sicllib = library
+    self._load_lock = threading.Lock()
+    self._buffers = threading.local()
+    self._handlers = {}
+    for name in _signatures:
+      setattr(self, "_" + name, _Symbol(self, name))
+
+  def library(self):
+    """
+    The SICL library, loaded on first use.
+    """
+    if self.sicllib is None:
+      with self._load_lock:
+        if self.sicllib is None:
+          module_logger.debug("SiclBackend: loading %s", self.path)
+          self.sicllib = ct.CDLL(self.path)
+    return self.sicllib
+
+  def _response(self):
+    """
+    This thread's buffer for formatted input.
+    """
+    buffer = getattr(self._buffers, "response", None)
+    if buffer is None:
+      buffer = self._buffers.response = ct.create_string_buffer(
+        self.response_size)
+    buffer[0] = b"\000"
+    return buffer
+
+  def errstr(self, status):
+    """
+    Text explaining a SICL error code.
+    """
+    text = self._igeterrstr(status) or b"SICL error %d" % status
+    return text.decode("latin-1")
+
+  def open(self, address):
+    instr = self._iopen(address)
+    if not instr:
+      raise RuntimeError("open of GPIB address %s failed"
+                         % address.decode("latin-1"))
+    return instr
+
+  def close(self, instr):
+    return self._iclose(instr)
+
+  def timeout(self, instr, milliseconds):
+    return self._itimeout(instr, milliseconds)
+
+  def write(self, instr, data):
+    # as in the native backend, the text is an argument rather than the
+    # format, so '%' is sent as it is, and the buffer is flushed at once
+    self._iprintf(instr, b"%s", data)
+    return self.flush(instr)
+
+  def scan(self, instr, format=b"%t"):
+    response = self._response()
+    status = self._iscanf(instr, format, response)
+    module_logger.debug("SiclBackend.scan: %d values converted", status)
+    return response.value
+
+  def read(self, instr, buffer):
+    nbytes = buffer.nbytes
+    target = (ct.c_char*nbytes).from_buffer(buffer)
+    reason = ct.c_int()
+    count = ct.c_ulong()
+    status = self._iread(instr, target, nbytes, ct.byref(reason),
+                         ct.byref(count))
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return count.value, reason.value
+
+  def prompt(self, instr, data):
+    response = self._response()
+    self._ipromptf(instr, b"%s", b"%t", data, response)
+    return response.value
+
+  def readstb(self, instr):
+    stb = ct.c_ubyte()
+    status = self._ireadstb(instr, ct.byref(stb))
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return stb.value
+
+  def lock(self, instr):
+    return self._ilock(instr)
+
+  def unlock(self, instr):
+    return self._iunlock(instr)
+
+  def clear(self, instr):
+    return self._iclear(instr)
+
+  def trigger(self, instr):
+    status = self._itrigger(instr)
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return status
+
+  def sendcmd(self, instr, data):
+    status = self._igpibsendcmd(instr, data, len(data))
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return status
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    status = self._isetbuf(instr, mask, size)
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return status
+
+  def _write(self, function, instr, data, end):
+    # bytes are passed as they are; other buffers without copying
+    if isinstance(data, bytes):
+      pointer, nbytes = data, len(data)
+    else:
+      view = memoryview(data).cast("B")
+      nbytes = view.nbytes
+      if view.readonly:
+        pointer = view.tobytes()
+      else:
+        pointer = (ct.c_char*nbytes).from_buffer(view)
+    count = ct.c_ulong()
+    status = function(instr, ct.cast(pointer, ct.c_void_p), nbytes,
+                      1 if end else 0, ct.byref(count))
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return count.value
+
+  def fwrite(self, instr, data, end=False):
+    return self._write(self._ifwrite, instr, data, end)
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    status = self._iflush(instr, mask)
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return status
+
+  def write_raw(self, instr, data, end=True):
+    return self._write(self._iwrite, instr, data, end)
+
+  def onsrq(self, instr, handler):
+    if handler is None:
+      callback = None
+    else:
+      callback = _srq_handler(handler)
+    status = self._ionsrq(instr, callback)
+    if status:
+      raise RuntimeError(self.errstr(status))
+    # the callback must live as long as SICL may call it
+    if callback is None:
+      self._handlers.pop(instr, None)
+    else:
+      self._handlers[instr] = callback
+    return status
+
+  def waithdlr(self, milliseconds):
+    status = self._iwaithdlr(milliseconds)
+    if status == I_ERR_TIMEOUT:
+      return False
+    if status:
+      raise RuntimeError(self.errstr(status))
+    return True
+
+  def introff(self):
+    return self._iintroff()
+
+  def intron(self):
+    return self._iintron()
+
+class NativeBackend(Backend):
+  """
+  Backend calling SICL through the C extension built from src/pysicl.c
+
+  The extension releases the GIL while SICL does I/O, so threads talking to
+  different buses run in parallel.  It is imported on first use.
+
+  Public attributes::
+    module - the extension module, or None if not imported yet
+  """
+  def __init__(self, module=None):
+    """
+    @param module : module with the functions of the extension, used instead
+                    of importing Electronics.Interfaces.GPIB._pysicl
+    @type  module : module
+    """
+    self.module = module
+
+  def _module(self):
+    if self.module is None:
+      self.module = importlib.import_module(
+        "Electronics.Interfaces.GPIB._pysicl")
+    return self.module
+
+  def open(self, address):
+    return self._module().gpib_open(address)
+
+  def close(self, instr):
+    return self._module().gpib_close(instr)
+
+  def timeout(self, instr, milliseconds):
+    return self._module().gpib_timeout(instr, milliseconds)
+
+  def write(self, instr, data):
+    return self._module().gpib_send(instr, data)
+
+  def scan(self, instr, format=b"%t"):
+    # the extension reads up to the termination character with ifread
+    return self._module().gpib_rcv(instr).encode("latin-1")
+
+  def read(self, instr, buffer):
+    return self._module().gpib_read_into(instr, buffer)
+
+  def prompt(self, instr, data):
+    return self._module().gpib_prompt(instr, data).encode("latin-1")
+
+  def readstb(self, instr):
+    return self._module().gpib_dev_status(instr)
+
+  def lock(self, instr):
+    return self._module().gpib_lock(instr)
+
+  def unlock(self, instr):
+    return self._module().gpib_unlock(instr)
+
+  def clear(self, instr):
+    return self._module().clear(instr)
+
+  def trigger(self, instr):
+    return self._module().gpib_trigger(instr)
+
+  def sendcmd(self, instr, data):
+    return self._module().gpib_sendcmd(instr, data)
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    return self._module().gpib_setbuf(instr, size, mask)
+
+  def fwrite(self, instr, data, end=False):
+    return self._module().gpib_fwrite(instr, data, end)
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    return self._module().gpib_flush(instr, mask)
+
+  def write_raw(self, instr, data, end=True):
+    return self._module().gpib_write_raw(instr, data, end)
+
+  def onsrq(self, instr, handler):
+    return self._module().gpib_onsrq(instr, handler)
+
+  def waithdlr(self, milliseconds):
+    return self._module().gpib_waithdlr(milliseconds)
+
+  def introff(self):
+    return self._module().gpib_introff()
+
+  def intron(self):
+    return self._module().gpib_intron()
+
+def load_backend(spec):
+  """
+  Create the backend named by a GPIB_BACKEND specification.
+
+  @param spec : 'sicl', 'native', 'sim', a library path, or
+                'module:attribute'
+  @type  spec : str
+
+  @return: Backend
+  """
+  if spec == "sicl":
+    return SiclBackend()
+  if spec == "native":
+    return NativeBackend()
+  if spec == "sim":
+    from Electronics.Interfaces.GPIB.sim import SimBackend
+    return SimBackend.from_registry()
+  if ":" in spec and os.path.sep not in spec.split(":")[0]:
+    module_name, attribute = spec.split(":", 1)
+    backend = getattr(importlib.import_module(module_name), attribute)
+    if isinstance(backend, Backend):
+      return backend
+    return SiclBackend(library=backend)
+  return SiclBackend(spec)
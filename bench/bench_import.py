@@ -0,0 +1,47 @@
+"""
+Benchmark the time taken to import the GPIB package
+
+Each import is done in a fresh interpreter.  The package must be importable
+as Electronics.Interfaces.GPIB, but SICL need not be installed::
+
+  $ python bench/bench_import.py --runs 20
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import Electronics.Interfaces.GPIB
+elapsed = time.perf_counter() - start
+from Electronics.Interfaces.GPIB import gpib_ct
+print(elapsed, gpib_ct._backend is not None)
+"""
+
+def import_times(runs):
+  """
+  Seconds taken by each of 'runs' cold imports.
+  """
+  times = []
+  for run in range(runs):
+    output = subprocess.check_output([sys.executable, "-c", probe])
+    elapsed, loaded = output.decode().split()
+    if loaded == "True":
+      raise RuntimeError("importing the package loaded a backend")
+    times.append(float(elapsed))
+  return times
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--runs", type=int, default=10)
+  args = parser.parse_args()
+  times = sorted(import_times(args.runs))
+  print(json.dumps({"runs": args.runs,
+                    "min_ms": 1e3*times[0],
+                    "median_ms": 1e3*times[len(times)//2],
+                    "max_ms": 1e3*times[-1]}))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+"""
+Benchmark the parsing of numeric responses into numpy arrays
+
+Compares, for traces of several lengths, the usual conversion of a comma
+separated list, float() on each item of resp.split(','), with
+ieee488.ascii_array, and struct.unpack of an arbitrary block with
+ieee488.response_array.  No instrument is involved.  The package must be
+importable as Electronics.Interfaces.GPIB::
+
+  $ python bench/bench_parse.py --points 100,1000,10000,100000
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy
+
+from Electronics.Interfaces.GPIB.ieee488 import ascii_array, response_array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import per_call
+
+def naive_ascii(response):
+  """
+  What callers do with the text from gpib_prompt
+  """
+  text = response.decode("latin-1")
+  return numpy.array([float(item) for item in text.strip().split(",")])
+
+def naive_block(response):
+  """
+  struct.unpack of a definite length block of big-endian floats
+  """
+  ndigits = int(response[1:2])
+  length = int(response[2:2 + ndigits])
+  data = response[2 + ndigits:2 + ndigits + length]
+  return numpy.array(struct.unpack(">%df" % (length//4), data))
+
+def responses(points):
+  """
+  The same trace as an NR3 list and as a block, each with a newline
+  """
+  trace = numpy.random.normal(-30., 1., points)
+  text = (",".join("%+.6E" % value for value in trace) + "\n").encode()
+  data = trace.astype(">f4").tobytes()
+  block = b"#%d%d" % (len(str(len(data))), len(data)) + data + b"\n"
+  return text, block
+
+def measure(points, seconds):
+  text, block = responses(points)
+  numpy.testing.assert_allclose(naive_ascii(text), ascii_array(text))
+  numpy.testing.assert_array_equal(naive_block(block),
+                                   response_array(block, "f4", byteorder=">"))
+  result = {}
+  for name, func, data in (
+      ("naive_ascii", naive_ascii, text),
+      ("ascii_array", ascii_array, text),
+      ("naive_block", naive_block, block),
+      ("block_array", lambda data: response_array(data, "f4", byteorder=">"),
+       block)):
+    elapsed = per_call(lambda: func(data), seconds)
+    result[name] = {"us": 1e6*elapsed, "points_per_s": points/elapsed}
+  result["ascii_speedup"] = (result["naive_ascii"]["us"] /
+                             result["ascii_array"]["us"])
+  result["block_speedup"] = (result["naive_block"]["us"] /
+                             result["block_array"]["us"])
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--points", default="100,1000,10000,100000",
+                      help="comma separated trace lengths")
+  parser.add_argument("--seconds", type=float, default=0.5,
+                      help="time spent on each measurement")
+  parser.add_argument("--json", action="store_true",
+                      help="print the results as JSON")
+  args = parser.parse_args()
+  results = dict((int(points), measure(int(points), args.seconds))
+                 for points in args.points.split(","))
+  if args.json:
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return
+  print("%8s %12s %12s %8s %12s %12s %8s"
+        % ("points", "split us", "array us", "x", "unpack us", "block us",
+           "x"))
+  for points, result in sorted(results.items()):
+    print("%8d %12.1f %12.1f %8.1f %12.1f %12.1f %8.1f"
+          % (points, result["naive_ascii"]["us"], result["ascii_array"]["us"],
+             result["ascii_speedup"], result["naive_block"]["us"],
+             result["block_array"]["us"], result["block_speedup"]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,58 @@
+"""
+Benchmark ask() with and without the session pool
+
+Runs against FakeSicl so no hardware is needed.  The package must be
+importable as Electronics.Interfaces.GPIB::
+
+  $ python bench/bench_pool.py --calls 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakesicl
+
+def unpooled_ask(pysicl, device, request):
+  """
+  The pre-pool ask(): open, prompt and close for every request
+  """
+  instr = pysicl.gpib_open(device)
+  resp = pysicl.gpib_prompt(instr, request)
+  pysicl.gpib_close(instr)
+  return resp
+
+def rate(func, calls):
+  """
+  Calls per second achieved by func()
+  """
+  start = time.time()
+  for count in range(calls):
+    func()
+  return calls/(time.time() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--calls", type=int, default=200)
+  parser.add_argument("--open-latency", type=float, default=0.005)
+  parser.add_argument("--io-latency", type=float, default=0.001)
+  parser.add_argument("--device", default="pm 13-1")
+  args = parser.parse_args()
+
+  fake = fakesicl.install(fakesicl.FakeSicl(open_latency=args.open_latency,
+                                            close_latency=args.open_latency/2,
+                                            io_latency=args.io_latency))
+  from Electronics.Interfaces import GPIB
+  from Electronics.Interfaces.GPIB import gpib_ct
+
+  without = rate(lambda: unpooled_ask(gpib_ct, args.device, "*IDN?"),
+                 args.calls)
+  with_pool = rate(lambda: GPIB.ask(args.device, "*IDN?"), args.calls)
+  print("without pool: %8.1f calls/s" % without)
+  print("with pool:    %8.1f calls/s" % with_pool)
+  print("speed-up:     %8.2f" % (with_pool/without))
+  print("pool stats:   %s" % GPIB.session_pool.stats)
+
+if __name__ == "__main__":
+  main()
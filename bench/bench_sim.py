@@ -0,0 +1,79 @@
+"""
+Throughput, latency and contention of ask() against simulated instruments
+
+Uses sim.SimBackend with the instruments in the device registry, so it runs
+on any machine.  The package must be importable as Electronics.Interfaces.GPIB::
+
+  $ python bench/bench_sim.py --seconds 2
+"""
+import argparse
+import json
+import threading
+import time
+
+def poll(ask, device, query, seconds):
+  """
+  Ask 'query' of 'device' repeatedly for 'seconds'; return the latencies.
+  """
+  latencies = []
+  stop = time.time() + seconds
+  while time.time() < stop:
+    start = time.time()
+    ask(device, query)
+    latencies.append(time.time() - start)
+  return latencies
+
+def summary(latencies, seconds):
+  latencies = sorted(latencies)
+  count = len(latencies)
+  return {"calls": count,
+          "calls_per_s": count/seconds,
+          "p50_ms": 1e3*latencies[count//2],
+          "p99_ms": 1e3*latencies[min(count - 1, int(count*0.99))]}
+
+def concurrent(ask, devices, query, seconds):
+  """
+  Poll every device from its own thread at once.
+  """
+  results = {}
+  def worker(device):
+    results[device] = poll(ask, device, query, seconds)
+  threads = [threading.Thread(target=worker, args=(device,))
+             for device in devices]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return dict((device, summary(latencies, seconds))
+              for device, latencies in results.items())
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--seconds", type=float, default=2.)
+  parser.add_argument("--latency", type=float, default=0.002,
+                      help="instrument latency in seconds")
+  args = parser.parse_args()
+
+  from Electronics.Interfaces import GPIB
+  from Electronics.Interfaces.GPIB import gpib_ct, sim
+  backend = sim.SimBackend.from_registry()
+  for instrument in backend.instruments.values():
+    instrument.script("TR2", sim.reading(), args.latency)
+    instrument.alive = True
+  gpib_ct.use_backend(backend)
+  start = time.time()
+
+  shared_bus = ["pm 13-1", "pm 13-2", "pm 13-4", "pm 13-5"]
+  separate_buses = ["pm 13-1", "pm 14-1", "mms 14-1", "pm 13-3"]
+  results = {
+    "single": summary(poll(GPIB.ask, "pm 13-1", "TR2", args.seconds),
+                      args.seconds),
+    "shared_bus": concurrent(GPIB.ask, shared_bus, "TR2", args.seconds),
+    "separate_buses": concurrent(GPIB.ask, separate_buses, "TR2",
+                                 args.seconds),
+    "bus_utilization": dict((bus, busy/(time.time() - start))
+                            for bus, busy in backend.busy.items())}
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,97 @@
+"""
+Benchmark the time series sink
+
+Measures the rate at which threads, one for each power meter in devices.py,
+can put() samples into a TimeSeriesSink, the rate of put_many(), and the time
+TimeSeriesReader takes to read a short time range compared with loading the
+whole of a device's columns.  The files go in a temporary directory.  The
+package must be importable as Electronics.Interfaces.GPIB::
+
+  $ python bench/bench_sink.py --samples 200000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+from Electronics.Interfaces.GPIB import devices
+from Electronics.Interfaces.GPIB.sink import TimeSeriesSink, TimeSeriesReader
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import per_call
+
+def put_rate(root, names, samples):
+  """
+  Samples/s put() by one thread per device, including the final flush
+  """
+  sink = TimeSeriesSink(root)
+  def produce(name):
+    for count in range(samples):
+      sink.put(count*1e-3, name, "power", -30.)
+  threads = [threading.Thread(target=produce, args=(name,)) for name in names]
+  start = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  sink.close()
+  return len(names)*samples/(time.perf_counter() - start)
+
+def put_many_rate(root, names, samples, block=1000):
+  """
+  Samples/s put_many() in blocks, including the final flush
+  """
+  sink = TimeSeriesSink(root)
+  values = numpy.full(block, -30.)
+  start = time.perf_counter()
+  for first in range(samples, 2*samples, block):
+    times = numpy.arange(first, first + block)*1e-3
+    for name in names:
+      sink.put_many(name, "trace", times, values)
+  sink.close()
+  return len(names)*samples/(time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--samples", type=int, default=200000,
+                      help="samples per device")
+  parser.add_argument("--seconds", type=float, default=0.5,
+                      help="time spent on each read measurement")
+  parser.add_argument("--json", action="store_true",
+                      help="print the results as JSON")
+  args = parser.parse_args()
+  names = ["pm %s" % name for name in sorted(devices.pm)]
+  root = tempfile.mkdtemp()
+  try:
+    result = {"devices": len(names),
+              "put_per_s": put_rate(root, names, args.samples),
+              "put_many_per_s": put_many_rate(root, names, args.samples)}
+    reader = TimeSeriesReader(root)
+    middle = args.samples*1e-3
+    directory = os.path.join(root, urllib.parse.quote(names[0], safe=""))
+    result["read_1s_us"] = 1e6*per_call(
+      lambda: reader.read(names[0], middle, middle + 1., channel="trace"),
+      args.seconds)
+    result["load_all_us"] = 1e6*per_call(
+      lambda: [numpy.load(os.path.join(directory, "%s.npy" % column))
+               for column in ("time", "channel", "value")], args.seconds)
+  finally:
+    shutil.rmtree(root)
+  if args.json:
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return
+  print("%d devices, %d samples each" % (len(names), args.samples))
+  print("put()            %12.0f samples/s" % result["put_per_s"])
+  print("put_many()       %12.0f samples/s" % result["put_many_per_s"])
+  print("read 1 s range   %12.1f us" % result["read_1s_us"])
+  print("load all columns %12.1f us" % result["load_all_us"])
+
+if __name__ == "__main__":
+  main()
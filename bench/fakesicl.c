@@ -0,0 +1,173 @@
+/* Stand-in for libsicl.so for benchmarking without hardware
+
+   Built as libsicl.so by the Makefile in this directory, it can be loaded
+   by gpib_ct through ctypes (GPIB_BACKEND=<path>) and linked with the C
+   extension in src, so that the two paths are measured against the same
+   library.  Every I/O call sleeps for the configured latency, ifwrite only
+   when the write buffer is flushed; iread and ifread return 'payload'
+   bytes.  fakesicl_configure() sets both. */
+
+#include <stdarg.h>
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+#include "sicl.h"
+
+static const char response[] = "HEWLETT-PACKARD,437B,0,1.0\n";
+static long open_latency = 0;      /* microseconds */
+static long io_latency = 0;        /* microseconds */
+static unsigned long payload = sizeof(response) - 1;
+static int next_id = 1;
+static void (*srq_handler)(INST id) = NULL;
+static INST srq_id = 0;
+static unsigned long buffered = 0; /* bytes in the write buffer */
+
+void fakesicl_configure(long open_us, long io_us, unsigned long nbytes) {
+   open_latency = open_us;
+   io_latency = io_us;
+   payload = nbytes;
+}
+
+static void io_delay(void) {
+   if (io_latency > 0) {
+      usleep(io_latency);
+   }
+}
+
+INST iopen(char *addr) {
+   if (open_latency > 0) {
+      usleep(open_latency);
+   }
+   return __sync_fetch_and_add(&next_id, 1);
+}
+
+int iclose(INST id) { return 0; }
+int itimeout(INST id, long tval) { return 0; }
+int igeterrno(void) { return 0; }
+int itermchr(INST id, int tchr) { return 0; }
+int ilock(INST id) { return 0; }
+int iunlock(INST id) { return 0; }
+int iclear(INST id) { return 0; }
+int itrigger(INST id) { io_delay(); return 0; }
+int igpibsendcmd(INST id, char *buf, int length) { io_delay(); return 0; }
+int iintroff(void) { return 0; }
+int iintron(void) { return 0; }
+
+char *igeterrstr(int errorcode) {
+   return errorcode ? "fake SICL error" : "no error";
+}
+
+int isetbuf(INST id, int mask, int size) { return 0; }
+
+int iflush(INST id, int mask) {
+   if ((mask & I_BUF_WRITE) && buffered) {
+      buffered = 0;
+      io_delay();
+   }
+   return 0;
+}
+
+int ifwrite(INST id, char *buf, unsigned long datalen, int endi,
+            unsigned long *actualcnt) {
+   buffered += datalen;
+   if (actualcnt) {
+      *actualcnt = datalen;
+   }
+   return endi ? iflush(id, I_BUF_WRITE) : 0;
+}
+
+int iwrite(INST id, char *buf, unsigned long datalen, int endi,
+           unsigned long *actualcnt) {
+   io_delay();
+   if (actualcnt) {
+      *actualcnt = datalen;
+   }
+   return 0;
+}
+
+int iprintf(INST id, const char *format, ...) {
+   io_delay();
+   return 1;
+}
+
+int iscanf(INST id, const char *format, ...) {
+   va_list args;
+   char *buf;
+
+   io_delay();
+   va_start(args, format);
+   buf = va_arg(args, char *);
+   strcpy(buf, response);
+   va_end(args);
+   return 1;
+}
+
+/* The response buffer follows one argument for each conversion in the
+   write format. */
+int ipromptf(INST id, const char *writefmt, const char *readfmt, ...) {
+   va_list args;
+   const char *p;
+   char *buf;
+
+   io_delay();
+   io_delay();
+   va_start(args, readfmt);
+   for (p = writefmt; (p = strchr(p, '%')) != NULL; p++) {
+      if (p[1] == '%') {
+         p++;
+      } else {
+         (void) va_arg(args, char *);
+      }
+   }
+   buf = va_arg(args, char *);
+   strcpy(buf, response);
+   va_end(args);
+   return 2;
+}
+
+int iread(INST id, char *buf, unsigned long bufsize, int *reason,
+          unsigned long *actualcnt) {
+   unsigned long count = payload < bufsize ? payload : bufsize;
+
+   io_delay();
+   memset(buf, 'x', count);
+   if (reason) {
+      *reason = count == payload ? I_TERM_END : I_TERM_MAXCNT;
+   }
+   if (actualcnt) {
+      *actualcnt = count;
+   }
+   return 0;
+}
+
+int ifread(INST id, char *buf, unsigned long bufsize, int *reason,
+           unsigned long *actualcnt) {
+   unsigned long count = sizeof(response) - 1;
+
+   io_delay();
+   memcpy(buf, response, count);
+   if (reason) {
+      *reason = I_TERM_CHR;
+   }
+   if (actualcnt) {
+      *actualcnt = count;
+   }
+   return 0;
+}
+
+int ireadstb(INST id, unsigned char *stb) {
+   io_delay();
+   *stb = 0;
+   return 0;
+}
+
+int ionsrq(INST id, void (*shdlr)(INST id)) {
+   srq_handler = shdlr;
+   srq_id = id;
+   return 0;
+}
+
+int iwaithdlr(long timeout) {
+   usleep(timeout*1000);
+   return I_ERR_TIMEOUT;
+}
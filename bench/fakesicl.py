@@ -0,0 +1,141 @@
+"""
+Stand-in for libsicl.so for benchmarking without hardware
+
+A FakeSicl object provides the SICL entry points which gpib_ct binds, with
+configurable delays that imitate a LAN gateway.  install() makes gpib_ct use
+it in place of libsicl.so; so does GPIB_BACKEND=fakesicl:sicl with this
+directory on the path.
+"""
+import ctypes as ct
+import itertools
+import threading
+import time
+
+class _Symbol(object):
+  """
+  Callable which accepts the argtypes/restype attributes ctypes sets
+  """
+  def __init__(self, func):
+    self.func = func
+    self.argtypes = None
+    self.restype = None
+
+  def __call__(self, *args):
+    return self.func(*args)
+
+class FakeSicl(object):
+  """
+  Simulated SICL library
+
+  Public attributes::
+    open_latency  - seconds taken by iopen
+    close_latency - seconds taken by iclose
+    io_latency    - seconds taken by each bus transaction
+    response      - bytes returned by ipromptf and iscanf
+    payload       - bytes returned by iread; None for 'response'
+    calls         - dict of call counts by symbol name
+  """
+  def __init__(self, open_latency=0.005, close_latency=0.002,
+               io_latency=0.001, response=b"HEWLETT-PACKARD,437B,0,1.0",
+               payload=None):
+    self.open_latency = open_latency
+    self.close_latency = close_latency
+    self.io_latency = io_latency
+    self.response = response
+    self.payload = payload
+    self.calls = {}
+    self._ids = itertools.count(1)
+    self._open = set()
+    self._lock = threading.Lock()
+    for name in ("iopen", "iclose", "itimeout", "iprintf", "iscanf",
+                 "ipromptf", "ilock", "iunlock", "ireadstb", "iclear",
+                 "igeterrstr", "iread", "iflush"):
+      setattr(self, name, _Symbol(self._counted(name)))
+
+  def _counted(self, name):
+    method = getattr(self, "_" + name)
+    def counted(*args):
+      with self._lock:
+        self.calls[name] = self.calls.get(name, 0) + 1
+      return method(*args)
+    return counted
+
+  def _check(self, instr):
+    if instr not in self._open:
+      return 1
+    return 0
+
+  def _iopen(self, address):
+    time.sleep(self.open_latency)
+    instr = next(self._ids)
+    self._open.add(instr)
+    return instr
+
+  def _iclose(self, instr):
+    time.sleep(self.close_latency)
+    self._open.discard(instr)
+    return 0
+
+  def _itimeout(self, instr, milliseconds):
+    return 0
+
+  def _iprintf(self, instr, format, *args):
+    time.sleep(self.io_latency)
+    return self._check(instr)
+
+  def _iflush(self, instr, mask):
+    return self._check(instr)
+
+  def _iscanf(self, instr, fmt, buf):
+    time.sleep(self.io_latency)
+    buf.value = self.response
+    return 1
+
+  def _ipromptf(self, instr, writefmt, readfmt, *args):
+    buf = args[-1]
+    time.sleep(2*self.io_latency)
+    buf.value = self.response
+    return self._check(instr)
+
+  def _ilock(self, instr):
+    return 0
+
+  def _iunlock(self, instr):
+    return 0
+
+  def _ireadstb(self, instr, stb):
+    time.sleep(self.io_latency)
+    stb._obj.value = 0
+    return self._check(instr)
+
+  def _iclear(self, instr):
+    return 0
+
+  def _igeterrstr(self, error):
+    return b"fake SICL error %d" % error
+
+  def _iread(self, instr, buf, size, reason, count):
+    time.sleep(self.io_latency)
+    if self.payload is None:
+      n = min(size, len(self.response))
+      ct.memmove(buf, self.response, n)
+      reason._obj.value = 4
+    else:
+      n = min(size, self.payload)
+      ct.memset(buf, ord("x"), n)
+      reason._obj.value = 2 if n == self.payload else 1
+    count._obj.value = n
+    return self._check(instr)
+
+def install(fake=None):
+  """
+  Make gpib_ct use 'fake' as its SICL library.
+
+  @return: the FakeSicl object
+  """
+  from Electronics.Interfaces.GPIB import gpib_ct
+  fake = fake or FakeSicl()
+  gpib_ct.use_backend(fake)
+  return fake
+
+sicl = FakeSicl()
@@ -0,0 +1,52 @@
+/* Minimal stand-in for the SICL header, declaring only what src/pysicl.c
+   and fakesicl.c use, so that both can be built for benchmarking on a
+   machine without SICL.  The values are those of the real sicl.h. */
+
+#ifndef FAKE_SICL_H
+#define FAKE_SICL_H
+
+typedef int INST;
+
+#define I_ERR_NOERROR    0
+#define I_ERR_BADID      5
+#define I_ERR_TIMEOUT   15
+#define I_ERR_INTERRUPT 24
+
+#define I_BUF_READ       1
+#define I_BUF_WRITE      2
+
+#define I_TERM_MAXCNT    1
+#define I_TERM_END       2
+#define I_TERM_CHR       4
+
+INST  iopen(char *addr);
+int   iclose(INST id);
+int   itimeout(INST id, long tval);
+int   igeterrno(void);
+char *igeterrstr(int errorcode);
+int   iprintf(INST id, const char *format, ...);
+int   iscanf(INST id, const char *format, ...);
+int   ipromptf(INST id, const char *writefmt, const char *readfmt, ...);
+int   iflush(INST id, int mask);
+int   isetbuf(INST id, int mask, int size);
+int   ifwrite(INST id, char *buf, unsigned long datalen, int endi,
+              unsigned long *actualcnt);
+int   iwrite(INST id, char *buf, unsigned long datalen, int endi,
+             unsigned long *actualcnt);
+int   itermchr(INST id, int tchr);
+int   iread(INST id, char *buf, unsigned long bufsize, int *reason,
+            unsigned long *actualcnt);
+int   ifread(INST id, char *buf, unsigned long bufsize, int *reason,
+             unsigned long *actualcnt);
+int   ilock(INST id);
+int   iunlock(INST id);
+int   ireadstb(INST id, unsigned char *stb);
+int   iclear(INST id);
+int   itrigger(INST id);
+int   igpibsendcmd(INST id, char *buf, int length);
+int   ionsrq(INST id, void (*shdlr)(INST id));
+int   iwaithdlr(long timeout);
+int   iintroff(void);
+int   iintron(void);
+
+#endif
@@ -0,0 +1,279 @@
+"""
+Benchmark suite for the GPIB access layer, with JSON output
+
+Measures, for each path to SICL:
+  * import time of the package,
+  * gpib_open/gpib_close of a session,
+  * ask() round trip through the session pool,
+  * gpib_rcv per call, and gpib_read and gpib_read_into throughput for a
+    range of payload sizes,
+  * find_devices() on a bus of 30 addresses, and
+  * calls/s of many threads polling different devices at once.
+
+The paths are 'python' (gpib_ct over the FakeSicl object in fakesicl.py),
+'ctypes' (gpib_ct over bench/build/libsicl.so, a C stand-in for libsicl) and
+'native' (the C extension from src/pysicl.c linked with that stand-in).  The
+last two need 'make -C bench' first and are skipped otherwise.  Each path
+runs in a fresh interpreter.  The package must be importable as
+Electronics.Interfaces.GPIB::
+
+  $ make -C bench
+  $ python bench/suite.py --output results.json
+  $ python bench/suite.py --baseline results.json
+
+With --baseline, each result is also given as a ratio to the baseline's,
+where above 1 is better.
+"""
+import argparse
+import ctypes as ct
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+build = os.path.join(here, "build")
+library = os.path.join(build, "libsicl.so")
+
+paths = ("python", "ctypes", "native")
+
+read_sizes = (64, 1024, 16384, 262144, 1048576)
+"""Payload sizes in bytes for the read throughput measurements"""
+
+def per_call(func, seconds):
+  """
+  Mean seconds per call of func(), calling it for at least 'seconds'.
+  """
+  func()
+  calls = 0
+  start = time.perf_counter()
+  stop = start + seconds
+  while True:
+    for count in range(10):
+      func()
+    calls += 10
+    now = time.perf_counter()
+    if now >= stop:
+      return (now - start)/calls
+
+def latencies(func, seconds):
+  """
+  Seconds taken by each call of func() for 'seconds'.
+  """
+  result = []
+  stop = time.perf_counter() + seconds
+  while time.perf_counter() < stop:
+    start = time.perf_counter()
+    func()
+    result.append(time.perf_counter() - start)
+  return sorted(result)
+
+def _setup(path):
+  """
+  Make gpib_ct use the path's library.
+
+  @return: function(open_latency, io_latency, payload) configuring the fake
+  """
+  from Electronics.Interfaces.GPIB import gpib_ct
+  if path == "python":
+    sys.path.insert(0, here)
+    import fakesicl
+    fake = fakesicl.install(fakesicl.FakeSicl(0., 0., 0.))
+    def configure(open_latency, io_latency, payload):
+      fake.open_latency = open_latency
+      fake.close_latency = 0.
+      fake.io_latency = io_latency
+      fake.payload = payload
+    return configure
+  if path == "ctypes":
+    gpib_ct.use_backend(library)
+  elif path == "native":
+    from Electronics.Interfaces.GPIB.backends import NativeBackend
+    sys.path.insert(0, build)
+    import _pysicl
+    gpib_ct.use_backend(NativeBackend(_pysicl))
+  else:
+    raise ValueError("unknown path %r" % path)
+  # the same file, so the library already loaded by the backend
+  fake = ct.CDLL(library)
+  fake.fakesicl_configure.argtypes = [ct.c_long, ct.c_long, ct.c_ulong]
+  def configure(open_latency, io_latency, payload):
+    fake.fakesicl_configure(int(open_latency*1e6), int(io_latency*1e6),
+                            payload or 27)
+  return configure
+
+def measure(path, seconds, poll_latency, threads):
+  """
+  Run every measurement for one path in this process.
+  """
+  start = time.perf_counter()
+  from Electronics.Interfaces import GPIB
+  import_s = time.perf_counter() - start
+  from Electronics.Interfaces.GPIB import gpib_ct, devices
+  configure = _setup(path)
+  results = {"import_ms": 1e3*import_s}
+  device = "pm 13-1"
+  address = GPIB.registry.address(device)
+
+  configure(0., 0., None)
+  def open_close():
+    gpib_ct.gpib_close(gpib_ct.gpib_open(address))
+  results["open_close_us"] = 1e6*per_call(open_close, seconds)
+
+  times = latencies(lambda: GPIB.ask(device, "?ID"), seconds)
+  results["ask_us"] = {"mean": 1e6*sum(times)/len(times),
+                       "p50": 1e6*times[len(times)//2],
+                       "p99": 1e6*times[min(len(times) - 1,
+                                            int(0.99*len(times)))]}
+
+  instr = gpib_ct.gpib_open(address)
+  try:
+    results["rcv_us"] = 1e6*per_call(lambda: gpib_ct.gpib_rcv(instr),
+                                     seconds)
+    results["read"] = {}
+    results["read_into"] = {}
+    for size in read_sizes:
+      configure(0., 0., size)
+      buffer = bytearray(size)
+      for name, func in (
+          ("read", lambda: gpib_ct.gpib_read(instr, size)),
+          ("read_into", lambda: gpib_ct.gpib_read_into(instr, buffer))):
+        elapsed = per_call(func, seconds/len(read_sizes))
+        results[name][str(size)] = {"calls_per_s": 1/elapsed,
+                                    "mb_per_s": size/elapsed/1e6}
+  finally:
+    gpib_ct.gpib_close(instr)
+
+  configure(0., 0., None)
+  controller = devices.controller.rstrip(",")
+  start = time.perf_counter()
+  found = GPIB.find_devices(controller)
+  results["find_devices_ms"] = 1e3*(time.perf_counter() - start)
+  results["find_devices_found"] = len(found)
+
+  configure(0., poll_latency, None)
+  names = []
+  for name in sorted(device.name for device in GPIB.registry):
+    if GPIB.registry.address(name) not in map(GPIB.registry.address, names):
+      names.append(name)
+  names = names[:threads]
+  counts = dict((name, 0) for name in names)
+  stop = time.perf_counter() + seconds
+  def poll(name):
+    while time.perf_counter() < stop:
+      GPIB.ask(name, "?ID")
+      counts[name] += 1
+  workers = [threading.Thread(target=poll, args=(name,)) for name in names]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  elapsed = time.perf_counter() - start
+  results["polling"] = {"threads": len(names),
+                        "io_latency_ms": 1e3*poll_latency,
+                        "calls_per_s": sum(counts.values())/elapsed,
+                        "ideal_calls_per_s": len(names)/(2*poll_latency)}
+  return results
+
+def available(path):
+  """
+  None if the path can be measured, or the reason why not.
+  """
+  if path in ("ctypes", "native") and not os.path.exists(library):
+    return "%s not built; run 'make -C bench'" % library
+  if path == "native" and not any(name.startswith("_pysicl")
+                                  for name in os.listdir(build)):
+    return "C extension not built; run 'make -C bench'"
+  return None
+
+def run(path, args):
+  """
+  Measure one path in a fresh interpreter.
+  """
+  reason = available(path)
+  if reason:
+    return {"skipped": reason}
+  output = subprocess.check_output(
+    [sys.executable, os.path.abspath(__file__), "--child", path,
+     "--seconds", str(args.seconds), "--poll-latency", str(args.poll_latency),
+     "--threads", str(args.threads)])
+  return json.loads(output.decode())
+
+def revision():
+  try:
+    return subprocess.check_output(
+      ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(here),
+      stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    return None
+
+def compare(current, baseline, smaller_is_better=False):
+  """
+  Ratios of the current results to the baseline's; above 1 is better.
+  """
+  if isinstance(current, dict) and isinstance(baseline, dict):
+    ratios = {}
+    for key, value in current.items():
+      if key in baseline:
+        ratio = compare(value, baseline[key],
+                        smaller_is_better or key.endswith(("_ms", "_us")))
+        if ratio is not None and ratio != {}:
+          ratios[key] = ratio
+    return ratios
+  if (isinstance(current, (int, float)) and
+      isinstance(baseline, (int, float)) and current and baseline):
+    return baseline/current if smaller_is_better else current/baseline
+  return None
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("--paths", default=",".join(paths),
+                      help="comma separated, from %s" % ", ".join(paths))
+  parser.add_argument("--seconds", type=float, default=1.,
+                      help="time spent on each measurement")
+  parser.add_argument("--poll-latency", type=float, default=0.001,
+                      help="I/O latency in seconds when polling")
+  parser.add_argument("--threads", type=int, default=8,
+                      help="devices polled at once")
+  parser.add_argument("--import-runs", type=int, default=10)
+  parser.add_argument("--output", help="file for the JSON results")
+  parser.add_argument("--baseline", help="JSON results to compare with")
+  parser.add_argument("--child", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    print(json.dumps(measure(args.child, args.seconds, args.poll_latency,
+                             args.threads)))
+    return
+
+  sys.path.insert(0, here)
+  import bench_import
+  times = sorted(bench_import.import_times(args.import_runs))
+  report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "revision": revision(),
+                     "python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "seconds": args.seconds},
+            "cold_import_ms": {"min": 1e3*times[0],
+                               "median": 1e3*times[len(times)//2]},
+            "paths": dict((path, run(path, args))
+                          for path in args.paths.split(","))}
+  if args.baseline:
+    with open(args.baseline) as baseline:
+      previous = json.load(baseline)
+    report["ratio_to_baseline"] = {
+      "cold_import_ms": compare(report["cold_import_ms"],
+                                previous.get("cold_import_ms", {}), True),
+      "paths": compare(report["paths"], previous.get("paths", {}))}
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as output:
+      output.write(text + "\n")
+  print(text)
+
+if __name__ == "__main__":
+  main()
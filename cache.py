@@ -0,0 +1,271 @@
+"""
+Cache of responses to queries which do not change often
+
+Identification and configuration queries such as '*IDN?' or 'CF?' return the
+same answer until something is written to the device.  A QueryCache holds
+their responses for a time set per command by rules::
+
+  >>> cache = QueryCache()
+  >>> cache.rule(r"RF\\?", None)     # until the device is written to
+  >>> cache.rule(r"CF\\?", 5.)        # five seconds
+  >>> GPIB.enable_cache(cache)
+
+A rule is a regular expression which must match the whole command, with a
+time to live in seconds; None means no expiry and 0 means never cache.  The
+first matching rule applies; commands matching no rule get 'default_ttl',
+which is 0, so measurements are not cached unless a rule says so.  Writing to
+a device, or sending it anything which is not a query, forgets its entries,
+except for the commands declared neutral for the device's type, such as a
+power meter's trigger::
+
+  >>> cache.neutral("437B", r"TR[0-3]")
+
+A response is only cached if nothing invalidated the device's entries while
+its query was in progress.  The least recently used entries are dropped when
+the responses held exceed 'max_bytes'.
+"""
+import collections
+import logging
+import re
+import threading
+import time
+
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+default_rules = [(r"\*IDN\?", None),
+                 (r"\?ID", None),
+                 (r"\*OPT\?", None)]
+"""Rules a new QueryCache starts with"""
+
+default_neutral = {"437B":   [r"TR[0-3]"],
+                   "438":    [r"TR[0-3]"],
+                   "E4418B": [r"INIT(:IMM)?", r"\*TRG"]}
+"""For each device type, commands which leave its cached responses valid"""
+
+entry_overhead = 100
+"""Bytes charged to each entry in addition to its command and response"""
+
+class QueryCache(object):
+  """
+  Time-limited, size-bounded cache of query responses
+
+  Public attributes::
+    rules       - list of (compiled pattern, ttl)
+    neutrals    - {device type: list of compiled patterns}
+    default_ttl - time to live for commands matching no rule
+    max_bytes   - bound on the size of the entries held
+    size        - current size of the entries held
+    stats       - dict of hits, misses, expired, evictions, invalidations,
+                  stale (responses not cached because of an invalidation)
+  """
+  def __init__(self, rules=default_rules, default_ttl=0, max_bytes=1 << 20,
+               neutral=default_neutral):
+    """
+    @param rules : (regular expression, time to live) pairs
+    @type  rules : list
+
+    @param neutral : {device type: regular expressions} of commands which do
+                     not invalidate
+    @type  neutral : dict
+
+    @param default_ttl : time to live for commands matching no rule
+    @type  default_ttl : float
+
+    @param max_bytes : bound on the size of the entries held
+    @type  max_bytes : int
+    """
+    self.rules = []
+    for pattern, ttl in rules:
+      self.rule(pattern, ttl)
+    self.neutrals = {}
+    for kind, patterns in neutral.items():
+      for pattern in patterns:
+        self.neutral(kind, pattern)
+    self.default_ttl = default_ttl
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._entries = collections.OrderedDict()
+    self._generations = {}
+    self._epoch = 0
+    self._kinds = {}
+    self._lock = threading.Lock()
+    self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+                  "invalidations": 0, "stale": 0}
+
+  def rule(self, pattern, ttl):
+    """
+    Add a rule, ahead of the existing ones.
+
+    @param pattern : regular expression matching whole commands
+    @type  pattern : str
+
+    @param ttl : seconds to keep a response; None for ever; 0 never
+    @type  ttl : float
+    """
+    self.rules.insert(0, (re.compile(pattern + r"\Z"), ttl))
+
+  def neutral(self, kind, pattern):
+    """
+    Declare commands which do not change a device type's cached responses.
+
+    @param kind : device type as in the registry, e.g. '437B'
+    @type  kind : str
+
+    @param pattern : regular expression matching whole commands
+    @type  pattern : str
+    """
+    self.neutrals.setdefault(kind, []).append(re.compile(pattern + r"\Z"))
+
+  def is_neutral(self, address, command):
+    """
+    Whether a command leaves the device's cached responses valid.
+
+    Commands joined by ';' are neutral if each of them is.
+    """
+    if address not in self._kinds:
+      devices = registry.at_address(address)
+      self._kinds[address] = devices[0].type if devices else None
+    patterns = self.neutrals.get(self._kinds[address], ())
+    return all(any(pattern.match(part.strip()) for pattern in patterns)
+               for part in command.split(";"))
+
+  def ttl(self, command):
+    """
+    Time to live for the response to a command.
+    """
+    command = command.strip()
+    for pattern, ttl in self.rules:
+      if pattern.match(command):
+        return ttl
+    return self.default_ttl
+
+  def get(self, address, command):
+    """
+    The cached response to a command.
+
+    @return: (True, response) or (False, None)
+    """
+    key = (address, command.strip())
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.stats["misses"] += 1
+        return False, None
+      response, expires, size = entry
+      if expires is not None and time.time() > expires:
+        self._remove(key)
+        self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return False, None
+      self._entries.move_to_end(key)
+      self.stats["hits"] += 1
+      return True, response
+
+  def generation(self, address):
+    """
+    Token which changes whenever the device's entries are invalidated.
+
+    Take it before sending a query and give it to put() with the response.
+    """
+    with self._lock:
+      return (self._epoch, self._generations.get(address, 0))
+
+  def put(self, address, command, response, generation=None):
+    """
+    Cache a response, if the rules allow.
+
+    @param generation : the device's generation() when the query was sent;
+                        the response is dropped if it has changed since
+    @type  generation : tuple
+    """
+    command = command.strip()
+    ttl = self.ttl(command)
+    if ttl == 0:
+      return
+    expires = None if ttl is None else time.time() + ttl
+    size = len(command) + len(response) + entry_overhead
+    key = (address, command)
+    with self._lock:
+      if generation is not None and generation != (
+          self._epoch, self._generations.get(address, 0)):
+        self.stats["stale"] += 1
+        return
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (response, expires, size)
+      self.size += size
+      while self.size > self.max_bytes and self._entries:
+        self._remove(next(iter(self._entries)))
+        self.stats["evictions"] += 1
+
+  def _remove(self, key):
+    response, expires, size = self._entries.pop(key)
+    self.size -= size
+
+  def invalidate(self, address):
+    """
+    Forget the cached responses of a device.
+    """
+    with self._lock:
+      keys = [key for key in self._entries if key[0] == address]
+      for key in keys:
+        self._remove(key)
+      self._generations[address] = self._generations.get(address, 0) + 1
+      self.stats["invalidations"] += 1
+
+  def written(self, address, command):
+    """
+    Note that a command was sent to a device, invalidating unless neutral.
+    """
+    if not self.is_neutral(address, command):
+      self.invalidate(address)
+
+  def clear(self):
+    """
+    Forget everything.
+    """
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+      self._epoch += 1
+
+  def ask(self, address, command, prompt):
+    """
+    Answer a query from the cache, or with prompt(command) and cache it.
+
+    A command which is not a query invalidates the device's entries once it
+    has been sent, unless it is neutral.  Of commands joined by ';', such as
+    'FREQ 1GHZ;FREQ?', only those which are all queries are cached; any
+    others among them invalidate as if sent alone.
+
+    @param address : SICL address of the device
+    @type  address : str
+
+    @param command : query
+    @type  command : str
+
+    @param prompt : function sending the query and returning the response
+    @type  prompt : callable
+
+    @return: response
+    """
+    setters = [part for part in command.split(";") if "?" not in part]
+    if setters:
+      try:
+        return prompt(command)
+      finally:
+        self.written(address, ";".join(setters))
+    if self.ttl(command) == 0:
+      return prompt(command)
+    hit, response = self.get(address, command)
+    if hit:
+      return response
+    generation = self.generation(address)
+    response = prompt(command)
+    self.put(address, command, response, generation)
+    return response
+
+  def __len__(self):
+    return len(self._entries)
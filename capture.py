@@ -0,0 +1,629 @@
+"""
+Capture of GPIB traffic to a file, and replay from it
+
+A Recorder puts a RecordingBackend in front of the backend in use, which
+appends every send, rcv, prompt, read, serial poll (dev_status), buffered
+write (fwrite) and flush, raw write, trigger and bus command (sendcmd), with
+its device, time, latency and data, to a compact binary file::
+
+  >>> from Electronics.Interfaces.GPIB import capture
+  >>> with capture.Recorder("/tmp/pm.gpibcap"):
+  ...   run_the_polling_service()
+
+Since it works below gpib_ct, all the device I/O of this package is
+recorded, including gpib_send_many, gpib_prompt_many and gpib_read; opening,
+closing, timeouts, locks and SRQ handlers are not.  The file can then answer
+the same calls without hardware, at the recorded speed or as fast as
+possible::
+
+  >>> gpib_ct.use_backend(capture.ReplayBackend("/tmp/pm.gpibcap", speed=1))
+  >>> GPIB.ask("pm 13-1", "?ID")
+  'HP438A'
+
+and the recorded sequence of calls can be sent again, with the recorded
+spacing or without any, to measure or check another backend::
+
+  >>> capture.replay("/tmp/pm.gpibcap", speed=None)
+  {'calls': 5000, 'mismatches': 0, 'errors': 0, 'elapsed': 0.21, ...}
+
+The file starts with the 8 byte signature 'GPIBCAP1'.  Each record is a
+24 byte little-endian header (time as a double, latency in seconds as a
+float, device number as an unsigned short, operation and flags as bytes, and
+the request and response lengths as unsigned ints), followed by the request
+and the response.  A device is named once, by a record with operation
+DEVICE whose request is its address; later records give only its number.
+Records are only ever appended, so a file can be read while it is written.
+"""
+import logging
+import mmap
+import struct
+import threading
+import time
+
+from Electronics.Interfaces.GPIB.backends import Backend, I_BUF_WRITE
+
+module_logger = logging.getLogger(__name__)
+
+signature = b"GPIBCAP1"
+
+_header = struct.Struct("<dfHBBII")
+"""time, latency, device number, operation, flags, request/response length"""
+
+(DEVICE, SEND, RCV, PROMPT, READ, DEV_STATUS, FWRITE, FLUSH, WRITE_RAW,
+ TRIGGER, SENDCMD) = range(11)
+"""Operation codes"""
+
+operation_names = {DEVICE: "device", SEND: "send", RCV: "rcv",
+                   PROMPT: "prompt", READ: "read", DEV_STATUS: "dev_status",
+                   FWRITE: "fwrite", FLUSH: "flush", WRITE_RAW: "write_raw",
+                   TRIGGER: "trigger", SENDCMD: "sendcmd"}
+
+commands = (SEND, FWRITE, FLUSH, WRITE_RAW, TRIGGER, SENDCMD)
+"""Operations which get no response from the device"""
+
+FAILED = 1
+"""Flag of a call which raised an exception; the response is its message"""
+
+class CaptureWriter(object):
+  """
+  Appends records to a capture file
+
+  Public attributes::
+    path    - file name
+    records - number of records written
+  """
+  def __init__(self, path):
+    self.path = path
+    self.records = 0
+    self._file = open(path, "ab")
+    if self._file.tell() == 0:
+      self._file.write(signature)
+    self._devices = {}
+    self._lock = threading.Lock()
+
+  def _device(self, address):
+    """
+    Number of a device, writing its DEVICE record if it is new.
+
+    Must be called with the writer lock held.
+    """
+    number = self._devices.get(address)
+    if number is None:
+      number = self._devices[address] = len(self._devices)
+      name = address.encode("latin-1")
+      self._file.write(_header.pack(time.time(), 0., number, DEVICE, 0,
+                                    len(name), 0))
+      self._file.write(name)
+    return number
+
+  def write(self, start, latency, address, operation, request, response,
+            flags=0):
+    """
+    Append one call.
+
+    @param start : time the call started
+    @type  start : float
+
+    @param latency : seconds the call took
+    @type  latency : float
+
+    @param address : SICL address of the device
+    @type  address : str
+
+    @param operation : an operation code other than DEVICE
+    @type  operation : int
+
+    @param request : bytes sent
+    @type  request : bytes-like
+
+    @param response : bytes received, or the error message
+    @type  response : bytes-like
+
+    @param flags : FAILED, and shifted left by one bit the termination
+                   reason of a READ, the END flag of an FWRITE or WRITE_RAW
+                   or the buffer mask of a FLUSH
+    @type  flags : int
+    """
+    with self._lock:
+      number = self._device(address)
+      self._file.write(_header.pack(start, latency, number, operation, flags,
+                                    len(request), len(response)))
+      self._file.write(request)
+      self._file.write(response)
+      self.records += 1
+
+  def flush(self):
+    with self._lock:
+      self._file.flush()
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+class Record(object):
+  """
+  One call read from a capture file
+
+  Public attributes::
+    time      - time the call started
+    latency   - seconds it took
+    address   - SICL address of the device
+    operation - operation code
+    failed    - True if the call raised an exception
+    reason    - termination reason of a read, END flag of a write or mask of
+                a flush
+    request   - memoryview of the bytes sent
+    response  - memoryview of the bytes received, or of the error message
+  """
+  __slots__ = ("time", "latency", "address", "operation", "failed", "reason",
+               "request", "response")
+
+  def __init__(self, time, latency, address, operation, flags, request,
+               response):
+    self.time = time
+    self.latency = latency
+    self.address = address
+    self.operation = operation
+    self.failed = bool(flags & FAILED)
+    self.reason = flags >> 1
+    self.request = request
+    self.response = response
+
+  def __repr__(self):
+    return "Record(%r, %s, %r)" % (self.address,
+                                   operation_names[self.operation],
+                                   bytes(self.request))
+
+class CaptureFile(object):
+  """
+  A capture file, memory mapped for reading
+
+  The records' data are views of the mapping, not copies.
+
+  Public attributes::
+    path    - file name
+    records - list of Record, in the order written
+  """
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as capture:
+      self._map = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(self._map)
+    if bytes(view[:len(signature)]) != signature:
+      raise ValueError("%s is not a GPIB capture file" % path)
+    self.records = []
+    devices = {}
+    offset = len(signature)
+    end = len(view)
+    while offset + _header.size <= end:
+      start, latency, number, operation, flags, nrequest, nresponse = \
+        _header.unpack_from(view, offset)
+      offset += _header.size
+      if offset + nrequest + nresponse > end:
+        # a record still being written
+        break
+      request = view[offset:offset + nrequest]
+      offset += nrequest
+      response = view[offset:offset + nresponse]
+      offset += nresponse
+      if operation == DEVICE:
+        devices[number] = bytes(request).decode("latin-1")
+        continue
+      self.records.append(Record(start, latency, devices[number], operation,
+                                 flags, request, response))
+
+  def __len__(self):
+    return len(self.records)
+
+  def __iter__(self):
+    return iter(self.records)
+
+  def duration(self):
+    """
+    Seconds from the first call to the end of the last.
+    """
+    if not self.records:
+      return 0.
+    last = self.records[-1]
+    return last.time + last.latency - self.records[0].time
+
+class RecordingBackend(Backend):
+  """
+  Backend which records the calls it passes to another backend
+
+  Public attributes::
+    backend - the backend doing the work
+    writer  - CaptureWriter the calls are recorded with
+  """
+  def __init__(self, backend, writer):
+    self.backend = backend
+    self.writer = writer
+    self._addresses = {}
+
+  def _address(self, instr):
+    """
+    Address of a session, which may have been opened before recording began.
+    """
+    address = self._addresses.get(instr)
+    if address is None:
+      from Electronics.Interfaces.GPIB import gpib_ct
+      address = gpib_ct.session_address(instr)
+      if address is None:
+        return "session %s" % instr
+      self._addresses[instr] = address
+    return address
+
+  def _record(self, operation, instr, request, call, response_of, flags=0):
+    start = time.time()
+    began = time.perf_counter()
+    try:
+      result = call()
+    except Exception as details:
+      self.writer.write(start, time.perf_counter() - began,
+                        self._address(instr), operation, request,
+                        ("%s" % details).encode("latin-1", "replace"),
+                        FAILED | flags << 1)
+      raise
+    response, reason = response_of(result)
+    self.writer.write(start, time.perf_counter() - began,
+                      self._address(instr), operation, request, response,
+                      (flags | reason) << 1)
+    return result
+
+  def open(self, address):
+    instr = self.backend.open(address)
+    if isinstance(address, bytes):
+      address = address.decode("latin-1")
+    self._addresses[instr] = address
+    return instr
+
+  def close(self, instr):
+    self._addresses.pop(instr, None)
+    return self.backend.close(instr)
+
+  def write(self, instr, data):
+    return self._record(SEND, instr, data,
+                        lambda: self.backend.write(instr, data),
+                        lambda result: (b"", 0))
+
+  def scan(self, instr, format=b"%t"):
+    return self._record(RCV, instr, b"",
+                        lambda: self.backend.scan(instr, format),
+                        lambda result: (result, 0))
+
+  def read(self, instr, buffer):
+    return self._record(READ, instr, b"",
+                        lambda: self.backend.read(instr, buffer),
+                        lambda result: (buffer[:result[0]], result[1]))
+
+  def prompt(self, instr, data):
+    return self._record(PROMPT, instr, data,
+                        lambda: self.backend.prompt(instr, data),
+                        lambda result: (result, 0))
+
+  def readstb(self, instr):
+    return self._record(DEV_STATUS, instr, b"",
+                        lambda: self.backend.readstb(instr),
+                        lambda result: (bytes([result & 0xff]), 0))
+
+  def timeout(self, instr, milliseconds):
+    return self.backend.timeout(instr, milliseconds)
+
+  def lock(self, instr):
+    return self.backend.lock(instr)
+
+  def unlock(self, instr):
+    return self.backend.unlock(instr)
+
+  def clear(self, instr):
+    return self.backend.clear(instr)
+
+  def trigger(self, instr):
+    return self._record(TRIGGER, instr, b"",
+                        lambda: self.backend.trigger(instr),
+                        lambda result: (b"", 0))
+
+  def sendcmd(self, instr, data):
+    return self._record(SENDCMD, instr, data,
+                        lambda: self.backend.sendcmd(instr, data),
+                        lambda result: (b"", 0))
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    return self.backend.setbuf(instr, size, mask)
+
+  def fwrite(self, instr, data, end=False):
+    return self._record(FWRITE, instr, data,
+                        lambda: self.backend.fwrite(instr, data, end),
+                        lambda result: (b"", 0), int(bool(end)))
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    return self._record(FLUSH, instr, b"",
+                        lambda: self.backend.flush(instr, mask),
+                        lambda result: (b"", 0), mask)
+
+  def write_raw(self, instr, data, end=True):
+    return self._record(WRITE_RAW, instr, data,
+                        lambda: self.backend.write_raw(instr, data, end),
+                        lambda result: (b"", 0), int(bool(end)))
+
+  def onsrq(self, instr, handler):
+    return self.backend.onsrq(instr, handler)
+
+  def waithdlr(self, milliseconds):
+    return self.backend.waithdlr(milliseconds)
+
+  def introff(self):
+    return self.backend.introff()
+
+  def intron(self):
+    return self.backend.intron()
+
+class Recorder(object):
+  """
+  Records the traffic of the backend in use while started
+
+  Public attributes::
+    path   - capture file name
+    writer - CaptureWriter while started, else None
+  """
+  def __init__(self, path):
+    self.path = path
+    self.writer = None
+    self._previous = None
+
+  def start(self):
+    """
+    Put a RecordingBackend in front of the backend in use.
+
+    Sessions opened before this through gpib_ct are recorded with their
+    addresses too.
+    """
+    from Electronics.Interfaces.GPIB import gpib_ct
+    if self.writer is not None:
+      return self
+    self.writer = CaptureWriter(self.path)
+    self._previous = gpib_ct.backend()
+    gpib_ct.use_backend(RecordingBackend(self._previous, self.writer))
+    return self
+
+  def stop(self):
+    """
+    Put the original backend back and close the file.
+    """
+    from Electronics.Interfaces.GPIB import gpib_ct
+    if self.writer is None:
+      return
+    gpib_ct.use_backend(self._previous)
+    self.writer.close()
+    module_logger.info("Recorder: %d calls recorded in %s",
+                       self.writer.records, self.path)
+    self.writer = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+class ReplayBackend(Backend):
+  """
+  Backend which answers calls from a capture file
+
+  The responses recorded for each device, operation and request are given in
+  turn, starting again from the first when they run out.  A recorded failure
+  is raised again as a RuntimeError.  Commands, writes, triggers and flushes
+  which were not recorded are accepted; queries which were not recorded
+  raise a RuntimeError.
+
+  Public attributes::
+    capture - CaptureFile the answers come from
+    speed   - None to answer at once, or a factor by which the recorded
+              latencies are shortened, e.g. 1 for the recorded speed
+    stats   - dict of counters: calls, unmatched
+  """
+  def __init__(self, capture, speed=None):
+    """
+    @param capture : capture file or its name
+    @type  capture : CaptureFile or str
+
+    @param speed : None, or the speed relative to the recording
+    @type  speed : float
+    """
+    if not isinstance(capture, CaptureFile):
+      capture = CaptureFile(capture)
+    self.capture = capture
+    self.speed = speed
+    self.stats = {"calls": 0, "unmatched": 0}
+    self._answers = {}
+    for record in capture:
+      key = (record.address, record.operation, bytes(record.request))
+      self._answers.setdefault(key, []).append(record)
+    self._next = dict((key, 0) for key in self._answers)
+    self._sessions = {}
+    self._ids = 0
+    self._lock = threading.Lock()
+
+  def _answer(self, instr, operation, request=b""):
+    """
+    The next record answering a call, after the recorded latency.
+    """
+    with self._lock:
+      try:
+        address = self._sessions[instr]
+      except KeyError:
+        raise RuntimeError("invalid session %r" % instr)
+      self.stats["calls"] += 1
+      key = (address, operation, bytes(request))
+      answers = self._answers.get(key)
+      if answers is None:
+        self.stats["unmatched"] += 1
+        if operation in commands:
+          return None
+        raise RuntimeError("%s %s %r was not recorded"
+                           % (address, operation_names[operation],
+                              bytes(request)))
+      index = self._next[key]
+      self._next[key] = (index + 1) % len(answers)
+      record = answers[index]
+    if self.speed:
+      time.sleep(record.latency/self.speed)
+    if record.failed:
+      raise RuntimeError(bytes(record.response).decode("latin-1"))
+    return record
+
+  def open(self, address):
+    if isinstance(address, bytes):
+      address = address.decode("latin-1")
+    with self._lock:
+      self._ids += 1
+      self._sessions[self._ids] = address
+      return self._ids
+
+  def close(self, instr):
+    with self._lock:
+      self._sessions.pop(instr, None)
+    return 0
+
+  def timeout(self, instr, milliseconds):
+    return 0
+
+  def write(self, instr, data):
+    self._answer(instr, SEND, data)
+    return 0
+
+  def scan(self, instr, format=b"%t"):
+    return bytes(self._answer(instr, RCV).response)
+
+  def read(self, instr, buffer):
+    record = self._answer(instr, READ)
+    count = min(len(record.response), buffer.nbytes)
+    buffer[:count] = record.response[:count]
+    return count, record.reason
+
+  def prompt(self, instr, data):
+    return bytes(self._answer(instr, PROMPT, data).response)
+
+  def readstb(self, instr):
+    return self._answer(instr, DEV_STATUS).response[0]
+
+  def lock(self, instr):
+    return 0
+
+  def unlock(self, instr):
+    return 0
+
+  def clear(self, instr):
+    return 0
+
+  def trigger(self, instr):
+    self._answer(instr, TRIGGER)
+    return 0
+
+  def sendcmd(self, instr, data):
+    self._answer(instr, SENDCMD, data)
+    return 0
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    return 0
+
+  def fwrite(self, instr, data, end=False):
+    self._answer(instr, FWRITE, data)
+    return len(data)
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    self._answer(instr, FLUSH)
+    return 0
+
+  def write_raw(self, instr, data, end=True):
+    self._answer(instr, WRITE_RAW, data)
+    return len(data)
+
+def replay(capture, speed=None, driver=None):
+  """
+  Make the recorded calls again, in order, through gpib_ct.
+
+  The responses are compared with those recorded, so that a capture from the
+  field can be used as a regression test, and the rate achieved measures the
+  backend in use, e.g. a ReplayBackend for this package's own overhead.
+
+  @param capture : capture file or its name
+  @type  capture : CaptureFile or str
+
+  @param speed : None to make the calls as fast as possible, or the speed
+                 relative to the recording, e.g. 1 to keep the recorded
+                 spacing of the calls
+  @type  speed : float
+
+  @param driver : module providing the gpib_* functions and backend(), which
+                 makes buffered writes and flushes; default gpib_ct
+  @type  driver : module
+
+  @return: dict with 'calls', 'mismatches' (answered differently, or
+           answered where the recorded call failed), 'errors' (failed where
+           the recorded call did not), 'elapsed' (seconds), 'rate' (calls/s)
+           and 'recorded' (seconds the recording took)
+  """
+  if driver is None:
+    from Electronics.Interfaces.GPIB import gpib_ct as driver
+  if not isinstance(capture, CaptureFile):
+    capture = CaptureFile(capture)
+  sessions = {}
+  stats = {"calls": 0, "mismatches": 0, "errors": 0}
+  first = capture.records[0].time if capture.records else 0.
+  start = time.time()
+  try:
+    for record in capture:
+      if speed:
+        delay = (record.time - first)/speed - (time.time() - start)
+        if delay > 0:
+          time.sleep(delay)
+      try:
+        instr = sessions.get(record.address)
+        if instr is None:
+          instr = sessions[record.address] = driver.gpib_open(record.address)
+        request = bytes(record.request).decode("latin-1")
+        response = b""
+        if record.operation == SEND:
+          driver.gpib_send(instr, request)
+        elif record.operation == FWRITE:
+          driver.backend().fwrite(instr, bytes(record.request),
+                                  bool(record.reason))
+        elif record.operation == FLUSH:
+          driver.backend().flush(instr, record.reason)
+        elif record.operation == WRITE_RAW:
+          driver.gpib_write_raw(instr, bytes(record.request),
+                                bool(record.reason))
+        elif record.operation == TRIGGER:
+          driver.gpib_trigger(instr)
+        elif record.operation == SENDCMD:
+          driver.gpib_sendcmd(instr, bytes(record.request))
+        elif record.operation == RCV:
+          response = driver.gpib_rcv(instr).encode("latin-1")
+        elif record.operation == PROMPT:
+          response = driver.gpib_prompt(instr, request).encode("latin-1")
+        elif record.operation == READ:
+          response = driver.gpib_read(instr, max(1, len(record.response)))[0]
+        else:
+          response = bytes([driver.gpib_dev_status(instr) & 0xff])
+      except Exception as details:
+        stats["calls"] += 1
+        if not record.failed:
+          stats["errors"] += 1
+          module_logger.debug("replay: %r failed; %s", record, details)
+        continue
+      stats["calls"] += 1
+      if record.failed or (record.operation not in commands and
+                           response.strip() != bytes(record.response).strip()):
+        stats["mismatches"] += 1
+        module_logger.debug("replay: %r answered %r", record, response)
+  finally:
+    for instr in sessions.values():
+      try:
+        driver.gpib_close(instr)
+      except Exception:
+        pass
+  elapsed = time.time() - start
+  stats.update(elapsed=elapsed,
+               rate=stats["calls"]/elapsed if elapsed > 0 else float("inf"),
+               recorded=capture.duration())
+  return stats
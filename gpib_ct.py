@@ -64,66 +64,97 @@ functions have the same parameters as iread and iwrite, but read or
 write raw output data to the formatted I/O buffers. 
 """
 
-import ctypes as ct
-from Electronics.Interfaces.GPIB.devices import *
+import os
+import threading
+from Electronics.Interfaces.GPIB.backends import Backend, SiclBackend, \
+     load_backend, I_TERM_MAXCNT, I_TERM_END, I_TERM_CHR, I_BUF_WRITE
+from Electronics.Interfaces.GPIB.registry import registry
 
 import logging
 module_logger = logging.getLogger(__name__)
 
-sicllib = ct.CDLL("/usr/lib/libsicl.so")
+_saved_level = logging.NOTSET
 
-_open = sicllib.iopen
-_open.argtypes = [ct.c_char_p]
-_open.restype = ct.c_int
-
-_timeout = sicllib.itimeout
-_timeout.argtypes = [ct.c_int, ct.c_int]
-_timeout.restype = ct.c_void_p
+"""
+The operations are carried out by a backend (see backends.py), which is not
+created until the first call which needs it, so that the package can be
+imported on machines without SICL.  It is chosen by the environment variable
+GPIB_BACKEND or by use_backend().
+"""
+_backend_spec = os.environ.get("GPIB_BACKEND", "sicl")
+_backend = None
+_backend_lock = threading.Lock()
 
-_print = sicllib.iprintf
-_print.argtypes = [ct.c_int, ct.c_char_p]
-_print.restype = ct.c_void_p
+def backend():
+  """
+  The backend in use, created on first use.
+  """
+  global _backend
+  if _backend is None:
+    with _backend_lock:
+      if _backend is None:
+        module_logger.debug("backend: loading %s", _backend_spec)
+        _backend = load_backend(_backend_spec)
+  return _backend
+
+def use_backend(new):
+  """
+  Select the backend to use from now on.
 
-_scan = sicllib.iscanf
-_scan.argtypes = [ct.c_int, ct.c_char_p, ct.c_char_p]
-_scan.restype = ct.c_int
+  Sessions opened with the previous backend are not closed.
 
-_prompt = sicllib.ipromptf
-_prompt.argtypes = [ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_char_p]
-_prompt.restype = ct.c_void_p
+  @param new : a GPIB_BACKEND specification, a Backend, or an object having
+               the SICL entry points as attributes
+  @type  new : str or object
 
-_close = sicllib.iclose
-_close.argtypes = [ct.c_int]
-_close.restype = ct.c_void_p
+  @return: the previous backend, or None if none had been created
+  """
+  global _backend, _backend_spec
+  with _backend_lock:
+    previous = _backend
+    if isinstance(new, str):
+      _backend_spec = new
+      _backend = None
+    else:
+      _backend_spec = repr(new)
+      if not isinstance(new, Backend):
+        new = SiclBackend(library=new)
+      _backend = new
+  return previous
+
+def _encode(text):
+  """
+  Convert a command to the bytes that the C library expects.
+  """
+  if isinstance(text, bytes):
+    return text
+  return text.encode('latin-1')
 
-_lock = sicllib.ilock
-_lock.argtypes = [ct.c_int]
-_lock.restype = ct.c_void_p
+def _decode(data):
+  """
+  Convert bytes received from an instrument to str.
+  """
+  return data.decode('latin-1')
 
-_unlock = sicllib.iunlock
-_unlock.argtypes = [ct.c_int]
-_unlock.restype = ct.c_void_p
+def device_address(name):
+  """
+  SICL address of a device.
 
-_get_dev_status = sicllib.ireadstb
-_get_dev_status.argtypes = [ct.c_int, ct.c_char_p]
-_get_dev_status.restype = ct.c_int
+  @param name : LAN/GPIB address, or device name like "pm 13-1" where the first
+                part is a table in devices and the second a key in that table
+  @type  name : str
 
-_clear = sicllib.iclear
-_clear.argtypes = [ct.c_int]
-_clear.restype = ct.c_int
+  @return: str
+  """
+  return registry.address(name)
 
-"""
-_get_errstr gets the textual explanation of an error code. Pass this function
-the error code you want and this function will return a human-readable string.
-"""
-_get_errstr = sicllib.igeterrstr
-_get_errstr.argtypes =[ct.c_int]
-_get_errstr.restype = ct.c_char_p
+_sessions = {}
 
-_read = sicllib.iread
-_read.argtypes = [ct.c_int, ct.c_char_p, ct.c_ulong,
-                  ct.POINTER(ct.c_int), ct.POINTER(ct.c_ulong)]
-_read.restype = ct.c_int
+def session_address(instrument_ID):
+  """
+  SICL address of the device an open session is for, or None.
+  """
+  return _sessions.get(instrument_ID)
 
 def gpib_open(name):
   """
@@ -134,14 +165,18 @@ def gpib_open(name):
   >>> gpib_open(lan[158.154.1.110]:19)
   4
 
-  @param name : LAN/GPIB address of the device
+  The name may also be a device name like "pm 13-1", where the first part is a
+  table in devices and the second a key in that table.
+
+  @param name : LAN/GPIB address or name of the device
   @type  name : str
 
   @return: int
   """
-  (devtype,devID) = name.split()
-  address = eval(devtype)[devID]['addr']
-  return _open(address)
+  address = device_address(name)
+  instr = backend().open(_encode(address))
+  _sessions[instr] = address
+  return instr
 
 def gpib_close(instrument_ID):
   """
@@ -152,7 +187,9 @@ def gpib_close(instrument_ID):
 
   @return: response str
   """
-  return _close(instrument_ID)
+  _sessions.pop(instrument_ID, None)
+  _write_buffers.pop(instrument_ID, None)
+  return backend().close(instrument_ID)
 
 def gpib_timeout(instrument, milliseconds):
   """
@@ -170,13 +207,10 @@ def gpib_timeout(instrument, milliseconds):
   @return: response str
   """
   try:
-    status = _timeout(instrument, milliseconds)
+    status = backend().timeout(instrument, milliseconds)
     return True
-  except Exception, details:
-    if status:
-      module_logger.error(_get_errstr(status))
-    raise RuntimeException, details
-  return status
+  except Exception as details:
+    raise RuntimeError(details)
   
 def gpib_diags(state):
   """
@@ -187,11 +221,12 @@ def gpib_diags(state):
 
   @return: response str
   """
+  global _saved_level
   if state:
-    self.loglevel = module_logger.getLoglevel()
-    module_logger.setLoglevel(logging.DEBUG)
+    _saved_level = module_logger.level
+    module_logger.setLevel(logging.DEBUG)
   else:
-    module_logger.setLoglevel(self.loglevel)
+    module_logger.setLevel(_saved_level)
   return True
 
 def gpib_send(instrument_ID, command):
@@ -211,7 +246,67 @@ def gpib_send(instrument_ID, command):
   
   @return: response str
   """
-  return _print(instrument_ID, command)
+  return backend().write(instrument_ID, _encode(command))
+
+max_write_buffer = 65536
+"""Largest formatted write buffer gpib_send_many asks for"""
+
+_write_buffers = {}
+
+def gpib_send_many(instrument_ID, commands, terminator="\n"):
+  """
+  Send several commands with a single flush of the write buffer.
+
+  The formatted write buffer is enlarged with isetbuf to hold all the
+  commands, up to max_write_buffer bytes; each is added with ifwrite, and
+  iflush sends them, asserting END with the last byte.  gpib_send would flush
+  after every command.
+
+  @param instrument_ID : GPIB identifier
+  @type  instrument_ID : int
+
+  @param commands : commands to send in order
+  @type  commands : list of str or bytes
+
+  @param terminator : appended to each command
+  @type  terminator : str
+
+  @return: number of bytes sent
+  """
+  terminator = _encode(terminator)
+  messages = [_encode(command) + terminator for command in commands]
+  if not messages:
+    return 0
+  total = sum(map(len, messages))
+  size = min(total, max_write_buffer)
+  if _write_buffers.get(instrument_ID, 0) < size:
+    backend().setbuf(instrument_ID, size, I_BUF_WRITE)
+    _write_buffers[instrument_ID] = size
+  last = len(messages) - 1
+  for index, message in enumerate(messages):
+    backend().fwrite(instrument_ID, message, index == last)
+  backend().flush(instrument_ID, I_BUF_WRITE)
+  return total
+
+def gpib_write_raw(instrument_ID, data, end=True):
+  """
+  Send a block of bytes unbuffered, with iwrite.
+
+  Implements iwrite(id, buf, datalen, endi, actualcnt).  Any object with the
+  buffer protocol may be sent; bytearrays and numpy arrays are not copied.
+
+  @param instrument_ID : GPIB identifier
+  @type  instrument_ID : int
+
+  @param data : bytes to send
+  @type  data : bytes-like
+
+  @param end : assert END with the last byte
+  @type  end : bool
+
+  @return: number of bytes sent
+  """
+  return backend().write_raw(instrument_ID, data, end)
 
 def gpib_rcv(instrument_ID, term_char=10, format="%t"):
   """
@@ -233,10 +328,8 @@ def gpib_rcv(instrument_ID, term_char=10, format="%t"):
   
   @return: response str
   """
-  response = ct.create_string_buffer('\000'*2048)
-  status = _scan(instrument_ID, format, response)
-  module_logger.debug("gpib_rcv: %d values converted",status)
-  return response.value.strip()
+  response = backend().scan(instrument_ID, _encode(format))
+  return _decode(response.strip())
 
 def gpib_read(instrument_ID, lendata):
   """
@@ -257,13 +350,42 @@ def gpib_read(instrument_ID, lendata):
      contains the actual number of bytes read from the device or interface.
      If actualcnt parameter is NULL, the number of bytes read will not be
      returned.
+
+  @return: (data bytes, reason, number of bytes read)
   """
-  data = ct.create_string_buffer('\000*16384')
-  reason_p = ct.pointer(ct.c_int())
-  num_recvd_p = ct.pointer(ct.c_ulong())
-  status = _read(instrument_ID, data, lendata, reason_p, num_recvd_p)
-  result = (data.value, reason_p.contents.value, num_recvd_p.contents.value)
-  return result
+  data = bytearray(lendata)
+  count, reason = gpib_read_into(instrument_ID, data)
+  return (bytes(data[:count]), reason, count)
+
+def gpib_read_into(instrument_ID, buffer, offset=0, nbytes=None):
+  """
+  Read raw data from the device directly into a writable buffer
+
+  The buffer may be any object supporting the writable, contiguous buffer
+  protocol, such as a bytearray, memoryview or numpy array.  No data are
+  copied.
+
+  @param instrument_ID : GPIB identifier
+  @type  instrument_ID : int
+
+  @param buffer : where to put the data
+  @type  buffer : writable buffer
+
+  @param offset : byte offset into buffer at which to start
+  @type  offset : int
+
+  @param nbytes : maximum number of bytes to read; default to end of buffer
+  @type  nbytes : int
+
+  @return: (number of bytes read, termination reason)
+  """
+  view = memoryview(buffer).cast("B")
+  if nbytes is None:
+    nbytes = view.nbytes - offset
+  if nbytes <= 0 or offset + nbytes > view.nbytes:
+    raise ValueError("cannot read %s bytes at offset %d into %d byte buffer"
+                     % (nbytes, offset, view.nbytes))
+  return backend().read(instrument_ID, view[offset:offset+nbytes])
 
 def gpib_prompt(ID, text):
   """
@@ -278,9 +400,22 @@ def gpib_prompt(ID, text):
 
   @return: str
   """
-  response = ct.create_string_buffer('\000'*2048)
-  status = _prompt(ID, text, "%t", response)
-  return response.value
+  return _decode(backend().prompt(ID, _encode(text)))
+
+def gpib_prompt_many(ID, texts):
+  """
+  Send each message in turn and receive its response.
+
+  @param ID : instrument identifier
+  @type  ID : int
+
+  @param texts : messages to device
+  @type  texts : list of str
+
+  @return: list of str
+  """
+  prompt = backend().prompt
+  return [_decode(prompt(ID, _encode(text))) for text in texts]
 
 def gpib_lock(instrument):
   """
@@ -301,7 +436,7 @@ def gpib_lock(instrument):
 
   @return: returns 0 if successful or non-zero error number if an error occurs.
   """
-  return _lock(instrument)
+  return backend().lock(instrument)
 
 def gpib_unlock(instrument):
   """
@@ -309,17 +444,86 @@ def gpib_unlock(instrument):
 
   @return: response str
   """
-  return _unlock(instrument)
+  return backend().unlock(instrument)
   
 def gpib_dev_status(instrument):
   """
   Get status byte for the instrument.
   
-  @return: str
+  @return: int
+  """
+  return backend().readstb(instrument)
+
+def gpib_trigger(instrument):
+  """
+  Send a group execute trigger to the instrument.
+
+  Implements itrigger(id).  For an interface session, the trigger goes to all
+  the devices addressed to listen.
+
+  @return: 0
+  """
+  return backend().trigger(instrument)
+
+def gpib_sendcmd(instrument, commands):
+  """
+  Send GPIB command bytes to the bus.
+
+  Implements igpibsendcmd(id, buf, length) on an interface session.  The bytes
+  are sent with ATN asserted, so they address and unaddress devices (UNL,
+  listen and talk addresses) or are universal or addressed commands.
+
+  @param commands : command bytes
+  @type  commands : bytes
+
+  @return: 0
+  """
+  return backend().sendcmd(instrument, bytes(commands))
+
+def gpib_onsrq(instrument, handler):
+  """
+  Install a service request handler for the instrument.
+
+  Implements ionsrq(id, shdlr).  handler(instrument) is called when the device
+  asserts SRQ; it should serial poll the device (gpib_dev_status) to find out
+  why and to clear the request.  With interrupts on, SICL calls it
+  asynchronously; after gpib_introff() it is called from gpib_waithdlr.
+
+  @param instrument : device ID
+  @type  instrument : int
+
+  @param handler : function of the device ID, or None to remove the handler
+  @type  handler : callable
+
+  @return: 0
+  """
+  return backend().onsrq(instrument, handler)
+
+def gpib_waithdlr(timeout):
+  """
+  Wait for a handler to be called.
+
+  Implements iwaithdlr(timeout).  With interrupts off (see gpib_introff), a
+  pending handler is called by this function, in the calling thread.
+
+  @param timeout : milliseconds to wait; 0 waits for ever
+  @type  timeout : int
+
+  @return: True if a handler was called, False on timeout
+  """
+  return backend().waithdlr(timeout)
+
+def gpib_introff():
+  """
+  Defer handlers until gpib_waithdlr is called.  Implements iintroff().
+  """
+  return backend().introff()
+
+def gpib_intron():
+  """
+  Call handlers asynchronously again.  Implements iintron().
   """
-  response = ct.create_string_buffer('\000'*2048)
-  status = _get_dev_status(instrument, response)
-  return response.value
+  return backend().intron()
 
 def clear(instrument):
   """
@@ -335,13 +539,10 @@ def clear(instrument):
   @return: 0 if successful or a non-zero error number if an error occurs.
   """
   try:
-    status = _clear(instrument)
+    status = backend().clear(instrument)
     return True
-  except Exception, details:
-    raise RuntimeError, details
-    if status:
-      module_logger(_get_errstr(status))
-    return False
+  except Exception as details:
+    raise RuntimeError(details)
   
 
 if __name__ == "__main__":
@@ -349,4 +550,4 @@ if __name__ == "__main__":
 
   gpib_open(mms['14-1']['addr'])
   r = gpib_prompt(1,"CF?")
-  print r
\ No newline at end of file
+  print(r)
\ No newline at end of file
@@ -0,0 +1,273 @@
+"""
+IEEE-488.2 arbitrary block data and numeric lists
+
+Binary traces are sent as a definite length block::
+  #<N><length><data>
+where N is a single digit giving the number of digits in 'length', or as an
+indefinite length block '#0<data>' ended by the END message.  The functions
+here locate the data in a received buffer and present it as a numpy array
+which shares the buffer's memory.
+
+ASCII traces are lists of numbers in the NR1, NR2 or NR3 formats, e.g.
+'12', '-1.5' or '+1.23450E-03', separated by commas or white space.
+ascii_array() converts such a list without a Python loop.  When every
+number has the same layout, as instruments usually format traces, the text
+is viewed as a matrix with a row per number and the digits are combined
+column by column; otherwise numpy's text parser is used.
+"""
+import re
+import warnings
+
+_separators = bytes.maketrans(b",;", b"  ")
+"""Translation of list separators to the space numpy.fromstring expects"""
+
+_blank = b", \t\r\n;"
+"""Characters which separate numbers in a list"""
+
+_field = re.compile(rb"[^, \t\r\n;]+")
+
+_layout = re.compile(r"s?d*(\.d*)?(Es?d+)?")
+"""Fixed layout of a number: sign, digits, point, exponent"""
+
+fixed_width_min = 8192
+"""
+Bytes below which a list is left to numpy's text parser, which is quicker
+for short lists than the many small steps of the fixed layout conversion
+"""
+
+_tables = None
+
+def _numeric_tables():
+  """
+  Powers of ten, and a table of separator bytes, made on first use.
+  """
+  global _tables
+  if _tables is None:
+    import numpy
+    powers = numpy.array([float("1e%d" % n) for n in range(309)])
+    separator = numpy.zeros(256, dtype=bool)
+    separator[list(_blank)] = True
+    _tables = powers, separator
+  return _tables
+
+byte_orders = {None: None, "<": "<", ">": ">", "little": "<", "big": ">",
+               "swapped": "<", "normal": ">"}
+"""
+Byte order names: numpy's, Python's, and those of the SCPI FORMat:BORDer
+command, in which NORMal is big-endian
+"""
+
+def parse_block_header(data):
+  """
+  Find the data in an arbitrary block.
+
+  @param data : received bytes, starting at the '#'
+  @type  data : bytes-like
+
+  @return: (header length, data length); data length is None for an
+           indefinite length block
+  """
+  view = memoryview(data).cast("B")
+  if len(view) < 2 or view[0] != ord("#"):
+    raise ValueError("block does not start with '#'")
+  ndigits = view[1] - ord("0")
+  if not 0 <= ndigits <= 9:
+    raise ValueError("bad block length digit count %r" % chr(view[1]))
+  if ndigits == 0:
+    return 2, None
+  if len(view) < 2 + ndigits:
+    raise ValueError("block header is incomplete")
+  length = int(bytes(view[2:2+ndigits]))
+  return 2 + ndigits, length
+
+def block_array(data, dtype="<f4", count=None):
+  """
+  A numpy view of the data in an arbitrary block.
+
+  The array shares memory with 'data'; nothing is copied.  For an indefinite
+  length block the data run to the end of 'data' less any trailing newline.
+
+  @param data : received bytes, starting at the '#'
+  @type  data : bytes-like
+
+  @param dtype : element type, with byte order, e.g. '>i2' or '<f4'
+  @type  dtype : str or numpy.dtype
+
+  @param count : number of bytes of 'data' received, if less than its size
+  @type  count : int
+
+  @return: numpy.ndarray
+  """
+  import numpy
+  view = memoryview(data).cast("B")
+  if count is not None:
+    view = view[:count]
+  header, length = parse_block_header(view)
+  if length is None:
+    length = len(view) - header
+    if length and view[-1] == 10:
+      length -= 1
+  elif header + length > len(view):
+    raise ValueError("block of %d bytes is incomplete; %d received"
+                     % (length, len(view) - header))
+  dtype = numpy.dtype(dtype)
+  return numpy.frombuffer(view, dtype=dtype, count=length//dtype.itemsize,
+                          offset=header)
+
+def _fixed_width(text):
+  """
+  Convert a list in which every number has the same layout.
+
+  @param text : the list, without leading or trailing separators
+  @type  text : bytes
+
+  @return: numpy.ndarray of float64, or None if the layouts differ
+  """
+  import numpy
+  powers, separator = _numeric_tables()
+  first = _field.match(text)
+  if first is None or len(first.group()) > 40:
+    return None
+  width = first.end()
+  following = _field.search(text, width)
+  stride = following.start() if following else width + 1
+  if (len(text) + stride - width) % stride:
+    return None
+  count = (len(text) + stride - width)//stride
+  rows = numpy.frombuffer(text + b" "*(stride - width),
+                          dtype=numpy.uint8).reshape(count, stride)
+  if not separator[rows[:, width:]].all():
+    return None
+  roles = []
+  for column, char in enumerate(first.group()):
+    char = bytes([char])
+    if char.isdigit():
+      roles.append("d")
+    elif char in b"+-":
+      roles.append("s")
+    elif char in b".Ee":
+      roles.append(char.upper().decode())
+    else:
+      return None
+  layout = "".join(roles)
+  if not _layout.fullmatch(layout):
+    return None
+  mantissa, e, exponent = layout.partition("E")
+  digits = [column for column, role in enumerate(mantissa) if role == "d"]
+  if not digits or len(digits) > 15:
+    return None
+  exponent_digits = [len(mantissa) + 1 + column
+                     for column, role in enumerate(exponent) if role == "d"]
+  signs = [column for column, role in enumerate(layout) if role == "s"]
+  literals = [column for column, role in enumerate(layout) if role in ".E"]
+  numerals = rows[:, digits + exponent_digits] - 48
+  if (numerals > 9).any():
+    return None
+  for column in signs:
+    if not ((rows[:, column] == 43) | (rows[:, column] == 45)).all():
+      return None
+  for column in literals:
+    if not ((rows[:, column] | 32) == (rows[0, column] | 32)).all():
+      return None
+  # the mantissa and exponent as integers, by one matrix product which is
+  # exact in float32 up to 7 digits and in float64 up to 15
+  ftype = numpy.float32 if len(digits) <= 7 else numpy.float64
+  weights = numpy.zeros((numerals.shape[1], 2), dtype=ftype)
+  weights[:len(digits), 0] = powers[len(digits) - 1::-1]
+  if exponent_digits:
+    weights[len(digits):, 1] = powers[len(exponent_digits) - 1::-1]
+  combined = numerals.astype(ftype) @ weights
+  values = combined[:, 0].astype(numpy.float64)
+  scale = -(len(mantissa) - mantissa.index(".") - 1) if "." in mantissa else 0
+  if exponent_digits:
+    exponents = combined[:, 1].astype(numpy.int64)
+    if exponent.startswith("s"):
+      exponents[rows[:, len(mantissa) + 1] == 45] *= -1
+    scale = exponents + scale
+    if abs(scale).max() > 308:
+      return None
+    # an integer of up to 15 digits divided or multiplied by a power of ten
+    # up to 1e22, both exact, is rounded once, as strtod would give; beyond
+    # that the power is itself rounded, so those numbers are parsed instead
+    inexact = abs(scale) > 22
+    values = numpy.where(scale < 0,
+                         values/powers[numpy.clip(-scale, 0, 22)],
+                         values*powers[numpy.clip(scale, 0, 22)])
+  else:
+    inexact = None
+    if scale:
+      values /= powers[-scale]
+  if layout.startswith("s"):
+    values[rows[:, 0] == 45] *= -1
+  if inexact is not None and inexact.any():
+    tokens = numpy.ascontiguousarray(rows[inexact, :width])
+    values[inexact] = tokens.view("S%d" % width).ravel().astype(numpy.float64)
+  return values
+
+def ascii_array(data, dtype="f8", count=None):
+  """
+  Convert a list of numbers separated by commas or white space.
+
+  @param data : received bytes
+  @type  data : bytes-like
+
+  @param dtype : element type
+  @type  dtype : str or numpy.dtype
+
+  @param count : number of bytes of 'data' received, if less than its size
+  @type  count : int
+
+  @return: numpy.ndarray
+  """
+  import numpy
+  view = memoryview(data).cast("B")
+  if count is not None:
+    view = view[:count]
+  text = bytes(view).strip(_blank)
+  if not text:
+    return numpy.empty(0, dtype=dtype)
+  values = _fixed_width(text) if len(text) >= fixed_width_min else None
+  if values is not None:
+    return values.astype(dtype, copy=False)
+  with warnings.catch_warnings():
+    # numpy warns, and stops, at the first item it cannot convert
+    warnings.simplefilter("error", DeprecationWarning)
+    try:
+      return numpy.fromstring(text.translate(_separators), dtype=dtype,
+                              sep=" ")
+    except (DeprecationWarning, ValueError) as details:
+      raise ValueError("not a numeric list: %r...; %s" % (text[:40], details))
+
+def response_array(data, dtype="f8", count=None, byteorder=None):
+  """
+  Convert a response holding either an arbitrary block or a numeric list.
+
+  @param data : received bytes
+  @type  data : bytes-like
+
+  @param dtype : element type; for a block, that of the binary data
+  @type  dtype : str or numpy.dtype
+
+  @param count : number of bytes of 'data' received, if less than its size
+  @type  count : int
+
+  @param byteorder : byte order of a block, overriding that of 'dtype'; see
+                     byte_orders
+  @type  byteorder : str
+
+  @return: numpy.ndarray; for a block, it shares memory with 'data'
+  """
+  import numpy
+  view = memoryview(data).cast("B")
+  if count is not None:
+    view = view[:count]
+  start = 0
+  while start < len(view) and view[start] in b" \t\r\n":
+    start += 1
+  if start < len(view) and view[start] == ord("#"):
+    dtype = numpy.dtype(dtype)
+    order = byte_orders[byteorder.lower() if byteorder else None]
+    if order:
+      dtype = dtype.newbyteorder(order)
+    return block_array(view[start:], dtype)
+  return ascii_array(view, dtype)
@@ -0,0 +1,323 @@
+"""
+Latency, traffic and error metrics for the gpib_ct entry points
+
+While enabled, every call of gpib_open, gpib_send, gpib_send_many,
+gpib_write_raw, gpib_rcv, gpib_prompt, gpib_prompt_many, gpib_read_into (and
+so gpib_read), gpib_dev_status, gpib_trigger, gpib_sendcmd, gpib_lock and
+gpib_close is timed and counted per device and per gateway::
+
+  >>> from Electronics.Interfaces.GPIB import metrics
+  >>> metrics.enable()
+  >>> ...
+  >>> metrics.snapshot()["devices"]["lan[137.228.236.75]:gpib0,16"]["prompt"]
+  {'count': 120, 'sum': 2.41, 'p50': 0.02, 'p99': 0.05, ...}
+  >>> print(metrics.prometheus_text())
+
+enable() replaces those functions in gpib_ct with timed wrappers and
+disable() puts the originals back, so when disabled there is no cost at all.
+Code which looks the functions up in gpib_ct when calling them, as everything
+in this package does, is measured; references taken with 'from gpib_ct import'
+before enable() are not.  The time spent in gpib_lock is the time spent
+waiting for the lock.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+
+module_logger = logging.getLogger(__name__)
+
+bounds = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+          1., 2., 5., 10.)
+"""Upper bounds in seconds of the latency histogram buckets"""
+
+class Histogram(object):
+  """
+  Latency histogram with fixed buckets
+
+  Public attributes::
+    counts - number of observations in each bucket; the last is unbounded
+    sum    - sum of the observations
+    count  - number of observations
+  """
+  def __init__(self):
+    self.counts = [0]*(len(bounds) + 1)
+    self.sum = 0.
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def quantile(self, q):
+    """
+    Upper bound of the bucket holding the q'th quantile.
+    """
+    if not self.count:
+      return None
+    rank = q*self.count
+    total = 0
+    for index, count in enumerate(self.counts):
+      total += count
+      if total >= rank:
+        return bounds[index] if index < len(bounds) else float("inf")
+
+  def summary(self):
+    return {"count": self.count,
+            "sum": self.sum,
+            "mean": self.sum/self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99)}
+
+class _Stats(object):
+  """
+  Everything recorded for one device or gateway
+  """
+  def __init__(self):
+    self.latency = {}
+    self.sent = 0
+    self.received = 0
+    self.timeouts = 0
+    self.errors = 0
+    self.busy = 0.
+    self.lock_wait = 0.
+
+  def record(self, operation, elapsed, sent, received, failure):
+    histogram = self.latency.get(operation)
+    if histogram is None:
+      histogram = self.latency[operation] = Histogram()
+    histogram.observe(elapsed)
+    self.sent += sent
+    self.received += received
+    if operation == "lock":
+      self.lock_wait += elapsed
+    else:
+      self.busy += elapsed
+    if failure == "timeout":
+      self.timeouts += 1
+    elif failure:
+      self.errors += 1
+
+  def summary(self):
+    return dict([(operation, histogram.summary())
+                 for operation, histogram in self.latency.items()] +
+                [("bytes_sent", self.sent),
+                 ("bytes_received", self.received),
+                 ("timeouts", self.timeouts),
+                 ("errors", self.errors),
+                 ("busy", self.busy),
+                 ("lock_wait", self.lock_wait)])
+
+def _length(value):
+  return len(value) if value is not None else 0
+
+def _session(args):
+  from Electronics.Interfaces.GPIB import gpib_ct
+  return gpib_ct.session_address(args[0]) or "session %s" % args[0]
+
+def _opened(args):
+  from Electronics.Interfaces.GPIB import gpib_ct
+  return gpib_ct.device_address(args[0])
+
+"""
+For each instrumented function: the operation name, a function of the
+arguments giving the device address, and a function of the arguments and
+result giving the bytes (sent, received).
+"""
+_entry_points = {
+  "gpib_open":        ("open", _opened, lambda a, r: (0, 0)),
+  "gpib_close":       ("close", _session, lambda a, r: (0, 0)),
+  "gpib_send":        ("send", _session, lambda a, r: (_length(a[1]), 0)),
+  "gpib_send_many":   ("send", _session, lambda a, r: (r, 0)),
+  "gpib_write_raw":   ("send", _session, lambda a, r: (r, 0)),
+  "gpib_rcv":         ("rcv", _session, lambda a, r: (0, _length(r))),
+  "gpib_prompt":      ("prompt", _session,
+                       lambda a, r: (_length(a[1]), _length(r))),
+  "gpib_prompt_many": ("prompt", _session,
+                       lambda a, r: (sum(map(len, a[1])),
+                                     sum(map(len, r)))),
+  "gpib_read_into":   ("read", _session, lambda a, r: (0, r[0])),
+  "gpib_dev_status":  ("dev_status", _session, lambda a, r: (0, 1)),
+  "gpib_trigger":     ("trigger", _session, lambda a, r: (0, 0)),
+  "gpib_sendcmd":     ("sendcmd", _session, lambda a, r: (_length(a[1]), 0)),
+  "gpib_lock":        ("lock", _session, lambda a, r: (0, 0))}
+
+class Instrumentation(object):
+  """
+  Collects metrics from the wrapped gpib_ct entry points
+
+  Public attributes::
+    started - time metrics were last enabled or reset
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._originals = {}
+    self.reset()
+
+  def reset(self):
+    """
+    Discard everything recorded.
+    """
+    with self._lock:
+      self._devices = {}
+      self._gateways = {}
+      self._buses = {}
+      self.started = time.time()
+
+  def record(self, operation, address, elapsed, sent=0, received=0,
+             failure=None):
+    """
+    Record one call.
+
+    @param failure : None, 'timeout' or 'error'
+    @type  failure : str
+    """
+    try:
+      gateway = gpib_address.gateway_of(address)
+      bus = gpib_address.bus_of(address)
+    except ValueError:
+      gateway = bus = "unknown"
+    with self._lock:
+      for index, key in ((self._devices, address),
+                         (self._gateways, gateway)):
+        stats = index.get(key)
+        if stats is None:
+          stats = index[key] = _Stats()
+        stats.record(operation, elapsed, sent, received, failure)
+      if operation != "lock":
+        self._buses[bus] = self._buses.get(bus, 0.) + elapsed
+
+  def _wrap(self, function, operation, device, traffic):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+      # the address is found first because gpib_close forgets it
+      try:
+        address = device(args)
+      except Exception:
+        address = "unknown"
+      start = time.perf_counter()
+      try:
+        result = function(*args, **kwargs)
+      except Exception as details:
+        elapsed = time.perf_counter() - start
+        failure = ("timeout" if "timeout" in str(details).lower()
+                   else "error")
+        self.record(operation, address, elapsed, failure=failure)
+        raise
+      elapsed = time.perf_counter() - start
+      try:
+        sent, received = traffic(args, result)
+      except Exception:
+        sent, received = 0, 0
+      self.record(operation, address, elapsed, sent, received)
+      return result
+    return timed
+
+  @property
+  def enabled(self):
+    return bool(self._originals)
+
+  def enable(self):
+    """
+    Replace the gpib_ct entry points with timed wrappers.
+    """
+    from Electronics.Interfaces.GPIB import gpib_ct
+    with self._lock:
+      if self._originals:
+        return
+      for name, (operation, device, traffic) in _entry_points.items():
+        original = getattr(gpib_ct, name)
+        self._originals[name] = original
+        setattr(gpib_ct, name, self._wrap(original, operation, device,
+                                          traffic))
+    self.reset()
+
+  def disable(self):
+    """
+    Restore the original gpib_ct entry points.
+    """
+    from Electronics.Interfaces.GPIB import gpib_ct
+    with self._lock:
+      for name, original in self._originals.items():
+        setattr(gpib_ct, name, original)
+      self._originals = {}
+
+  def snapshot(self):
+    """
+    Everything recorded since metrics were enabled or reset.
+
+    @return: {'elapsed': seconds,
+              'devices': {address: stats},
+              'gateways': {gateway: stats},
+              'utilization': {bus: fraction of the time busy}}
+             where stats has a latency summary for each operation and the
+             bytes_sent, bytes_received, timeouts, errors, busy and lock_wait
+             totals
+    """
+    with self._lock:
+      elapsed = time.time() - self.started
+      return {"elapsed": elapsed,
+              "devices": dict((key, stats.summary())
+                              for key, stats in self._devices.items()),
+              "gateways": dict((key, stats.summary())
+                               for key, stats in self._gateways.items()),
+              "utilization": dict((bus, busy/elapsed if elapsed else 0.)
+                                  for bus, busy in self._buses.items())}
+
+  def prometheus_text(self, prefix="gpib"):
+    """
+    The metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    def family(name, kind, text):
+      lines.append("# HELP %s_%s %s" % (prefix, name, text))
+      lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+    def sample(name, labels, value):
+      text = ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                      for key, value in labels)
+      lines.append("%s_%s{%s} %r" % (prefix, name, text, value))
+    with self._lock:
+      for label, index in (("device", self._devices),
+                           ("gateway", self._gateways)):
+        family("%s_operation_seconds" % label, "histogram",
+               "Latency of GPIB operations by %s" % label)
+        for key, stats in sorted(index.items()):
+          for operation, histogram in sorted(stats.latency.items()):
+            labels = [(label, key), ("operation", operation)]
+            total = 0
+            for bound, count in zip(bounds + ("+Inf",), histogram.counts):
+              total += count
+              sample("%s_operation_seconds_bucket" % label,
+                     labels + [("le", bound)], total)
+            sample("%s_operation_seconds_sum" % label, labels,
+                   histogram.sum)
+            sample("%s_operation_seconds_count" % label, labels,
+                   histogram.count)
+      for name, attribute, text in (
+          ("bytes_sent_total", "sent", "Bytes sent to devices"),
+          ("bytes_received_total", "received", "Bytes received from devices"),
+          ("timeouts_total", "timeouts", "Operations which timed out"),
+          ("errors_total", "errors", "Operations which failed otherwise"),
+          ("lock_wait_seconds_total", "lock_wait",
+           "Time spent waiting for device locks")):
+        family(name, "counter", text)
+        for key, stats in sorted(self._devices.items()):
+          sample(name, [("device", key)], getattr(stats, attribute))
+      family("bus_busy_seconds_total", "counter",
+             "Time spent in operations on each bus")
+      for bus, busy in sorted(self._buses.items()):
+        sample("bus_busy_seconds_total", [("bus", bus)], busy)
+    return "\n".join(lines) + "\n"
+
+instrumentation = Instrumentation()
+
+enable = instrumentation.enable
+disable = instrumentation.disable
+reset = instrumentation.reset
+snapshot = instrumentation.snapshot
+prometheus_text = instrumentation.prometheus_text
@@ -0,0 +1,459 @@
+"""
+Periodic polling of many devices at their own rates
+
+A PollPlanner is given (device, query, period) entries, e.g. thermometers
+every few seconds, power meters several times a second and the K-band
+controller every minute::
+
+  >>> from Electronics.Interfaces.GPIB.planner import PollPlanner
+  >>> planner = PollPlanner([("thermometer ls_14", "KRDG?", 5.),
+  ...                        ("pm 13-1", "TR2", 0.1),
+  ...                        ("control K_14", "STAT?", 60.)])
+  >>> planner.load()
+  {'lan[137.228.236.54]:hpib': 0.004, 'lan[137.228.236.75]:gpib0': 0.32}
+  >>> planner.start()
+  >>> planner.report()
+  [{'device': 'pm 13-1', 'query': 'TR2', 'rate': 9.99, 'missed': 0,
+    'jitter_p99': 0.0021, ...}, ...]
+  >>> planner.stop()
+
+The time one poll occupies its bus is measured when the entry is added, by
+sending the query a few times, and kept up to date from the polls.  An
+entry's share of its bus is that time divided by its period.  An entry which
+would take a bus over 'utilization' is refused with Oversubscribed or, if
+'degrade' is set, every period on that bus is stretched by the same factor
+until the bus fits; the periods return towards those asked for when the
+measured times allow.
+
+Polls are due at fixed times, the start plus whole periods, so they do not
+drift however long each takes, and are queued on the BusScheduler with the
+next due time as their deadline, so the scheduler serves the most urgent
+first.  A poll which is not sent before the next one is due, or is skipped
+because the previous one is still waiting, is a missed deadline.  Jitter is
+the time from when a poll is due to when it is sent.  Each response goes to
+the entry's callback, if any, and its value to the planner's
+sink.TimeSeriesSink, if any.
+"""
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.registry import registry
+from Electronics.Interfaces.GPIB.scheduler import DeadlineExceeded
+
+module_logger = logging.getLogger(__name__)
+
+class Oversubscribed(ValueError):
+  """
+  The entry would take its bus over the planner's utilization
+  """
+  pass
+
+def _median(values):
+  values = sorted(values)
+  return values[len(values)//2]
+
+class PollEntry(object):
+  """
+  One query polled periodically
+
+  Public attributes::
+    device    - device name or SICL address
+    query     - command sent for each poll
+    requested - period asked for, in seconds
+    period    - period in use, longer than 'requested' when degraded
+    bus       - SICL address of the device's bus
+    channel   - channel name of the readings in the planner's sink
+    callback  - function(entry, time sent, response) called for each
+                response, or None
+    polls     - polls answered
+    missed    - deadlines missed
+    errors    - polls which failed
+    value     - the last response
+    when      - time the last response was asked for
+    started   - time the counts started, or None before polling
+  """
+  def __init__(self, device, query, period, channel=None, callback=None,
+               window=100):
+    if period <= 0:
+      raise ValueError("period must be positive")
+    self.device = device
+    self.query = query
+    self.requested = period
+    self.period = period
+    self.bus = gpib_address.bus_of(registry.address(device))
+    self.channel = query if channel is None else channel
+    self.callback = callback
+    self.polls = 0
+    self.missed = 0
+    self.errors = 0
+    self.value = None
+    self.when = None
+    self.started = None
+    self.costs = collections.deque(maxlen=window)
+    self.jitters = collections.deque(maxlen=window)
+    self.max_jitter = 0.
+    self.outstanding = False
+    self.due = None
+    self.active = False
+
+  @property
+  def cost(self):
+    """
+    Seconds a poll occupies the bus.
+    """
+    return _median(self.costs) if self.costs else None
+
+  def reset(self, started):
+    """
+    Start counting polls, missed deadlines, errors and jitter afresh.
+    """
+    self.polls = 0
+    self.missed = 0
+    self.errors = 0
+    self.jitters.clear()
+    self.max_jitter = 0.
+    self.started = started
+
+  def __repr__(self):
+    return "PollEntry(%r, %r, %r)" % (self.device, self.query, self.requested)
+
+class PollPlanner(object):
+  """
+  Plans and runs periodic polls within the capacity of each bus
+
+  Public attributes::
+    scheduler      - scheduler.BusScheduler the polls are queued on
+    utilization    - largest fraction of a bus's time the polls may take
+    degrade        - stretch periods rather than refuse an entry
+    sink           - sink.TimeSeriesSink for the readings, or None
+    probes         - polls sent to measure a new entry's transaction time
+    replan_interval - seconds between updates of the periods in use
+  """
+  def __init__(self, entries=(), scheduler=None, utilization=0.8,
+               degrade=False, sink=None, probes=3, replan_interval=10.):
+    """
+    @param entries : (device, query, period) tuples
+    @type  entries : list
+
+    @param scheduler : request scheduler; default the shared one
+    @type  scheduler : scheduler.BusScheduler
+
+    @param utilization : largest fraction of a bus's time used by polling
+    @type  utilization : float
+
+    @param degrade : stretch the periods on a bus which would be
+                     oversubscribed instead of refusing the entry
+    @type  degrade : bool
+
+    @param sink : sink for the readings, which must be numbers
+    @type  sink : sink.TimeSeriesSink
+
+    @param probes : polls sent to time a new entry
+    @type  probes : int
+    """
+    if scheduler is None:
+      from Electronics.Interfaces.GPIB.scheduler import scheduler
+    self.scheduler = scheduler
+    self.utilization = utilization
+    self.degrade = degrade
+    self.sink = sink
+    self.probes = probes
+    self.replan_interval = replan_interval
+    self._entries = []
+    self._heap = []
+    self._sequence = itertools.count()
+    self._lock = threading.Lock()
+    self._wake = threading.Condition(self._lock)
+    self._thread = None
+    self._running = False
+    self._started = None
+    self._stopped = None
+    for entry in entries:
+      self.add(*entry)
+
+  def _poller(self, entry):
+    """
+    Scheduler operation polling an entry; returns (sent, done, response).
+    """
+    driver = self.scheduler.driver
+    def poll(instr):
+      sent = time.time()
+      response = driver.gpib_prompt(instr, entry.query)
+      return sent, time.time(), response
+    return poll
+
+  def measure(self, entry):
+    """
+    Time a few polls of an entry.
+
+    @return: median seconds per poll
+    """
+    poll = self._poller(entry)
+    for count in range(self.probes):
+      sent, done, response = self.scheduler.submit(entry.device,
+                                                   poll).result()
+      entry.costs.append(done - sent)
+    return entry.cost
+
+  def _load(self, bus, extra=None):
+    """
+    Fraction of a bus's time taken by its entries at the requested periods.
+
+    Must be called with the planner lock held.
+    """
+    entries = [entry for entry in self._entries if entry.bus == bus]
+    if extra is not None:
+      entries.append(extra)
+    return sum(entry.cost/entry.requested for entry in entries
+               if entry.cost is not None)
+
+  def _balance(self, bus):
+    """
+    Set the periods in use on a bus from its load.
+
+    Must be called with the planner lock held.
+    """
+    load = self._load(bus)
+    factor = max(1., load/self.utilization) if self.degrade else 1.
+    changed = False
+    for entry in self._entries:
+      if entry.bus == bus:
+        period = entry.requested*factor
+        # small changes of the measured times are not worth reporting
+        changed |= abs(period - entry.period) > 0.01*entry.period
+        entry.period = period
+    if changed:
+      module_logger.info("PollPlanner: %s would be %.0f%% busy; periods "
+                         "stretched %.2f times", bus, 100*load, factor)
+    elif load > self.utilization and not self.degrade:
+      module_logger.warning("PollPlanner: %s is %.0f%% busy", bus, 100*load)
+
+  def add(self, device, query, period, channel=None, callback=None):
+    """
+    Plan a poll of a device, measuring its cost first.
+
+    @param device : device name or SICL address
+    @type  device : str
+
+    @param query : command sent for each poll
+    @type  query : str
+
+    @param period : seconds between polls
+    @type  period : float
+
+    @param channel : channel name in the sink; default the query
+    @type  channel : str
+
+    @param callback : function(entry, time sent, response)
+    @type  callback : callable
+
+    @return: PollEntry
+    """
+    entry = PollEntry(device, query, period, channel, callback)
+    self.measure(entry)
+    with self._lock:
+      load = self._load(entry.bus, entry)
+      if load > self.utilization and not self.degrade:
+        raise Oversubscribed(
+          "%s %s every %g s would make %s %.0f%% busy; the limit is %.0f%%"
+          % (device, query, period, entry.bus, 100*load,
+             100*self.utilization))
+      self._entries.append(entry)
+      self._balance(entry.bus)
+      if self._running:
+        now = time.time()
+        entry.reset(now)
+        self._schedule(entry, now)
+    return entry
+
+  def remove(self, entry):
+    """
+    Stop polling an entry.
+    """
+    with self._lock:
+      self._entries.remove(entry)
+      entry.active = False
+      self._balance(entry.bus)
+
+  @property
+  def entries(self):
+    return list(self._entries)
+
+  def load(self):
+    """
+    Fraction of each bus's time the entries take at their requested periods.
+    """
+    with self._lock:
+      return dict((bus, self._load(bus))
+                  for bus in set(entry.bus for entry in self._entries))
+
+  def _schedule(self, entry, due):
+    """
+    Must be called with the planner lock held.
+    """
+    entry.active = True
+    entry.due = due
+    heapq.heappush(self._heap, (due, next(self._sequence), entry))
+    self._wake.notify()
+
+  def start(self):
+    """
+    Start polling.
+    """
+    with self._lock:
+      if self._running:
+        return
+      self._running = True
+      self._started = time.time()
+      self._stopped = None
+      # entries on a bus start one after another rather than all queueing
+      # at once
+      offsets = {}
+      for entry in sorted(self._entries, key=lambda entry: entry.period):
+        entry.reset(self._started)
+        offset = offsets.get(entry.bus, 0.)
+        self._schedule(entry, self._started + offset)
+        offsets[entry.bus] = offset + entry.cost
+    self._thread = threading.Thread(target=self._run, name="GPIB planner")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """
+    Stop polling; polls already queued are still answered.
+    """
+    with self._lock:
+      if self._running:
+        self._stopped = time.time()
+      self._running = False
+      self._heap = []
+      for entry in self._entries:
+        entry.active = False
+      self._wake.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _run(self):
+    replan = time.time() + self.replan_interval
+    while True:
+      with self._lock:
+        while self._running:
+          now = time.time()
+          if now >= replan:
+            for bus in set(entry.bus for entry in self._entries):
+              self._balance(bus)
+            replan = now + self.replan_interval
+          due = self._heap[0][0] if self._heap else replan
+          if due <= now:
+            break
+          self._wake.wait(min(due, replan) - now)
+        if not self._running:
+          return
+        due, sequence, entry = heapq.heappop(self._heap)
+        if not entry.active or due != entry.due:
+          continue
+        # the next poll is due a whole number of periods after this one
+        following = due + entry.period
+        if following <= now:
+          skipped = int((now - following)/entry.period) + 1
+          entry.missed += skipped
+          following += skipped*entry.period
+        self._schedule(entry, following)
+        if entry.outstanding:
+          entry.missed += 1
+          continue
+        entry.outstanding = True
+      self._submit(entry, due, following - now)
+
+  def _submit(self, entry, due, deadline):
+    try:
+      future = self.scheduler.submit(entry.device, self._poller(entry),
+                                     deadline=deadline)
+    except Exception as details:
+      self._done(entry, due, None, details)
+      return
+    future.add_done_callback(lambda future: self._done(entry, due, future))
+
+  def _done(self, entry, due, future, failure=None):
+    if failure is None:
+      try:
+        failure = future.exception()
+      except futures.CancelledError as details:
+        # cancelled before it was sent, e.g. by the scheduler shutting down
+        failure = details
+    with self._lock:
+      entry.outstanding = False
+      if isinstance(failure, (DeadlineExceeded, futures.CancelledError)):
+        entry.missed += 1
+        return
+      if failure is not None:
+        entry.errors += 1
+        module_logger.debug("PollPlanner: %r failed; %s", entry, failure)
+        return
+      sent, done, response = future.result()
+      jitter = sent - due
+      entry.jitters.append(jitter)
+      entry.max_jitter = max(entry.max_jitter, jitter)
+      entry.costs.append(done - sent)
+      entry.polls += 1
+      entry.value = response
+      entry.when = sent
+    if self.sink is not None:
+      try:
+        self.sink.put(sent, entry.device, entry.channel, float(response))
+      except ValueError as details:
+        entry.errors += 1
+        module_logger.debug("PollPlanner: %r: %s", entry, details)
+    if entry.callback is not None:
+      try:
+        entry.callback(entry, sent, response)
+      except Exception:
+        module_logger.exception("PollPlanner: callback of %r failed", entry)
+
+  def report(self):
+    """
+    What each entry has achieved since the planner was last started, or
+    since it was added if later, until it was stopped.
+
+    @return: list of {'device', 'query', 'bus', 'requested' and 'period' (s),
+                      'rate' (polls/s), 'polls', 'missed', 'errors',
+                      'cost', 'jitter_mean', 'jitter_p99' and 'jitter_max'
+                      (s)}
+    """
+    with self._lock:
+      end = self._stopped or time.time()
+      result = []
+      for entry in self._entries:
+        elapsed = end - entry.started if entry.started else 0.
+        jitters = sorted(entry.jitters)
+        result.append({
+          "device": entry.device,
+          "query": entry.query,
+          "bus": entry.bus,
+          "requested": entry.requested,
+          "period": entry.period,
+          "rate": entry.polls/elapsed if elapsed else 0.,
+          "polls": entry.polls,
+          "missed": entry.missed,
+          "errors": entry.errors,
+          "cost": entry.cost,
+          "jitter_mean": sum(jitters)/len(jitters) if jitters else None,
+          "jitter_p99": (jitters[min(len(jitters) - 1,
+                                     int(0.99*len(jitters)))]
+                         if jitters else None),
+          "jitter_max": entry.max_jitter})
+      return result
@@ -0,0 +1,389 @@
+"""
+Adaptive timeouts, retries and circuit breakers per device
+
+SICL sessions start with a 10 s timeout, so every call to an instrument
+which has died stalls its caller for 10 s.  A DevicePolicy instead sets each
+session's timeout from the latencies observed for its device, as a multiple
+of their 99th percentile, retries a failed call with exponential backoff, and
+stops calling a device after repeated failures::
+
+  >>> from Electronics.Interfaces import GPIB
+  >>> policy = GPIB.enable_policy()
+  >>> GPIB.ask("pm 13-2", "?ID")
+  'No response due to error'
+  >>> policy.state("pm 13-2")
+  {'state': 'open', 'timeout': 2000, 'failures': 2, ...}
+
+While a device's circuit is open, calls fail at once with DeviceUnavailable.
+A background thread serial polls it, at intervals which double up to
+'max_probe_interval', and closes the circuit when it answers.  Devices marked
+'alive': False in the registry start with their circuit open.
+
+The policy applies to calls made through SessionPool.call, and so to ask(),
+ask_many(), dev_status(), the scheduler and the gateway workers.  A Gpib
+instance keeps the timeout set with its tmo() method.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+CLOSED, OPEN = "closed", "open"
+"""Circuit states: calls allowed, calls refused"""
+
+class DeviceUnavailable(RuntimeError):
+  """
+  The device's circuit is open after repeated failures
+  """
+  pass
+
+class _Device(object):
+  """
+  What the policy knows about one device
+  """
+  def __init__(self, address, window, timeout, state):
+    self.address = address
+    self.latencies = collections.deque(maxlen=window)
+    self.timeout = timeout
+    self.failures = 0
+    self.state = state
+    self.opened = time.time() if state == OPEN else None
+    self.probe_interval = None
+    self.next_probe = 0.
+
+class DevicePolicy(object):
+  """
+  Timeout, retry and circuit breaker policy for every device
+
+  Public attributes::
+    initial            - timeout in ms until 'min_samples' latencies are
+                         known; it is not doubled for retries
+    factor             - timeout as a multiple of the 99th percentile latency
+    minimum            - smallest timeout in ms
+    maximum            - largest timeout in ms, including after backoff
+    window             - number of recent latencies kept per device
+    min_samples        - latencies needed before the timeout adapts
+    retries            - attempts after the first failed one
+    backoff            - seconds before the first retry; doubles each retry
+    max_backoff        - longest wait before a retry
+    threshold          - consecutive failures which open a device's circuit
+    probe_interval     - seconds before an open device is first probed
+    max_probe_interval - longest interval between probes
+    probe_timeout      - timeout in ms of the serial poll probing a device
+    stats              - dict of counters: calls, failures, retries, rejected,
+                         opened, probes, recovered
+  """
+  def __init__(self, initial=2000, factor=4., minimum=100, maximum=10000,
+               window=100, min_samples=5, retries=1, backoff=0.05,
+               max_backoff=1., threshold=2, probe_interval=5.,
+               max_probe_interval=300., probe_timeout=200, pool=None):
+    """
+    @param initial : timeout in ms for devices without enough latencies
+    @type  initial : int
+
+    @param factor : multiple of the 99th percentile latency
+    @type  factor : float
+
+    @param minimum : smallest timeout in ms
+    @type  minimum : int
+
+    @param maximum : largest timeout in ms
+    @type  maximum : int
+
+    @param retries : attempts after the first failed one
+    @type  retries : int
+
+    @param backoff : seconds before the first retry
+    @type  backoff : float
+
+    @param threshold : consecutive failures which open a circuit
+    @type  threshold : int
+
+    @param probe_interval : seconds before an open device is first probed
+    @type  probe_interval : float
+
+    @param probe_timeout : timeout in ms of a probe, which holds the bus
+    @type  probe_timeout : int
+
+    @param pool : session pool used for probes; default the shared pool
+    @type  pool : pool.SessionPool
+    """
+    self.initial = initial
+    self.factor = factor
+    self.minimum = minimum
+    self.maximum = maximum
+    self.window = window
+    self.min_samples = min_samples
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.threshold = threshold
+    self.probe_interval = probe_interval
+    self.max_probe_interval = max_probe_interval
+    self.probe_timeout = probe_timeout
+    self.stats = {"calls": 0, "failures": 0, "retries": 0, "rejected": 0,
+                  "opened": 0, "probes": 0, "recovered": 0}
+    self._pool = pool
+    self._devices = {}
+    self._lock = threading.Lock()
+    self._wake = threading.Condition(self._lock)
+    self._prober = None
+    self._running = False
+    self._stopped = False
+
+  @property
+  def pool(self):
+    if self._pool is None:
+      from Electronics.Interfaces.GPIB.pool import session_pool
+      self._pool = session_pool
+    return self._pool
+
+  def _address(self, name):
+    try:
+      return registry.address(name)
+    except KeyError:
+      return name
+
+  def _device(self, address):
+    """
+    The state of a device, created if necessary.
+
+    Must be called with the policy lock held.
+    """
+    device = self._devices.get(address)
+    if device is None:
+      known = registry.at_address(address)
+      alive = not known or any(entry.alive for entry in known)
+      device = self._devices[address] = _Device(
+        address, self.window, self.initial, CLOSED if alive else OPEN)
+      if not alive:
+        self._schedule_probe(device)
+    return device
+
+  def _adapt(self, device):
+    """
+    Set the device's timeout from its latencies.
+    """
+    if len(device.latencies) < self.min_samples:
+      return
+    latencies = sorted(device.latencies)
+    p99 = latencies[min(len(latencies) - 1, int(0.99*len(latencies)))]
+    # whole tens of ms, so that small changes do not reset the session
+    timeout = 10*int(self.factor*p99*100 + 1)
+    device.timeout = max(self.minimum, min(self.maximum, timeout))
+
+  def timeout(self, name, attempt=0):
+    """
+    Timeout in ms for a device, doubled for each retry once it is learned.
+
+    The initial timeout is a guess, which a dead device would only make
+    its callers wait for longer if it were doubled.
+    """
+    with self._lock:
+      device = self._device(self._address(name))
+      if len(device.latencies) < self.min_samples:
+        return device.timeout
+      timeout = device.timeout
+    return min(self.maximum, timeout << attempt)
+
+  def _apply(self, session, timeout):
+    if session.timeout != timeout:
+      self.pool.driver.gpib_timeout(session.instr, timeout)
+      session.timeout = timeout
+
+  def _succeeded(self, device, elapsed):
+    with self._lock:
+      device.latencies.append(elapsed)
+      device.failures = 0
+      self._adapt(device)
+
+  def _failed(self, device, details):
+    with self._lock:
+      self.stats["failures"] += 1
+      device.failures += 1
+      if device.state == CLOSED and device.failures >= self.threshold:
+        device.state = OPEN
+        device.opened = time.time()
+        device.probe_interval = None
+        self._schedule_probe(device)
+        self.stats["opened"] += 1
+        module_logger.warning("DevicePolicy: %s failed %d times; "
+                              "circuit opened; %s",
+                              device.address, device.failures, details)
+        return True
+    return False
+
+  def call(self, pool, name, func, *args, **kwargs):
+    """
+    Call func(instr, *args) on a pooled session under the policy.
+
+    @param pool : pool supplying the session
+    @type  pool : pool.SessionPool
+
+    @param name : device name or address
+    @type  name : str
+
+    @param retries : attempts after the first failed one (keyword, default
+                     the policy's)
+    @type  retries : int
+
+    @return: whatever func returns
+    """
+    retries = kwargs.pop("retries", self.retries)
+    address = self._address(name)
+    with self._lock:
+      device = self._device(address)
+      self.stats["calls"] += 1
+      if device.state == OPEN:
+        self.stats["rejected"] += 1
+        raise DeviceUnavailable("%s has failed %d times since %s"
+                                % (address, device.failures,
+                                   time.ctime(device.opened)))
+    delay = self.backoff
+    attempt = 0
+    while True:
+      # failing to open a session, e.g. to a dead gateway, counts too
+      session = None
+      try:
+        session = pool.checkout(name)
+        self._apply(session, self.timeout(address, attempt))
+        start = time.time()
+        result = func(session.instr, *args, **kwargs)
+      except Exception as details:
+        if session is not None:
+          pool.checkin(session, broken=True)
+        if self._failed(device, details) or attempt >= retries:
+          raise
+        attempt += 1
+        self.stats["retries"] += 1
+        # jitter keeps threads retrying the same gateway from doing so together
+        time.sleep(delay*random.uniform(0.5, 1.))
+        delay = min(2*delay, self.max_backoff)
+        continue
+      self._succeeded(device, time.time() - start)
+      pool.checkin(session)
+      return result
+
+  def _schedule_probe(self, device):
+    """
+    Set when an open device is next probed.
+
+    Must be called with the policy lock held.
+    """
+    if device.probe_interval is None:
+      device.probe_interval = self.probe_interval
+    else:
+      device.probe_interval = min(2*device.probe_interval,
+                                  self.max_probe_interval)
+    device.next_probe = time.time() + device.probe_interval
+    self._start()
+    self._wake.notify()
+
+  def _probe(self, device):
+    """
+    Serial poll an open device; close its circuit if it answers.
+    """
+    self.stats["probes"] += 1
+    pool = self.pool
+    try:
+      session = pool.checkout(device.address)
+    except Exception as details:
+      module_logger.debug("DevicePolicy: opening %s failed; %s",
+                          device.address, details)
+      return False
+    try:
+      previous = pool.set_timeout(session, self.probe_timeout)
+      pool.driver.gpib_dev_status(session.instr)
+      pool.restore_timeout(session, previous)
+    except Exception as details:
+      pool.checkin(session, broken=True)
+      module_logger.debug("DevicePolicy: probe of %s failed; %s",
+                          device.address, details)
+      return False
+    pool.checkin(session)
+    return True
+
+  def _start(self):
+    # a probe which fails while stop() waits for it must not start another
+    if self._prober is None and not self._stopped:
+      self._running = True
+      self._prober = threading.Thread(target=self._run,
+                                      name="GPIB policy probes")
+      self._prober.daemon = True
+      self._prober.start()
+
+  def _run(self):
+    while True:
+      with self._lock:
+        while self._running:
+          now = time.time()
+          due = [device for device in self._devices.values()
+                 if device.state == OPEN and device.next_probe <= now]
+          if due:
+            break
+          waits = [device.next_probe - now
+                   for device in self._devices.values()
+                   if device.state == OPEN and
+                   device.next_probe != float("inf")]
+          self._wake.wait(min(waits) if waits else None)
+        if not self._running:
+          return
+        for device in due:
+          # not probed again until this probe is done
+          device.next_probe = float("inf")
+      for device in due:
+        answered = self._probe(device)
+        with self._lock:
+          if answered:
+            device.state = CLOSED
+            device.failures = 0
+            device.probe_interval = None
+            self.stats["recovered"] += 1
+            module_logger.info("DevicePolicy: %s answered; circuit closed",
+                               device.address)
+          else:
+            self._schedule_probe(device)
+
+  def state(self, name):
+    """
+    What is known about a device.
+
+    @return: dict with 'state', 'timeout' (ms), 'failures', 'samples',
+             'opened' and 'next_probe' (times or None)
+    """
+    with self._lock:
+      device = self._device(self._address(name))
+      is_open = device.state == OPEN
+      return {"state": device.state,
+              "timeout": device.timeout,
+              "failures": device.failures,
+              "samples": len(device.latencies),
+              "opened": device.opened if is_open else None,
+              "next_probe": device.next_probe if is_open else None}
+
+  def reset(self, name=None):
+    """
+    Forget what is known about a device, or about every device if None.
+    """
+    with self._lock:
+      if name is None:
+        self._devices = {}
+      else:
+        self._devices.pop(self._address(name), None)
+
+  def stop(self):
+    """
+    Stop the probe thread for good; open devices are no longer probed.
+    """
+    with self._lock:
+      prober, self._prober = self._prober, None
+      self._running = False
+      self._stopped = True
+      self._wake.notify_all()
+    if prober is not None:
+      prober.join()
@@ -0,0 +1,344 @@
+"""
+Persistent pool of SICL device sessions
+
+Opening a session on a LAN gateway (``lan[...]:gpib0``) costs a full
+iopen/iclose round trip to the gateway.  A SessionPool keeps sessions open
+between requests, keyed by device address (a device name like "pm 13-1" is
+looked up in the registry), so that the module-level helpers and the Gpib
+class can share them::
+
+  >>> from Electronics.Interfaces.GPIB.pool import session_pool
+  >>> resp = session_pool.call("pm 13-1", pysicl.gpib_prompt, "?ID")
+
+A session is checked out by one caller at a time.  Sessions which have been
+idle for longer than 'max_idle' seconds are closed.  A session which has been
+idle for more than 'check_idle' seconds is health checked with ireadstb before
+it is handed out, and a session which fails an operation is closed and
+replaced by a fresh one.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+initial_timeout = 10000
+"""I/O timeout in ms of a newly opened SICL session"""
+
+class Session(object):
+  """
+  An open SICL session as held by the pool
+
+  Public attributes::
+    name     - device address passed to gpib_open
+    instr    - SICL session identifier returned by gpib_open
+    opened   - time the session was opened
+    last_use - time the session was last checked in
+    uses     - number of times the session has been checked out
+    timeout  - I/O timeout in ms set through the pool or a
+               policy.DevicePolicy, or None for initial_timeout
+  """
+  def __init__(self, name, instr):
+    self.name = name
+    self.instr = instr
+    self.opened = time.time()
+    self.last_use = self.opened
+    self.uses = 0
+    self.timeout = None
+
+  def __repr__(self):
+    return "Session(%r, %r)" % (self.name, self.instr)
+
+class SessionPool(object):
+  """
+  Keyed pool of open SICL sessions
+
+  Public attributes::
+    max_idle    - seconds after which an idle session is closed
+    check_idle  - seconds of idleness after which a session is health checked
+                  on checkout; 0 checks every checkout
+    max_per_key - maximum number of idle sessions kept for one device
+    policy      - policy.DevicePolicy applied by call(), or None
+    stats       - dict of counters: opens, closes, reuses, checks, failures
+  """
+  def __init__(self, driver=None, max_idle=60., check_idle=1., max_per_key=4,
+               policy=None):
+    """
+    @param driver : module providing gpib_open, gpib_close, gpib_dev_status;
+                    defaults to gpib_ct
+    @type  driver : module
+
+    @param max_idle : seconds after which an idle session is closed
+    @type  max_idle : float
+
+    @param check_idle : idle seconds after which a session is health checked
+    @type  check_idle : float
+
+    @param max_per_key : idle sessions kept per device
+    @type  max_per_key : int
+
+    @param policy : timeout, retry and circuit breaker policy for call()
+    @type  policy : policy.DevicePolicy
+    """
+    self._driver = driver
+    self.max_idle = max_idle
+    self.check_idle = check_idle
+    self.max_per_key = max_per_key
+    self.policy = policy
+    self._idle = {}
+    self._lock = threading.Lock()
+    self.stats = {"opens": 0, "closes": 0, "reuses": 0, "checks": 0,
+                  "failures": 0}
+
+  @property
+  def driver(self):
+    """
+    Module which performs the SICL calls
+    """
+    if self._driver is None:
+      from Electronics.Interfaces.GPIB import gpib_ct
+      self._driver = gpib_ct
+    return self._driver
+
+  def _key(self, name):
+    """
+    Sessions are keyed by address, so a device has the same sessions whether
+    it is opened by name or by address.
+    """
+    try:
+      return registry.address(name)
+    except KeyError:
+      return name
+
+  def _open(self, name):
+    instr = self.driver.gpib_open(name)
+    self.stats["opens"] += 1
+    module_logger.debug("SessionPool: opened %s as %s", name, instr)
+    return Session(name, instr)
+
+  def _close(self, session):
+    self.stats["closes"] += 1
+    try:
+      self.driver.gpib_close(session.instr)
+    except Exception as details:
+      module_logger.debug("SessionPool: closing %r failed; %s",
+                          session, details)
+
+  def _healthy(self, session):
+    self.stats["checks"] += 1
+    try:
+      self.driver.gpib_dev_status(session.instr)
+      return True
+    except Exception as details:
+      module_logger.debug("SessionPool: %r failed health check; %s",
+                          session, details)
+      return False
+
+  def _expired(self, now):
+    """
+    Remove and return sessions idle longer than max_idle.
+
+    Must be called with the pool lock held.
+    """
+    expired = []
+    for name in list(self._idle.keys()):
+      keep = []
+      for session in self._idle[name]:
+        if now - session.last_use > self.max_idle:
+          expired.append(session)
+        else:
+          keep.append(session)
+      if keep:
+        self._idle[name] = keep
+      else:
+        del self._idle[name]
+    return expired
+
+  def evict(self):
+    """
+    Close sessions which have been idle for longer than max_idle.
+
+    @return: number of sessions closed
+    """
+    with self._lock:
+      expired = self._expired(time.time())
+    for session in expired:
+      self._close(session)
+    return len(expired)
+
+  def checkout(self, name, check=True):
+    """
+    Get an open session for the device, opening one if none is idle.
+
+    @param name : device name as accepted by gpib_open
+    @type  name : str
+
+    @param check : False to skip the health check, a serial poll, which
+                   would clear a pending service request
+    @type  check : bool
+
+    @return: Session
+    """
+    name = self._key(name)
+    now = time.time()
+    with self._lock:
+      expired = self._expired(now)
+      idle = self._idle.get(name)
+      session = idle.pop() if idle else None
+    for stale in expired:
+      self._close(stale)
+    while session:
+      if (not check or now - session.last_use < self.check_idle or
+          self._healthy(session)):
+        self.stats["reuses"] += 1
+        break
+      self.stats["failures"] += 1
+      self._close(session)
+      with self._lock:
+        idle = self._idle.get(name)
+        session = idle.pop() if idle else None
+    else:
+      session = self._open(name)
+    session.uses += 1
+    return session
+
+  def checkin(self, session, broken=False):
+    """
+    Return a session to the pool.
+
+    @param session : session obtained from checkout
+    @type  session : Session
+
+    @param broken : True if the session failed and must be closed
+    @type  broken : bool
+    """
+    if broken:
+      self.stats["failures"] += 1
+      self._close(session)
+      return
+    session.last_use = time.time()
+    with self._lock:
+      idle = self._idle.setdefault(session.name, [])
+      if len(idle) < self.max_per_key:
+        idle.append(session)
+        session = None
+    if session:
+      self._close(session)
+
+  def set_timeout(self, session, milliseconds):
+    """
+    Set the I/O timeout of a checked out session.
+
+    A caller which changes the timeout must put the previous one back with
+    restore_timeout() before checking the session in, so that it does not
+    apply to the session's next user.
+
+    @return: the previous timeout in ms, or None for initial_timeout
+    """
+    previous = session.timeout
+    if milliseconds != (initial_timeout if previous is None else previous):
+      self.driver.gpib_timeout(session.instr, milliseconds)
+    session.timeout = milliseconds
+    return previous
+
+  def restore_timeout(self, session, previous):
+    """
+    Put back a timeout returned by set_timeout().
+    """
+    self.set_timeout(session, initial_timeout if previous is None
+                              else previous)
+    session.timeout = previous
+
+  def replace(self, session):
+    """
+    Close a failed session and open a new one for the same device.
+
+    @param session : session that failed
+    @type  session : Session
+
+    @return: Session
+    """
+    self.checkin(session, broken=True)
+    return self.checkout(session.name)
+
+  @contextlib.contextmanager
+  def session(self, name):
+    """
+    Context manager which yields a checked out session.
+
+    A session which raises an exception is closed rather than returned.
+    """
+    session = self.checkout(name)
+    try:
+      yield session
+    except Exception:
+      self.checkin(session, broken=True)
+      raise
+    self.checkin(session)
+
+  def call(self, name, func, *args, **kwargs):
+    """
+    Call func(instr, *args) on a pooled session for the device.
+
+    If the call fails, the session is closed and the error raised; the call
+    is only repeated on a freshly opened session if 'retries' asks for it,
+    since an operation such as a write or a trigger may have taken effect
+    before it failed.  Failing to open the session is retried once.  Stale
+    idle sessions are caught beforehand by the health check.  If the pool
+    has a policy, the policy sets the session timeout and decides whether
+    and when to retry.
+
+    @param name : device name as accepted by gpib_open
+    @type  name : str
+
+    @param func : function taking a SICL session ID as its first argument
+    @type  func : callable
+
+    @param retries : number of times to reopen and repeat a failed call, for
+                     operations which may safely be repeated (keyword,
+                     default 0 or the policy's)
+    @type  retries : int
+
+    @return: whatever func returns
+    """
+    if self.policy is not None:
+      return self.policy.call(self, name, func, *args, **kwargs)
+    retries = kwargs.pop("retries", 0)
+    reopens = 1
+    while True:
+      try:
+        session = self.checkout(name)
+      except Exception:
+        if reopens <= 0:
+          raise
+        reopens -= 1
+        continue
+      try:
+        result = func(session.instr, *args, **kwargs)
+      except Exception:
+        self.checkin(session, broken=True)
+        if retries <= 0:
+          raise
+        retries -= 1
+        continue
+      self.checkin(session)
+      return result
+
+  def close_all(self):
+    """
+    Close all idle sessions.
+    """
+    with self._lock:
+      sessions = [s for idle in self._idle.values() for s in idle]
+      self._idle = {}
+    for session in sessions:
+      self._close(session)
+
+  def __len__(self):
+    with self._lock:
+      return sum(len(idle) for idle in self._idle.values())
+
+session_pool = SessionPool()
@@ -0,0 +1,458 @@
+"""
+Network GPIB proxy, so that many clients share one set of gateway sessions
+
+A ProxyServer owns the SICL sessions and serves the requests of any number
+of clients through the per-bus queues of a BusScheduler, so clients no
+longer contend for bus locks or open sessions of their own.  It listens on
+TCP or on a Unix socket::
+
+  $ python -m Electronics.Interfaces.GPIB.proxy --listen localhost:9488
+  $ GPIB_BACKEND=sim python -m Electronics.Interfaces.GPIB.proxy \\
+      --listen /tmp/gpib.sock
+
+and a client uses the Gpib class of this module in place of GPIB.Gpib::
+
+  >>> from Electronics.Interfaces.GPIB import proxy
+  >>> pm = proxy.Gpib("pm 13-1", proxy.ProxyClient("localhost:9488"))
+  >>> pm.ask("?ID")
+  'HP438A'
+
+With no client given, Gpib uses one shared with other Gpib instances which
+connects to GPIB_PROXY, by default localhost:9488.
+
+The protocol is JSON, one object per line.  A request is::
+
+  {"id": 7, "op": "ask", "device": "pm 13-1", "args": ["?ID"]}
+
+and its reply, which may come after replies to later requests, is::
+
+  {"id": 7, "result": "HP438A"}   or   {"id": 7, "error": "..."}
+
+The operations are ask, write, write_many, writebin, rcv, read, dev_status
+and trigger.  Binary data is sent base64 encoded, in 'data'.
+"""
+import argparse
+import base64
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB.scheduler import BusScheduler
+
+module_logger = logging.getLogger(__name__)
+
+default_address = "localhost:9488"
+"""Address clients connect to if GPIB_PROXY is not set"""
+
+operations = {"ask":        "gpib_prompt",
+              "write":      "gpib_send",
+              "write_many": "gpib_send_many",
+              "writebin":   "gpib_write_raw",
+              "rcv":        "gpib_rcv",
+              "read":       "gpib_read",
+              "dev_status": "gpib_dev_status",
+              "trigger":    "gpib_trigger"}
+"""gpib_ct function serving each operation"""
+
+def parse_address(address):
+  """
+  Socket family and address for 'host:port', a (host, port) pair, or the path
+  of a Unix socket.
+
+  @return: (socket family, address)
+  """
+  if isinstance(address, tuple):
+    return socket.AF_INET, address
+  if address.startswith("unix:"):
+    return socket.AF_UNIX, address[5:]
+  if "/" in address:
+    return socket.AF_UNIX, address
+  host, sep, port = address.rpartition(":")
+  if not sep:
+    raise ValueError("%r is neither host:port nor a socket path" % address)
+  return socket.AF_INET, (host or "localhost", int(port))
+
+def _encode(message):
+  return (json.dumps(message) + "\n").encode("utf-8")
+
+class _Handler(socketserver.StreamRequestHandler):
+  """
+  Serves one client connection
+  """
+  def setup(self):
+    socketserver.StreamRequestHandler.setup(self)
+    self.send_lock = threading.Lock()
+
+  def reply(self, message):
+    try:
+      with self.send_lock:
+        self.wfile.write(_encode(message))
+        self.wfile.flush()
+    except (OSError, ValueError):
+      # the client has gone
+      pass
+
+  def finish_request(self, ident, future):
+    try:
+      result = future.result()
+    except Exception as details:
+      self.server.proxy.stats["errors"] += 1
+      self.reply({"id": ident, "error": "%s" % details})
+      return
+    if isinstance(result, tuple):
+      # gpib_read
+      data, reason, count = result
+      self.reply({"id": ident, "result": count, "reason": reason,
+                  "data": base64.b64encode(data).decode("ascii")})
+    else:
+      self.reply({"id": ident, "result": result})
+
+  def handle(self):
+    proxy = self.server.proxy
+    proxy.stats["connections"] += 1
+    module_logger.debug("ProxyServer: connection from %s", self.client_address)
+    for line in self.rfile:
+      if not line.strip():
+        continue
+      ident = None
+      try:
+        request = json.loads(line.decode("utf-8"))
+        ident = request.get("id")
+        args = list(request.get("args", []))
+        operation = request["op"]
+        if operation == "writebin":
+          args[0] = base64.b64decode(args[0])
+        future = proxy.scheduler.submit(request["device"],
+                                        operations[operation], *args)
+      except Exception as details:
+        proxy.stats["errors"] += 1
+        self.reply({"id": ident, "error": "bad request: %s" % details})
+        continue
+      proxy.stats["requests"] += 1
+      future.add_done_callback(
+        lambda future, ident=ident: self.finish_request(ident, future))
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+  class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+class ProxyServer(object):
+  """
+  Serves GPIB requests from network clients
+
+  Public attributes::
+    address   - address being listened on; a (host, port) pair or a path
+    scheduler - scheduler.BusScheduler serving the requests
+    stats     - dict of counters: connections, requests, errors
+  """
+  def __init__(self, address=default_address, scheduler=None):
+    """
+    @param address : 'host:port', (host, port) or a Unix socket path; port 0
+                     picks a free port
+    @type  address : str or tuple
+
+    @param scheduler : scheduler serving the requests; default a new one
+                       with the shared session pool
+    @type  scheduler : scheduler.BusScheduler
+    """
+    self._own_scheduler = scheduler is None
+    self.scheduler = scheduler or BusScheduler()
+    self.stats = {"connections": 0, "requests": 0, "errors": 0}
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+      if os.path.exists(address):
+        os.unlink(address)
+      self._server = _UnixServer(address, _Handler)
+    else:
+      self._server = _TCPServer(address, _Handler)
+    self._server.proxy = self
+    self.address = self._server.server_address
+    self._thread = None
+
+  def serve_forever(self):
+    """
+    Serve clients until shutdown() is called.
+    """
+    module_logger.info("ProxyServer: listening on %s", self.address)
+    self._server.serve_forever()
+
+  def start(self):
+    """
+    Serve clients on a background thread.
+    """
+    self._thread = threading.Thread(target=self.serve_forever,
+                                    name="GPIB proxy")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def shutdown(self):
+    """
+    Stop serving, and remove the Unix socket.
+
+    A scheduler created by the server is shut down once its queues are empty.
+    """
+    if self._thread is not None:
+      self._server.shutdown()
+      self._thread.join()
+      self._thread = None
+    self._server.server_close()
+    if self._own_scheduler:
+      self.scheduler.shutdown()
+    if isinstance(self.address, str) and os.path.exists(self.address):
+      os.unlink(self.address)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+
+class ProxyClient(object):
+  """
+  Connection to a ProxyServer
+
+  Requests may be sent from many threads at once; each gets its reply
+  through a future.
+
+  Public attributes::
+    address - address of the server
+  """
+  def __init__(self, address=None):
+    """
+    @param address : 'host:port', (host, port) or a Unix socket path; default
+                     GPIB_PROXY or default_address
+    @type  address : str or tuple
+    """
+    self.address = address or os.environ.get("GPIB_PROXY", default_address)
+    family, address = parse_address(self.address)
+    self._socket = socket.socket(family, socket.SOCK_STREAM)
+    self._socket.connect(address)
+    if family == socket.AF_INET:
+      self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._reader = self._socket.makefile("rb")
+    self._ids = itertools.count(1)
+    self._pending = {}
+    self._send_lock = threading.Lock()
+    self._closed = False
+    self._thread = threading.Thread(target=self._receive,
+                                    name="GPIB proxy client")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _receive(self):
+    try:
+      for line in self._reader:
+        reply = json.loads(line.decode("utf-8"))
+        future = self._pending.pop(reply.get("id"), None)
+        if future is None:
+          module_logger.warning("ProxyClient: unexpected reply %r", reply)
+        elif "error" in reply:
+          future.set_exception(RuntimeError(reply["error"]))
+        elif "data" in reply:
+          future.set_result(base64.b64decode(reply["data"]))
+        else:
+          future.set_result(reply["result"])
+    except (OSError, ValueError) as details:
+      if not self._closed:
+        module_logger.error("ProxyClient: connection to %s failed; %s",
+                            self.address, details)
+    with self._send_lock:
+      self._closed = True
+      pending, self._pending = self._pending, {}
+    for future in pending.values():
+      future.set_exception(RuntimeError("connection to %s closed"
+                                        % self.address))
+
+  def submit(self, operation, device, *args):
+    """
+    Send a request.
+
+    @param operation : one of the keys of 'operations'
+    @type  operation : str
+
+    @return: concurrent.futures.Future
+    """
+    future = futures.Future()
+    with self._send_lock:
+      if self._closed:
+        raise RuntimeError("connection to %s closed" % self.address)
+      ident = next(self._ids)
+      self._pending[ident] = future
+      try:
+        self._socket.sendall(_encode({"id": ident, "op": operation,
+                                      "device": device, "args": args}))
+      except OSError:
+        del self._pending[ident]
+        raise
+    return future
+
+  def ask(self, device, command):
+    return self.submit("ask", device, command).result()
+
+  def write(self, device, command):
+    return self.submit("write", device, command).result()
+
+  def write_many(self, device, commands, terminator="\n"):
+    return self.submit("write_many", device, list(commands),
+                       terminator).result()
+
+  def writebin(self, device, data):
+    data = base64.b64encode(bytes(data)).decode("ascii")
+    return self.submit("writebin", device, data).result()
+
+  def rcv(self, device):
+    return self.submit("rcv", device).result()
+
+  def read(self, device, nbytes=512):
+    """
+    Read up to 'nbytes' of raw data.
+
+    @return: bytes
+    """
+    return self.submit("read", device, nbytes).result()
+
+  def dev_status(self, device):
+    return self.submit("dev_status", device).result()
+
+  def trigger(self, device):
+    return self.submit("trigger", device).result()
+
+  def close(self):
+    """
+    Close the connection; requests waiting for replies fail.
+    """
+    with self._send_lock:
+      self._closed = True
+    try:
+      self._socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self._socket.close()
+    self._thread.join()
+    self._reader.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+_client = None
+_client_lock = threading.Lock()
+
+def shared_client():
+  """
+  The ProxyClient shared by Gpib instances created without one.
+  """
+  global _client
+  with _client_lock:
+    if _client is None or _client._closed:
+      _client = ProxyClient()
+    return _client
+
+class Gpib(object):
+  """
+  Stand-in for GPIB.Gpib which sends its requests to a ProxyServer
+
+  Timeouts are those of the server's sessions, so there is no tmo().
+
+  Public attributes::
+    name   - device name or address
+    client - ProxyClient the requests go through
+    count  - bytes moved by the last read or write
+  """
+  def __init__(self, name=None, client=None):
+    if not name:
+      raise RuntimeError("instrument name required")
+    self.name = name
+    self.client = client or shared_client()
+    self.count = 0
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def clear(self):
+    pass
+
+  def ibcnt(self):
+    return self.count
+
+  def ibsta(self):
+    return self.client.dev_status(self.name)
+
+  def read(self, length=512):
+    """
+    Read a response, up to the termination character.
+    """
+    response = self.client.rcv(self.name)
+    self.count = len(response)
+    return response
+
+  def readbin(self, len=512):
+    response = self.client.read(self.name, len)
+    self.count = memoryview(response).nbytes
+    return response
+
+  def rsp(self):
+    return self.client.dev_status(self.name)
+
+  def trigger(self):
+    return self.client.trigger(self.name)
+
+  def write(self, command):
+    return self.client.write(self.name, command)
+
+  def write_many(self, commands, terminator="\n"):
+    self.count = self.client.write_many(self.name, commands, terminator)
+    return self.count
+
+  def writebin(self, data, len=None):
+    if len is not None:
+      data = memoryview(data).cast("B")[:len]
+    self.count = self.client.writebin(self.name, data)
+    return self.count
+
+  def ask(self, command):
+    return self.client.ask(self.name, command)
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Serve GPIB requests from network clients")
+  parser.add_argument("--listen", default=default_address,
+                      help="host:port or Unix socket path (default %s)"
+                           % default_address)
+  parser.add_argument("--backend",
+                      help="GPIB_BACKEND specification; default as set in "
+                           "the environment")
+  parser.add_argument("--log-level", default="INFO")
+  args = parser.parse_args()
+  logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+  if args.backend:
+    from Electronics.Interfaces.GPIB import gpib_ct
+    gpib_ct.use_backend(args.backend)
+  server = ProxyServer(args.listen)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,310 @@
+"""
+Catalog of GPIB devices with precomputed lookups
+
+A DeviceRegistry is loaded from the tables in devices.py, in which a device
+is named by table and key, e.g. "pm 13-1", and from files in the Linux Gpib
+/etc/gpib.conf format, in which a device has a one-word name.  Lookups by
+name, by address, by bus and by gateway are dictionary lookups::
+
+  >>> from Electronics.Interfaces.GPIB.registry import registry
+  >>> registry.address("pm 13-1")
+  'lan[137.228.236.75]:gpib0,16'
+  >>> [d.name for d in registry.on_bus('lan[137.228.236.75]:gpib0')]
+  ['pm 13-1', 'pm 13-2', 'pm 13-4', 'pm 13-5']
+
+This module does not load libsicl.
+"""
+import logging
+import os
+import re
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+
+module_logger = logging.getLogger(__name__)
+
+default_conf = "/etc/gpib.conf"
+
+class Device(object):
+  """
+  A device in the registry
+
+  Public attributes::
+    name      - name used to open the device, e.g. "pm 13-1"
+    address   - SICL address
+    bus       - SICL address of the bus the device is on
+    gateway   - LAN gateway of the bus, or 'local'
+    primary   - primary GPIB address
+    secondary - secondary GPIB address or None
+    type      - instrument type, e.g. '437B', or None
+    info      - description
+    entry     - the dict the device was loaded from
+  """
+  def __init__(self, name, address, entry=None):
+    self.name = name
+    self.address = address
+    self.entry = entry if entry is not None else {"addr": address}
+    gateway, interface, self.primary, self.secondary = gpib_address.parse(
+      address)
+    self.gateway = gateway or "local"
+    self.bus = gpib_address.bus_of(address)
+    self.type = self.entry.get("type")
+    self.info = self.entry.get("info", "")
+
+  @property
+  def alive(self):
+    """
+    False if the device is marked as not working
+    """
+    return self.entry.get("alive", True)
+
+  def __repr__(self):
+    return "Device(%r, %r)" % (self.name, self.address)
+
+class DeviceRegistry(object):
+  """
+  Indexed catalog of devices
+
+  Public attributes::
+    devices - dict of Device by name
+  """
+  def __init__(self):
+    self.devices = {}
+    self._by_address = {}
+    self._by_bus = {}
+    self._by_gateway = {}
+
+  def add(self, name, address, entry=None):
+    """
+    Add a device.
+
+    @param name : name to open the device by
+    @type  name : str
+
+    @param address : SICL address
+    @type  address : str
+
+    @param entry : table entry with 'addr', 'type', 'info', 'alive' keys
+    @type  entry : dict
+
+    @return: Device
+    """
+    name = " ".join(name.split())
+    if name in self.devices:
+      self.remove(name)
+    device = Device(name, address, entry)
+    self.devices[name] = device
+    self._by_address.setdefault(address, []).append(device)
+    self._by_bus.setdefault(device.bus, []).append(device)
+    self._by_gateway.setdefault(device.gateway, []).append(device)
+    return device
+
+  def remove(self, name):
+    """
+    Remove a device.
+    """
+    device = self.devices.pop(name)
+    for index, key in ((self._by_address, device.address),
+                       (self._by_bus, device.bus),
+                       (self._by_gateway, device.gateway)):
+      index[key].remove(device)
+      if not index[key]:
+        del index[key]
+
+  def load_module(self, module):
+    """
+    Add the devices in the tables of a module like devices.py.
+
+    A table is a module-level dict whose values are dicts with an 'addr' key.
+    The device "pm 13-1" is the entry '13-1' of the table 'pm'.
+
+    @return: number of devices added
+    """
+    count = 0
+    for table_name, table in vars(module).items():
+      if table_name.startswith("_") or not isinstance(table, dict):
+        continue
+      for key, entry in table.items():
+        if isinstance(entry, dict) and "addr" in entry:
+          self.add("%s %s" % (table_name, key), entry["addr"], entry)
+          count += 1
+    return count
+
+  def load_conf(self, filename=default_conf, interface="gpib%d"):
+    """
+    Add the devices in a Linux Gpib configuration file.
+
+    The board a device is on is given by its 'minor' number, which is turned
+    into a SICL interface name with the format 'interface'.  Numbers may be
+    written in decimal or, as the Linux Gpib library allows, in 0x
+    hexadecimal or 0 octal.
+
+    @param filename : path of the configuration file
+    @type  filename : str
+
+    @param interface : SICL interface name for a minor number
+    @type  interface : str
+
+    @return: number of devices added
+    """
+    with open(filename) as conf:
+      sections = parse_conf(conf.read())
+    count = 0
+    for kind, settings in sections:
+      if kind != "device" or "name" not in settings:
+        continue
+      bus = interface % _integer(settings.get("minor", "0"))
+      secondary = _integer(settings.get("sad", "0")) or None
+      address = gpib_address.device_address(bus, _integer(settings["pad"]),
+                                            secondary)
+      entry = {"addr": address}
+      entry.update(settings)
+      self.add(settings["name"], address, entry)
+      count += 1
+    return count
+
+  def __contains__(self, name):
+    return " ".join(name.split()) in self.devices
+
+  def __len__(self):
+    return len(self.devices)
+
+  def __iter__(self):
+    return iter(self.devices.values())
+
+  def get(self, name):
+    """
+    The Device of that name.
+    """
+    return self.devices[" ".join(name.split())]
+
+  def address(self, name):
+    """
+    SICL address for a device name; an address is returned unchanged.
+
+    @param name : device name or SICL address
+    @type  name : str
+
+    @return: str
+    """
+    device = self.devices.get(name)
+    if device:
+      return device.address
+    if " " in name:
+      try:
+        return self.get(name).address
+      except KeyError:
+        raise KeyError("no device named %r" % name)
+    return name
+
+  def at_address(self, address):
+    """
+    Devices with the given SICL address.
+    """
+    return list(self._by_address.get(address, []))
+
+  def on_bus(self, bus):
+    """
+    Devices on the bus with the given SICL interface address.
+    """
+    return list(self._by_bus.get(bus, []))
+
+  def on_gateway(self, gateway):
+    """
+    Devices on the buses of a LAN gateway.
+    """
+    return list(self._by_gateway.get(gateway, []))
+
+  def buses(self):
+    """
+    SICL addresses of all buses with devices.
+    """
+    return sorted(self._by_bus)
+
+  def gateways(self):
+    """
+    All gateways with devices.
+    """
+    return sorted(self._by_gateway)
+
+  def group_by_gateway(self, names):
+    """
+    Sort device names or addresses by the gateway they are on.
+
+    @return: {gateway: [name, ...]}
+    """
+    groups = {}
+    for name in names:
+      gateway = gpib_address.gateway_of(self.address(name))
+      groups.setdefault(gateway, []).append(name)
+    return groups
+
+  def group_by_bus(self, names):
+    """
+    Sort device names or addresses by the bus they are on.
+
+    @return: {bus: [name, ...]}
+    """
+    groups = {}
+    for name in names:
+      groups.setdefault(gpib_address.bus_of(self.address(name)),
+                        []).append(name)
+    return groups
+
+  def update_alive(self, results):
+    """
+    Set the 'alive' flags of devices from scanner.BusScanner results.
+
+    @return: list of names of devices updated
+    """
+    updated = []
+    for bus_results in results.values():
+      for result in bus_results.values():
+        for device in self._by_address.get(result.address, []):
+          device.entry["alive"] = result.alive
+          updated.append(device.name)
+    return updated
+
+_comment = re.compile(r"/\*.*?\*/", re.S)
+_section = re.compile(r"(\w+)\s*\{([^}]*)\}", re.S)
+_setting = re.compile(r"([\w-]+)\s*=\s*(\"[^\"]*\"|[^\s]+)")
+
+def _integer(text):
+  """
+  An integer written as in C, in decimal, 0x hexadecimal or 0 octal
+  """
+  text = text.strip()
+  if len(text) > 1 and text.startswith("0") and text.isdigit():
+    return int(text, 8)
+  return int(text, 0)
+
+def parse_conf(text):
+  """
+  Parse the text of a Linux Gpib configuration file.
+
+  @return: list of (section kind, {setting: value}) in file order
+  """
+  text = _comment.sub("", text)
+  sections = []
+  for kind, body in _section.findall(text):
+    settings = {}
+    for key, value in _setting.findall(body):
+      settings[key] = value.strip('"')
+    sections.append((kind, settings))
+  return sections
+
+def default_registry():
+  """
+  A registry of the devices in devices.py and, if it exists, /etc/gpib.conf
+  """
+  from Electronics.Interfaces.GPIB import devices
+  new = DeviceRegistry()
+  new.load_module(devices)
+  if os.path.exists(default_conf):
+    try:
+      new.load_conf(default_conf)
+    except Exception as details:
+      module_logger.warning("default_registry: cannot load %s; %s",
+                            default_conf, details)
+  return new
+
+registry = default_registry()
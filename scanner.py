@@ -0,0 +1,181 @@
+"""
+Concurrent scan of GPIB buses for responding devices
+
+Every address on a bus is serially polled with a short timeout.  Buses on
+different gateways are scanned at the same time, and at most 'per_gateway'
+probes are outstanding on any one gateway::
+
+  >>> from Electronics.Interfaces.GPIB import devices, scanner
+  >>> results = scanner.BusScanner().scan(devices.bus)
+  >>> results["DSS13-3"][16]
+  ProbeResult('lan[137.228.236.75]:gpib0,16', status=0, latency=0.012)
+  >>> scanner.update_alive(results, devices.pm)
+"""
+import logging
+import time
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+
+module_logger = logging.getLogger(__name__)
+
+class ProbeResult(object):
+  """
+  Outcome of probing one GPIB address
+
+  Public attributes::
+    address - SICL address probed
+    status  - status byte, or None if the device did not respond
+    idn     - response to '*IDN?', or None
+    latency - seconds taken by the serial poll
+    error   - text of the exception if the device did not respond
+  """
+  def __init__(self, address, status=None, idn=None, latency=None,
+               error=None):
+    self.address = address
+    self.status = status
+    self.idn = idn
+    self.latency = latency
+    self.error = error
+
+  @property
+  def alive(self):
+    return self.status is not None
+
+  def __repr__(self):
+    if self.alive:
+      return "ProbeResult(%r, status=%d, latency=%.3f)" % (
+        self.address, self.status, self.latency)
+    return "ProbeResult(%r, error=%r)" % (self.address, self.error)
+
+def probe(address, timeout=200, identify=True, driver=None):
+  """
+  Serial poll one address and, if it answers, ask for its identity.
+
+  @param address : SICL device address
+  @type  address : str
+
+  @param timeout : I/O timeout in milliseconds
+  @type  timeout : int
+
+  @param identify : send '*IDN?' to devices which respond
+  @type  identify : bool
+
+  @param driver : module providing the gpib_* functions; default gpib_ct
+  @type  driver : module
+
+  @return: ProbeResult
+  """
+  if driver is None:
+    from Electronics.Interfaces.GPIB import gpib_ct as driver
+  result = ProbeResult(address)
+  try:
+    instr = driver.gpib_open(address)
+  except Exception as details:
+    result.error = str(details)
+    return result
+  try:
+    driver.gpib_timeout(instr, timeout)
+    start = time.time()
+    result.status = int(driver.gpib_dev_status(instr))
+    result.latency = time.time() - start
+    if identify:
+      try:
+        result.idn = driver.gpib_prompt(instr, "*IDN?").strip() or None
+      except Exception as details:
+        module_logger.debug("probe: %s has no *IDN?; %s", address, details)
+  except Exception as details:
+    result.error = str(details)
+  finally:
+    try:
+      driver.gpib_close(instr)
+    except Exception as details:
+      module_logger.debug("probe: closing %s failed; %s", address, details)
+  return result
+
+class BusScanner(object):
+  """
+  Probes GPIB addresses on many buses in parallel
+
+  Public attributes::
+    per_gateway - maximum concurrent probes on one LAN gateway
+    timeout     - probe timeout in milliseconds
+    identify    - whether to ask responding devices for '*IDN?'
+    addresses   - primary addresses to probe
+    skip        - primary addresses not probed, e.g. the controller's
+  """
+  def __init__(self, per_gateway=4, timeout=200, identify=True,
+               addresses=range(1, 31), skip=(21,), driver=None):
+    self.per_gateway = per_gateway
+    self.timeout = timeout
+    self.identify = identify
+    self.addresses = [a for a in addresses if a not in skip]
+    self.skip = skip
+    self.driver = driver
+
+  def _probe(self, address):
+    return probe(address, self.timeout, self.identify, self.driver)
+
+  def scan(self, buses):
+    """
+    Probe every address on every bus.
+
+    @param buses : bus addresses keyed by name, like devices.bus, or a list
+    @type  buses : dict or list
+
+    @return: {bus name: {primary address: ProbeResult}}
+    """
+    if not hasattr(buses, "items"):
+      buses = dict((bus, bus) for bus in buses)
+    pools = {}
+    pending = {}
+    try:
+      for name, bus in buses.items():
+        gateway = gpib_address.gateway_of(bus)
+        if gateway not in pools:
+          pools[gateway] = futures.ThreadPoolExecutor(self.per_gateway)
+        for primary in self.addresses:
+          address = gpib_address.device_address(bus, primary)
+          pending[pools[gateway].submit(self._probe, address)] = (name,
+                                                                  primary)
+      results = dict((name, {}) for name in buses)
+      for future in futures.as_completed(pending):
+        name, primary = pending[future]
+        results[name][primary] = future.result()
+    finally:
+      for pool in pools.values():
+        pool.shutdown(wait=False)
+    return results
+
+  def scan_bus(self, bus):
+    """
+    Probe every address on one bus.
+
+    @return: {primary address: ProbeResult}
+    """
+    return self.scan([bus])[bus]
+
+def update_alive(results, table):
+  """
+  Set the 'alive' flag of entries in a device table from scan results.
+
+  Entries whose address was not scanned are left alone.
+
+  @param results : as returned by BusScanner.scan
+  @type  results : dict
+
+  @param table : device table like devices.pm
+  @type  table : dict
+
+  @return: list of keys whose flag was set
+  """
+  found = {}
+  for bus_results in results.values():
+    for result in bus_results.values():
+      found[result.address] = result.alive
+  updated = []
+  for key, entry in table.items():
+    if entry["addr"] in found:
+      entry["alive"] = found[entry["addr"]]
+      updated.append(key)
+  return updated
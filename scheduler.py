@@ -0,0 +1,326 @@
+"""
+Per-bus transaction scheduler
+
+A GPIB bus carries one transaction at a time.  Rather than have threads
+contend for a bus through SICL locks, a BusScheduler gives every bus (gateway
+and interface) its own queue and worker thread.  Requests are served in order
+of priority, then deadline, then arrival; different buses run in parallel::
+
+  >>> from Electronics.Interfaces.GPIB.scheduler import scheduler
+  >>> f1 = scheduler.ask("pm 13-1", "TR2", priority=1)
+  >>> f2 = scheduler.ask("pm 13-4", "TR2", deadline=0.5)
+  >>> f1.result(), f2.result()
+
+A query (ask or status) identical to one which is queued or in progress is
+not sent again; the caller gets a future of its own for the same response,
+which it may cancel without affecting the other callers.  The query is then
+served at the highest priority and latest deadline of its callers, and
+fails with DeadlineExceeded only for those whose own deadline has passed.
+A request whose deadline passes before it reaches the bus fails with
+DeadlineExceeded.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+coalesced_operations = ("gpib_prompt", "gpib_dev_status")
+"""gpib_ct operations which may be shared between identical requests"""
+
+class DeadlineExceeded(RuntimeError):
+  """
+  The request's deadline passed before it could be sent
+  """
+  pass
+
+class _Request(object):
+  def __init__(self, sequence, address, operation, args, priority, deadline):
+    self.sequence = sequence
+    self.address = address
+    self.operation = operation
+    self.args = args
+    self.priority = priority
+    self.deadline = deadline
+    self.enqueued = time.time()
+    self.callers = [(futures.Future(), deadline)]
+    self.key = None
+
+  def join(self, priority, deadline):
+    """
+    Add a caller; the request takes on its priority and deadline if later.
+
+    @return: the caller's future
+    """
+    future = futures.Future()
+    self.callers.append((future, deadline))
+    self.priority = max(self.priority, priority)
+    if self.deadline is not None:
+      self.deadline = None if deadline is None else max(self.deadline,
+                                                        deadline)
+    return future
+
+  def sort_key(self):
+    if self.deadline is None:
+      return (-self.priority, float("inf"), self.sequence)
+    return (-self.priority, self.deadline, self.sequence)
+
+  def __lt__(self, other):
+    return self.sort_key() < other.sort_key()
+
+class _BusQueue(object):
+  """
+  Queue, worker and statistics of one bus
+  """
+  def __init__(self, bus):
+    self.bus = bus
+    self.heap = []
+    self.ready = threading.Condition()
+    self.worker = None
+    self.served = 0
+    self.expired = 0
+    self.failed = 0
+    self.coalesced = 0
+    self.total_wait = 0.
+    self.max_wait = 0.
+    self.busy = 0.
+
+class BusScheduler(object):
+  """
+  Serves GPIB requests through one queue per bus
+
+  Public attributes::
+    pool - session pool supplying device sessions
+  """
+  def __init__(self, pool=None, driver=None):
+    """
+    @param pool : session pool; default the shared pool
+    @type  pool : pool.SessionPool
+
+    @param driver : module providing the gpib_* functions; default gpib_ct
+    @type  driver : module
+    """
+    self.pool = pool or session_pool
+    self._driver = driver
+    self._queues = {}
+    self._inflight = {}
+    self._lock = threading.Lock()
+    self._sequence = itertools.count()
+    self._running = True
+
+  @property
+  def driver(self):
+    if self._driver is None:
+      from Electronics.Interfaces.GPIB import gpib_ct
+      self._driver = gpib_ct
+    return self._driver
+
+  def _queue(self, bus):
+    """
+    The queue for a bus, starting its worker if necessary.
+
+    Must be called with the scheduler lock held.
+    """
+    queue = self._queues.get(bus)
+    if queue is None:
+      queue = self._queues[bus] = _BusQueue(bus)
+    if queue.worker is None:
+      queue.worker = threading.Thread(target=self._serve, args=(queue,),
+                                      name="GPIB %s" % bus)
+      queue.worker.daemon = True
+      queue.worker.start()
+    return queue
+
+  def submit(self, device, operation, *args, **kwargs):
+    """
+    Queue an operation on a device.
+
+    @param device : device name or SICL address
+    @type  device : str
+
+    @param operation : name of a gpib_ct function taking the session ID as its
+                       first argument, or such a function
+    @type  operation : str or callable
+
+    @param priority : larger is served sooner (keyword, default 0)
+    @type  priority : int
+
+    @param deadline : seconds from now by which the request must be sent
+                      (keyword, default None for no deadline)
+    @type  deadline : float
+
+    @return: concurrent.futures.Future
+    """
+    priority = kwargs.pop("priority", 0)
+    deadline = kwargs.pop("deadline", None)
+    if kwargs:
+      raise TypeError("unexpected keywords %s" % ", ".join(kwargs))
+    if not self._running:
+      raise RuntimeError("scheduler has been shut down")
+    address = registry.address(device)
+    bus = gpib_address.bus_of(address)
+    if deadline is not None:
+      deadline = time.time() + deadline
+    key = None
+    if operation in coalesced_operations:
+      key = (address, operation, args)
+    with self._lock:
+      queue = self._queue(bus)
+      if key in self._inflight:
+        queue.coalesced += 1
+        request = self._inflight[key]
+        with queue.ready:
+          future = request.join(priority, deadline)
+          # its place in the queue may have changed
+          heapq.heapify(queue.heap)
+        return future
+      request = _Request(next(self._sequence), address, operation, args,
+                         priority, deadline)
+      if key:
+        request.key = key
+        self._inflight[key] = request
+    with queue.ready:
+      heapq.heappush(queue.heap, request)
+      queue.ready.notify()
+    return request.callers[0][0]
+
+  def ask(self, device, command, **kwargs):
+    """
+    Queue a query; the future's result is the response.
+    """
+    return self.submit(device, "gpib_prompt", command, **kwargs)
+
+  def write(self, device, command, **kwargs):
+    """
+    Queue a command.
+    """
+    return self.submit(device, "gpib_send", command, **kwargs)
+
+  def dev_status(self, device, **kwargs):
+    """
+    Queue a serial poll; the future's result is the status byte.
+    """
+    return self.submit(device, "gpib_dev_status", **kwargs)
+
+  def _start(self, request, now):
+    """
+    Mark the request's futures running, dropping those cancelled.
+
+    @return: the callers whose deadlines have passed
+    """
+    with self._lock:
+      callers = [(future, deadline) for future, deadline in request.callers
+                 if future.set_running_or_notify_cancel()]
+      request.callers = [(future, deadline) for future, deadline in callers
+                         if deadline is None or now <= deadline]
+      return [future for future, deadline in callers
+              if deadline is not None and now > deadline]
+
+  def _finish(self, request, result=None, exception=None):
+    """
+    Stop coalescing with the request and give every caller its outcome.
+    """
+    if request.key:
+      with self._lock:
+        if self._inflight.get(request.key) is request:
+          del self._inflight[request.key]
+    for future, deadline in request.callers:
+      try:
+        if exception is None:
+          future.set_result(result)
+        else:
+          future.set_exception(exception)
+      except futures.InvalidStateError:
+        # a caller which joined while the request was running cancelled it
+        pass
+
+  def _serve(self, queue):
+    """
+    Worker loop for one bus.
+    """
+    while True:
+      with queue.ready:
+        while not queue.heap and self._running:
+          queue.ready.wait()
+        if not queue.heap:
+          return
+        request = heapq.heappop(queue.heap)
+      now = time.time()
+      late = self._start(request, now)
+      if not request.callers and not late:
+        # every caller cancelled
+        self._finish(request)
+        continue
+      wait = now - request.enqueued
+      queue.total_wait += wait
+      queue.max_wait = max(queue.max_wait, wait)
+      if late:
+        expired = DeadlineExceeded("%s waited %.3f s for %s"
+                                   % (request.address, wait, queue.bus))
+        for future in late:
+          future.set_exception(expired)
+      if not request.callers:
+        queue.expired += 1
+        self._finish(request)
+        continue
+      operation = request.operation
+      if not callable(operation):
+        operation = getattr(self.driver, operation)
+      try:
+        result = self.pool.call(request.address, operation, *request.args)
+      except Exception as details:
+        queue.failed += 1
+        self._finish(request, exception=details)
+      else:
+        self._finish(request, result)
+      queue.served += 1
+      queue.busy += time.time() - now
+
+  def metrics(self):
+    """
+    Statistics for each bus.
+
+    @return: {bus: {'depth', 'served', 'failed', 'expired', 'coalesced',
+                    'mean_wait', 'max_wait', 'busy'}} with times in seconds
+    """
+    result = {}
+    with self._lock:
+      queues = list(self._queues.values())
+    for queue in queues:
+      with queue.ready:
+        depth = len(queue.heap)
+      started = queue.served + queue.expired
+      result[queue.bus] = {
+        "depth": depth,
+        "served": queue.served,
+        "failed": queue.failed,
+        "expired": queue.expired,
+        "coalesced": queue.coalesced,
+        "mean_wait": queue.total_wait/started if started else 0.,
+        "max_wait": queue.max_wait,
+        "busy": queue.busy}
+    return result
+
+  def shutdown(self, wait=True):
+    """
+    Stop accepting requests and stop the workers once their queues are empty.
+    """
+    self._running = False
+    with self._lock:
+      queues = list(self._queues.values())
+    for queue in queues:
+      with queue.ready:
+        queue.ready.notify_all()
+    if wait:
+      for queue in queues:
+        if queue.worker:
+          queue.worker.join()
+
+scheduler = BusScheduler()
@@ -0,0 +1,576 @@
+"""
+Simulated GPIB instruments
+
+SimBackend stands in for SICL so that polling services can be load tested,
+and the overhead of this package measured, without hardware.  Each simulated
+instrument answers scripted commands after a configurable delay, and every
+transaction occupies its bus for the bus turnaround time plus the command
+latency plus the transfer time of the message, so devices sharing a bus
+contend as they would on a real one::
+
+  >>> from Electronics.Interfaces.GPIB import gpib_ct, sim
+  >>> backend = sim.SimBackend.from_registry()
+  >>> backend.instruments['lan[137.228.236.75]:gpib0,16'].latency = 0.05
+  >>> gpib_ct.use_backend(backend)
+
+or set GPIB_BACKEND=sim.  The models of the power meters in devices.pm are
+rough; the latencies are typical of a reading with the default filtering.
+"""
+import itertools
+import logging
+import random
+import threading
+import time
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.backends import Backend, \
+     I_TERM_MAXCNT, I_TERM_END, I_BUF_WRITE
+
+module_logger = logging.getLogger(__name__)
+
+RQS = 0x40
+"""Request service bit of the status byte"""
+
+class SimInstrument(object):
+  """
+  A scriptable simulated instrument
+
+  A command is looked up in 'responses'.  A response may be bytes, str or a
+  function of the command returning either; None means the command is not a
+  query and produces no output.  Commands not in 'responses' are answered by
+  'default' in the same way.
+
+  Public attributes::
+    model     - instrument type
+    responses - dict of responses by command
+    default   - response to commands not in 'responses'
+    latency   - seconds the instrument takes to act on a command
+    latencies - dict of latencies by command, overriding 'latency'
+    stb       - status byte
+    alive     - False if the instrument does not respond at all
+    output    - bytes waiting to be read
+    commands  - number of commands received
+    triggers  - number of triggers received
+    srq_after_trigger - if not None, seconds after a trigger at which the
+                instrument requests service
+    trigger_command - command the instrument acts on when triggered, e.g.
+                to take a reading, or None
+    ready     - time at which the instrument finishes acting on a trigger;
+                it holds off the bus until then
+  """
+  def __init__(self, model="generic", responses=None, default=None,
+               latency=0.001, latencies=None, stb=0, alive=True,
+               srq_after_trigger=None, trigger_command=None):
+    self.model = model
+    self.responses = dict(responses or {})
+    self.default = default
+    self.latency = latency
+    self.latencies = dict(latencies or {})
+    self.stb = stb
+    self.alive = alive
+    self.output = b""
+    self.commands = 0
+    self.triggers = 0
+    self.srq_after_trigger = srq_after_trigger
+    self.trigger_command = trigger_command
+    self.ready = 0.
+    self._lock = threading.Lock()
+
+  def script(self, command, response=None, latency=None, size=None):
+    """
+    Set the response to a command.
+
+    @param command : command as received, without terminator
+    @type  command : str
+
+    @param response : bytes, str, function of the command, or None
+    @type  response : object
+
+    @param latency : seconds taken to act on the command
+    @type  latency : float
+
+    @param size : if given, respond with this many bytes of comma separated
+                  numbers instead of 'response'
+    @type  size : int
+    """
+    if size is not None:
+      response = numeric_list(size)
+    self.responses[command] = response
+    if latency is not None:
+      self.latencies[command] = latency
+
+  def latency_of(self, command):
+    return self.latencies.get(command, self.latency)
+
+  def receive(self, command):
+    """
+    Act on a command, queueing any response for output.
+
+    @param command : bytes received
+    @type  command : bytes
+
+    @return: seconds taken by the instrument
+    """
+    text = command.decode("latin-1").strip()
+    response = self.responses.get(text, self.default)
+    if callable(response):
+      response = response(text)
+    with self._lock:
+      self.commands += 1
+      if response is not None:
+        if not isinstance(response, bytes):
+          response = response.encode("latin-1")
+        self.output = response + b"\n"
+    return self.latency_of(text)
+
+  def send(self, nbytes=None, line=False):
+    """
+    Take bytes from the output queue.
+
+    @param nbytes : maximum number of bytes; default all
+    @type  nbytes : int
+
+    @param line : stop after the first newline
+    @type  line : bool
+
+    @return: (bytes, True if the output queue is now empty)
+    """
+    with self._lock:
+      end = len(self.output)
+      if line and b"\n" in self.output:
+        end = self.output.index(b"\n") + 1
+      if nbytes is not None:
+        end = min(end, nbytes)
+      data, self.output = self.output[:end], self.output[end:]
+      return data, not self.output
+
+  def trigger(self):
+    """
+    Act on a group execute trigger.
+    """
+    with self._lock:
+      self.triggers += 1
+    if self.trigger_command is not None:
+      self.ready = time.time() + self.receive(self.trigger_command.encode())
+
+  def serial_poll(self):
+    """
+    The status byte, clearing its RQS bit as a serial poll does.
+    """
+    with self._lock:
+      stb = self.stb
+      self.stb &= ~RQS
+      return stb
+
+def numeric_list(size):
+  """
+  About 'size' bytes of comma separated readings.
+  """
+  values = []
+  total = 0
+  while total < size:
+    value = "%+.5E" % random.gauss(-30., 1.)
+    values.append(value)
+    total += len(value) + 1
+  return ",".join(values).encode("latin-1")[:size]
+
+def reading(mean=-30., sigma=0.01):
+  """
+  A function giving a noisy power reading as a power meter formats it
+  """
+  def read(command):
+    return "%+.4E" % random.gauss(mean, sigma)
+  return read
+
+def hp437b():
+  """
+  HP 437B power meter; not IEEE 488.2, so it does not know '*IDN?'
+  """
+  return SimInstrument("437B", responses={"?ID": "HP437B", "TR0": None,
+                                          "TR3": None},
+                       default=reading(), latency=0.02,
+                       latencies={"?ID": 0.005, "TR0": 0.001, "TR3": 0.001},
+                       trigger_command="TR2")
+
+def hp438a():
+  """
+  HP 438A dual channel power meter
+  """
+  return SimInstrument("438", responses={"?ID": "HP438A", "TR0": None,
+                                         "TR3": None},
+                       default=reading(), latency=0.03,
+                       latencies={"?ID": 0.005, "TR0": 0.001, "TR3": 0.001},
+                       trigger_command="TR2")
+
+def e4418b():
+  """
+  Agilent E4418B SCPI power meter
+  """
+  meter = SimInstrument("E4418B", latency=0.002, trigger_command="*TRG")
+  meter.script("*IDN?", "Agilent Technologies,E4418B,GB00000000,A1.01.00")
+  meter.script("TRIG:SOUR BUS;INIT")
+  meter.script("TRIG:SOUR IMM;INIT:CONT ON")
+  meter.script("*TRG", latency=0.05)
+  for query, latency in (("FETC?", 0.005), ("READ?", 0.05),
+                         ("MEAS?", 0.05)):
+    meter.script(query, reading(), latency)
+  return meter
+
+models = {"437B": hp437b, "438": hp438a, "E4418B": e4418b}
+"""Functions creating simulated instruments by device type"""
+
+class _SimSession(object):
+  def __init__(self, instr, address):
+    self.instr = instr
+    self.address = address
+    self.bus = gpib_address.bus_of(address)
+    self.interface = gpib_address.parse(address)[2] is None
+    self.timeout = 10000
+    self.write_buffer = bytearray()
+    self.write_size = 128
+
+class SimBackend(Backend):
+  """
+  Backend with simulated instruments
+
+  Public attributes::
+    instruments  - dict of SimInstrument by SICL address
+    turnaround   - seconds of bus overhead for every transaction
+    open_latency - seconds taken to open a session
+    rate         - bus transfer rate in bytes/s
+    busy         - dict of seconds each bus has been in use, by bus address
+    transactions - dict of numbers of transactions, by bus address
+
+  SRQ handlers are called in the thread of service_request() unless
+  interrupts are off, when they are held for waithdlr().  An interface session
+  (an address without a device) may address listeners with sendcmd() and
+  trigger them all at once; locking it keeps device sessions off its bus.
+  """
+  def __init__(self, instruments=None, turnaround=0.0005, open_latency=0.,
+               rate=500e3):
+    self.instruments = dict(instruments or {})
+    self.turnaround = turnaround
+    self.open_latency = open_latency
+    self.rate = rate
+    self.busy = {}
+    self.transactions = {}
+    self._sessions = {}
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._bus_locks = {}
+    self._owners = {}
+    self._owner_changed = threading.Condition(self._lock)
+    self._handlers = {}
+    self._interrupts = True
+    self._pending = []
+    self._handler_ready = threading.Condition(self._lock)
+    self._listeners = {}
+
+  @classmethod
+  def from_registry(cls, registry=None, **kwargs):
+    """
+    A SimBackend with an instrument for each device in the registry.
+
+    Devices of a type in 'models' get that model; others get a generic
+    instrument which answers every command with '0'.  Devices marked as not
+    alive do not respond.
+    """
+    if registry is None:
+      from Electronics.Interfaces.GPIB.registry import registry
+    backend = cls(**kwargs)
+    for device in registry:
+      if device.address in backend.instruments:
+        continue
+      if device.type in models:
+        instrument = models[device.type]()
+      else:
+        instrument = SimInstrument(device.type or "generic", default="0")
+      instrument.alive = device.alive
+      backend.add(device.address, instrument)
+    return backend
+
+  def add(self, address, instrument):
+    """
+    Attach a simulated instrument at a SICL address.
+    """
+    self.instruments[address] = instrument
+    return instrument
+
+  def _session(self, instr):
+    try:
+      return self._sessions[instr]
+    except KeyError:
+      raise RuntimeError("invalid session %r" % instr)
+
+  def _bus_lock(self, bus):
+    with self._lock:
+      if bus not in self._bus_locks:
+        self._bus_locks[bus] = threading.Lock()
+      return self._bus_locks[bus]
+
+  def _wait_for_owner(self, session, owned):
+    """
+    Wait until owned() is true, for up to the session's timeout, where a
+    timeout of 0 means for ever as in SICL.
+
+    Must be called with the backend lock held.
+    """
+    deadline = (time.time() + session.timeout/1000. if session.timeout
+                else None)
+    while not owned():
+      remaining = None if deadline is None else deadline - time.time()
+      if not self._owner_changed.wait(remaining) and not owned():
+        raise RuntimeError("%s is locked" % session.address)
+
+  def _timed_out(self, session):
+    time.sleep(session.timeout/1000.)
+    raise RuntimeError("timeout on %s" % session.address)
+
+  def _transact(self, instr, action, interface=False):
+    """
+    Carry out action(instrument) as one bus transaction.
+
+    'action' returns (result, seconds taken by the instrument, bytes moved).
+    On an interface session it is given None, and it must be one allowed
+    there, as 'interface' says.
+    """
+    session = self._session(instr)
+    if session.interface and not interface:
+      raise RuntimeError("operation not supported on interface session %s"
+                         % session.address)
+    with self._lock:
+      self._wait_for_owner(session, lambda: (
+        self._owners.get(session.address, instr) == instr and
+        self._owners.get(session.bus, instr) == instr))
+    instrument = self.instruments.get(session.address)
+    with self._bus_lock(session.bus):
+      start = time.time()
+      if session.interface:
+        result, latency, nbytes = action(None)
+      else:
+        # addressing the device unaddresses the listeners of a sendcmd
+        self._listeners.pop(session.bus, None)
+        if instrument is None or not instrument.alive:
+          self._timed_out(session)
+        time.sleep(max(0., instrument.ready - start))
+        result, latency, nbytes = action(instrument)
+      time.sleep(self.turnaround + latency + nbytes/self.rate)
+      with self._lock:
+        self.busy[session.bus] = (self.busy.get(session.bus, 0.)
+                                  + time.time() - start)
+        self.transactions[session.bus] = (
+          self.transactions.get(session.bus, 0) + 1)
+    return result
+
+  def open(self, address):
+    if isinstance(address, bytes):
+      address = address.decode("latin-1")
+    time.sleep(self.open_latency)
+    with self._lock:
+      instr = next(self._ids)
+      self._sessions[instr] = _SimSession(instr, address)
+    return instr
+
+  def close(self, instr):
+    with self._lock:
+      self._handlers.pop(instr, None)
+      session = self._sessions.pop(instr, None)
+      if session and self._owners.get(session.address) == instr:
+        del self._owners[session.address]
+        self._owner_changed.notify_all()
+    return 0
+
+  def timeout(self, instr, milliseconds):
+    self._session(instr).timeout = milliseconds
+    return 0
+
+  def write(self, instr, data):
+    def action(instrument):
+      return 0, instrument.receive(data), len(data)
+    return self._transact(instr, action)
+
+  def setbuf(self, instr, size, mask=I_BUF_WRITE):
+    if mask & I_BUF_WRITE:
+      self._session(instr).write_size = size
+    return 0
+
+  def fwrite(self, instr, data, end=False):
+    session = self._session(instr)
+    session.write_buffer += data
+    if end or len(session.write_buffer) >= session.write_size:
+      self.flush(instr)
+    return len(data)
+
+  def flush(self, instr, mask=I_BUF_WRITE):
+    session = self._session(instr)
+    if not mask & I_BUF_WRITE or not session.write_buffer:
+      return 0
+    data = bytes(session.write_buffer)
+    del session.write_buffer[:]
+    def action(instrument):
+      latency = 0.
+      for line in data.splitlines(True):
+        latency += instrument.receive(line)
+      return 0, latency, len(data)
+    return self._transact(instr, action)
+
+  def write_raw(self, instr, data, end=True):
+    data = bytes(data)
+    def action(instrument):
+      return len(data), instrument.receive(data), len(data)
+    return self._transact(instr, action)
+
+  def scan(self, instr, format=b"%t"):
+    session = self._session(instr)
+    def action(instrument):
+      data, empty = instrument.send(line=True)
+      if not data:
+        self._timed_out(session)
+      return data, 0., len(data)
+    return self._transact(instr, action)
+
+  def read(self, instr, buffer):
+    session = self._session(instr)
+    def action(instrument):
+      data, empty = instrument.send(buffer.nbytes)
+      if not data:
+        self._timed_out(session)
+      buffer[:len(data)] = data
+      reason = I_TERM_END if empty else I_TERM_MAXCNT
+      return (len(data), reason), 0., len(data)
+    return self._transact(instr, action)
+
+  def prompt(self, instr, data):
+    session = self._session(instr)
+    def action(instrument):
+      latency = instrument.receive(data)
+      response, empty = instrument.send(line=True)
+      if not response:
+        self._timed_out(session)
+      return response, latency, len(data) + len(response)
+    return self._transact(instr, action)
+
+  def readstb(self, instr):
+    def action(instrument):
+      return instrument.serial_poll(), 0., 1
+    return self._transact(instr, action)
+
+  def _triggered(self, address, instrument):
+    instrument.trigger()
+    if instrument.srq_after_trigger is not None:
+      timer = threading.Timer(instrument.srq_after_trigger,
+                              self.service_request, (address,))
+      timer.daemon = True
+      timer.start()
+
+  def trigger(self, instr):
+    session = self._session(instr)
+    def action(instrument):
+      if not session.interface:
+        self._triggered(session.address, instrument)
+        return 0, 0., 1
+      # every listener sees the one GET at the same time
+      for address in self._listeners.get(session.bus, ()):
+        instrument = self.instruments.get(address)
+        if instrument is not None and instrument.alive:
+          self._triggered(address, instrument)
+      return 0, 0., 1
+    return self._transact(instr, action, True)
+
+  def sendcmd(self, instr, data):
+    session = self._session(instr)
+    if not session.interface:
+      raise RuntimeError("%s is not an interface session" % session.address)
+    def action(instrument):
+      self._listeners[session.bus] = gpib_address.listeners(
+        session.bus, data, self._listeners.get(session.bus, ()))
+      return 0, 0., len(data)
+    return self._transact(instr, action, True)
+
+  def service_request(self, address, status=0):
+    """
+    Make the instrument at 'address' request service.
+
+    @param status : status bits to set along with RQS
+    @type  status : int
+    """
+    instrument = self.instruments[address]
+    with instrument._lock:
+      instrument.stb |= RQS | status
+    with self._lock:
+      calls = [(instr, handler) for instr, handler in self._handlers.items()
+               if self._sessions[instr].address == address]
+      if not self._interrupts:
+        self._pending.extend(calls)
+        self._handler_ready.notify_all()
+        return
+    for instr, handler in calls:
+      handler(instr)
+
+  def onsrq(self, instr, handler):
+    self._session(instr)
+    with self._lock:
+      if handler is None:
+        self._handlers.pop(instr, None)
+      else:
+        self._handlers[instr] = handler
+    return 0
+
+  def _next_pending(self):
+    """
+    The next held handler call whose handler is still installed, or None.
+    """
+    while self._pending:
+      instr, handler = self._pending.pop(0)
+      if self._handlers.get(instr) is handler:
+        return instr, handler
+    return None
+
+  def waithdlr(self, milliseconds):
+    with self._lock:
+      deadline = time.time() + milliseconds/1000. if milliseconds else None
+      call = self._next_pending()
+      while call is None:
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._handler_ready.wait(remaining)
+        call = self._next_pending()
+    instr, handler = call
+    handler(instr)
+    return True
+
+  def introff(self):
+    with self._lock:
+      self._interrupts = False
+    return 0
+
+  def intron(self):
+    with self._lock:
+      self._interrupts = True
+      pending, self._pending = self._pending, []
+    for instr, handler in pending:
+      handler(instr)
+    return 0
+
+  def lock(self, instr):
+    session = self._session(instr)
+    with self._lock:
+      self._wait_for_owner(
+        session, lambda: self._owners.get(session.address, instr) == instr)
+      self._owners[session.address] = instr
+    return 0
+
+  def unlock(self, instr):
+    session = self._session(instr)
+    with self._lock:
+      if self._owners.get(session.address) == instr:
+        del self._owners[session.address]
+        self._owner_changed.notify_all()
+    return 0
+
+  def clear(self, instr):
+    def action(instrument):
+      instrument.send()
+      return 0, 0., 1
+    return self._transact(instr, action)
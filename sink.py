@@ -0,0 +1,543 @@
+"""
+Columnar storage of polled readings
+
+A TimeSeriesSink takes (time, device, channel, value) samples from any
+number of threads, buffers them in numpy arrays per device and writes them in
+batches, from a background thread, to append-only column files::
+
+  >>> from Electronics.Interfaces.GPIB.sink import TimeSeriesSink
+  >>> sink = TimeSeriesSink("/var/gpib/readings")
+  >>> sink.put(time.time(), "pm 13-1", "power", -31.2)
+  >>> acq = Acquisition("pm 13-1", "TR2", sink=sink, channel="power")
+  >>> ...
+  >>> sink.close()
+
+and a TimeSeriesReader slices a time range out of them::
+
+  >>> from Electronics.Interfaces.GPIB.sink import TimeSeriesReader
+  >>> reader = TimeSeriesReader("/var/gpib/readings")
+  >>> times, values = reader.read("pm 13-1", start, stop, channel="power")
+
+Each device has a directory under the root holding three columns, 'time'
+(float64 seconds since the epoch), 'channel' (uint16 codes for the names in
+'channels.json') and 'value' (float64), and an index with one row (first row,
+rows, earliest time, latest time) for each batch written.  Every file is an
+.npy file with a fixed 128 byte header, so data is appended without moving
+anything and numpy.load(filename, mmap_mode='r') maps a closed file.  The
+samples in a batch are sorted by time.  The reader memory-maps the files,
+picks the batches whose times overlap the range from the index and finds the
+range in each by bisection, so only the pages holding the range are read.
+
+The reader takes the number of batches from the size of the index file and
+the writer appends a batch to the columns before its index row, so a reader
+sees whole batches only and can run while the sink is writing.  A sink
+opened on an existing directory drops column data not in the index, which is
+what an interrupted write leaves.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+module_logger = logging.getLogger(__name__)
+
+_header_size = 128
+"""Bytes of the .npy header of every file"""
+
+_magic = b"\x93NUMPY\x01\x00"
+
+_columns = (("time", "<f8"), ("channel", "<u2"), ("value", "<f8"))
+"""Column names and types"""
+
+_index_width = 4
+"""Index row: first row, rows, earliest time, latest time"""
+
+def _directory(root, device):
+  return os.path.join(root, urllib.parse.quote(device, safe=""))
+
+def _header(dtype, shape):
+  """
+  .npy version 1.0 header padded to _header_size bytes.
+  """
+  text = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" \
+         % (dtype, tuple(shape))
+  text = text.ljust(_header_size - len(_magic) - 3) + "\n"
+  return _magic + numpy.uint16(len(text)).astype("<u2").tobytes() + \
+         text.encode("latin-1")
+
+def _rows(path, dtype, width=1):
+  """
+  Whole rows in a file, from its size.
+  """
+  try:
+    size = os.path.getsize(path)
+  except OSError:
+    return 0
+  return max(0, size - _header_size)//(numpy.dtype(dtype).itemsize*width)
+
+def _map(path, dtype, rows, width=1):
+  """
+  Read-only map of the first rows of a file.
+  """
+  if not rows:
+    shape = (0, width) if width > 1 else (0,)
+    return numpy.zeros(shape, dtype)
+  with open(path, "rb") as f:
+    if f.read(len(_magic)) != _magic:
+      raise ValueError("%s is not a version 1.0 .npy file" % path)
+  shape = (rows, width) if width > 1 else (rows,)
+  return numpy.memmap(path, dtype, "r", _header_size, shape)
+
+class _File(object):
+  """
+  One append-only .npy file of the sink
+  """
+  def __init__(self, path, dtype, width=1, rows=None):
+    """
+    @param rows : rows to keep of an existing file; default all
+    @type  rows : int
+    """
+    self.path = path
+    self.dtype = numpy.dtype(dtype)
+    self.width = width
+    if os.path.exists(path):
+      self.file = open(path, "r+b")
+      present = _rows(path, dtype, width)
+      self.rows = present if rows is None else min(rows, present)
+      self.file.truncate(_header_size +
+                         self.rows*self.dtype.itemsize*width)
+    else:
+      self.file = open(path, "w+b")
+      self.rows = 0
+    self._update()
+
+  def _update(self):
+    shape = (self.rows, self.width) if self.width > 1 else (self.rows,)
+    self.file.seek(0)
+    self.file.write(_header(self.dtype.str, shape))
+    self.file.seek(0, os.SEEK_END)
+
+  def append(self, data):
+    """
+    Append rows; the header is brought up to date by update().
+    """
+    self.file.write(numpy.ascontiguousarray(data, self.dtype).tobytes())
+    self.rows += len(data)
+
+  def update(self):
+    """
+    Write the row count into the header and flush.
+    """
+    self._update()
+    self.file.flush()
+
+  def close(self):
+    self._update()
+    self.file.close()
+
+class _Batch(object):
+  """
+  Samples of one device waiting to be written
+  """
+  def __init__(self, size):
+    self.times = numpy.empty(size)
+    self.channels = numpy.empty(size, "u2")
+    self.values = numpy.empty(size)
+    self.count = 0
+
+class _Store(object):
+  """
+  The files of one device
+  """
+  def __init__(self, directory):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    index_path = os.path.join(directory, "index.npy")
+    self.index = _File(index_path, "<f8", _index_width)
+    if self.index.rows:
+      last = numpy.asarray(_map(index_path, "<f8", self.index.rows,
+                                _index_width)[-1])
+      rows = int(last[0] + last[1])
+    else:
+      rows = 0
+    self.columns = [_File(os.path.join(directory, "%s.npy" % name), dtype,
+                          rows=rows)
+                    for name, dtype in _columns]
+    if any(column.rows != rows for column in self.columns):
+      raise IOError("%s has fewer rows than its index" % directory)
+    self.channels = _load_channels(directory)
+    self.saved_channels = len(self.channels)
+
+  def write(self, batch, channels):
+    """
+    Append a batch, sorted by time, then its index row.
+    """
+    count = batch.count
+    times = batch.times[:count]
+    order = numpy.argsort(times, kind="stable")
+    if len(channels) > self.saved_channels:
+      self.channels = list(channels)
+      _save_channels(self.directory, self.channels)
+      self.saved_channels = len(channels)
+    first = self.columns[0].rows
+    for column, data in zip(self.columns,
+                            (times, batch.channels[:count],
+                             batch.values[:count])):
+      column.append(data[order])
+      column.update()
+    self.index.append(numpy.array([[first, count, times[order[0]],
+                                    times[order[-1]]]]))
+    self.index.update()
+
+  def close(self):
+    for f in self.columns + [self.index]:
+      f.close()
+
+def _load_channels(directory):
+  try:
+    with open(os.path.join(directory, "channels.json")) as f:
+      return json.load(f)
+  except IOError:
+    return []
+
+def _save_channels(directory, channels):
+  path = os.path.join(directory, "channels.json")
+  with open(path + ".new", "w") as f:
+    json.dump(channels, f)
+  os.replace(path + ".new", path)
+
+class TimeSeriesSink(object):
+  """
+  Buffers samples and writes them to per-device column files
+
+  Public attributes::
+    root        - directory holding a directory for each device
+    batch_size  - samples buffered per device before a batch is written
+    interval    - seconds after which partly filled batches are written
+    max_pending - full batches waiting to be written before put() blocks
+    stats       - dict of counters: samples, written, batches, bytes, stalls
+                  (puts which waited for the writer), errors
+  """
+  def __init__(self, root, batch_size=8192, interval=1., max_pending=64):
+    """
+    @param root : directory for the files; made if necessary
+    @type  root : str
+
+    @param batch_size : samples per device per batch
+    @type  batch_size : int
+
+    @param interval : most seconds a sample waits to be written
+    @type  interval : float
+
+    @param max_pending : full batches queued before put() waits
+    @type  max_pending : int
+    """
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    self.root = root
+    self.batch_size = batch_size
+    self.interval = interval
+    self.max_pending = max_pending
+    self.stats = {"samples": 0, "written": 0, "batches": 0, "bytes": 0,
+                  "stalls": 0, "errors": 0}
+    self._batches = {}
+    self._full = []
+    self._channels = {}
+    self._stores = {}
+    self._lock = threading.Lock()
+    self._condition = threading.Condition(self._lock)
+    self._write_lock = threading.Lock()
+    self._running = True
+    self._writer = threading.Thread(target=self._run, name="GPIB sink")
+    self._writer.daemon = True
+    self._writer.start()
+
+  def _code(self, device, channel):
+    """
+    Number of a device's channel, assigned on first use.
+
+    Must be called with the sink lock held.
+    """
+    codes = self._channels.get(device)
+    if codes is None:
+      names = _load_channels(_directory(self.root, device))
+      codes = self._channels[device] = dict((name, code) for code, name
+                                            in enumerate(names))
+    code = codes.get(channel)
+    if code is None:
+      if len(codes) > numpy.iinfo("u2").max:
+        raise ValueError("%s has too many channels" % device)
+      code = codes[channel] = len(codes)
+    return code
+
+  def _batch(self, device):
+    """
+    The device's batch with room for a sample.
+
+    Must be called with the sink lock held.  A full batch is queued, and
+    taken from the device, before waiting for the writer, and the device's
+    batch is looked at again afterwards, since other threads may have
+    added to it meanwhile.
+    """
+    while True:
+      if not self._running:
+        raise ValueError("the sink is closed")
+      batch = self._batches.get(device)
+      if batch is not None and batch.count < self.batch_size:
+        return batch
+      if batch is not None:
+        del self._batches[device]
+        self._full.append((device, batch))
+        self._condition.notify_all()
+      if len(self._full) > self.max_pending:
+        self.stats["stalls"] += 1
+        self._condition.wait()
+        continue
+      batch = self._batches[device] = _Batch(self.batch_size)
+      return batch
+
+  def put(self, when, device, channel, value):
+    """
+    Add one sample.
+
+    @param when : seconds since the epoch
+    @type  when : float
+
+    @param device : device name or address
+    @type  device : str
+
+    @param channel : name of the quantity
+    @type  channel : str
+
+    @param value : the reading
+    @type  value : float
+    """
+    with self._lock:
+      batch = self._batch(device)
+      batch.times[batch.count] = when
+      batch.channels[batch.count] = self._code(device, channel)
+      batch.values[batch.count] = value
+      batch.count += 1
+      self.stats["samples"] += 1
+
+  def put_many(self, device, channel, times, values):
+    """
+    Add samples of one channel of one device.
+
+    @param times : seconds since the epoch
+    @type  times : sequence of float
+
+    @param values : the readings
+    @type  values : sequence of float
+    """
+    times = numpy.asarray(times, float)
+    values = numpy.asarray(values, float)
+    if times.shape != values.shape:
+      raise ValueError("times and values differ in shape")
+    with self._lock:
+      code = self._code(device, channel)
+      done = 0
+      while done < len(times):
+        batch = self._batch(device)
+        count = min(len(times) - done, self.batch_size - batch.count)
+        end = batch.count + count
+        batch.times[batch.count:end] = times[done:done + count]
+        batch.channels[batch.count:end] = code
+        batch.values[batch.count:end] = values[done:done + count]
+        batch.count = end
+        done += count
+      self.stats["samples"] += done
+
+  def _take(self, everything):
+    """
+    Remove the full batches, and the partly filled ones if 'everything'.
+
+    Must be called with the sink lock held.
+    """
+    batches, self._full = self._full, []
+    if everything:
+      batches.extend((device, batch)
+                     for device, batch in self._batches.items()
+                     if batch.count)
+      self._batches = {}
+    self._condition.notify_all()
+    channels = dict((device, sorted(self._channels[device],
+                                    key=self._channels[device].get))
+                    for device in set(device for device, batch in batches))
+    return batches, channels
+
+  def _write(self, batches, channels):
+    """
+    Write batches; called with the write lock held.
+    """
+    for device, batch in batches:
+      try:
+        store = self._stores.get(device)
+        if store is None:
+          store = self._stores[device] = _Store(_directory(self.root,
+                                                           device))
+        store.write(batch, channels[device])
+      except Exception as details:
+        self.stats["errors"] += 1
+        module_logger.error("TimeSeriesSink: %d samples of %s lost; %s",
+                            batch.count, device, details)
+        continue
+      self.stats["written"] += batch.count
+      self.stats["batches"] += 1
+      self.stats["bytes"] += batch.count*sum(numpy.dtype(dtype).itemsize
+                                             for name, dtype in _columns)
+
+  def flush(self):
+    """
+    Write everything buffered now.
+    """
+    with self._write_lock:
+      with self._lock:
+        batches, channels = self._take(True)
+      self._write(batches, channels)
+
+  def _run(self):
+    due = time.time() + self.interval
+    while True:
+      with self._write_lock:
+        with self._lock:
+          while self._running and not self._full and time.time() < due:
+            self._condition.wait(max(0., due - time.time()))
+          if not self._running:
+            return
+          everything = time.time() >= due
+          batches, channels = self._take(everything)
+        self._write(batches, channels)
+      if everything:
+        due = time.time() + self.interval
+
+  def close(self):
+    """
+    Write everything buffered, stop the writer and close the files.
+    """
+    with self._lock:
+      if not self._running:
+        return
+      self._running = False
+      self._condition.notify_all()
+    self._writer.join()
+    with self._write_lock:
+      with self._lock:
+        batches, channels = self._take(True)
+      self._write(batches, channels)
+      for store in self._stores.values():
+        store.close()
+      self._stores = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class TimeSeriesReader(object):
+  """
+  Reads time ranges from the files of a TimeSeriesSink
+
+  Public attributes::
+    root - directory holding a directory for each device
+  """
+  def __init__(self, root):
+    self.root = root
+
+  def devices(self):
+    """
+    Names of the devices with data.
+    """
+    return sorted(urllib.parse.unquote(name) for name in os.listdir(self.root)
+                  if os.path.exists(os.path.join(self.root, name,
+                                                 "index.npy")))
+
+  def channels(self, device):
+    """
+    Names of a device's channels.
+    """
+    return _load_channels(_directory(self.root, device))
+
+  def _index(self, directory):
+    path = os.path.join(directory, "index.npy")
+    rows = _rows(path, "<f8", _index_width)
+    return _map(path, "<f8", rows, _index_width)
+
+  def span(self, device):
+    """
+    Earliest and latest times of a device's samples.
+
+    @return: (first, last) or None if there are none
+    """
+    index = self._index(_directory(self.root, device))
+    if not len(index):
+      return None
+    return float(index[:, 2].min()), float(index[:, 3].max())
+
+  def count(self, device):
+    """
+    Number of samples of a device.
+    """
+    index = self._index(_directory(self.root, device))
+    return int(index[:, 1].sum())
+
+  def read(self, device, start=None, stop=None, channel=None):
+    """
+    Samples with start <= time < stop, in time order.
+
+    @param device : device name or address
+    @type  device : str
+
+    @param start : earliest time; default the first sample
+    @type  start : float
+
+    @param stop : time after the last sample wanted; default after the last
+    @type  stop : float
+
+    @param channel : channel wanted; default all
+    @type  channel : str
+
+    @return: (times, values) for one channel, or {channel: (times, values)}
+    """
+    directory = _directory(self.root, device)
+    names = _load_channels(directory)
+    if channel is not None and channel not in names:
+      raise KeyError("%s has no channel %s" % (device, channel))
+    index = numpy.array(self._index(directory))
+    if start is None:
+      start = -numpy.inf
+    if stop is None:
+      stop = numpy.inf
+    chunks = index[(index[:, 3] >= start) & (index[:, 2] < stop)]
+    rows = int((chunks[:, 0] + chunks[:, 1]).max()) if len(chunks) else 0
+    columns = [_map(os.path.join(directory, "%s.npy" % name), dtype, rows)
+               for name, dtype in _columns]
+    slices = []
+    for first, count, earliest, latest in chunks:
+      first, end = int(first), int(first + count)
+      times = columns[0][first:end]
+      low = first + (numpy.searchsorted(times, start) if start > earliest
+                     else 0)
+      high = first + (numpy.searchsorted(times, stop) if stop <= latest
+                      else count)
+      if high > low:
+        slices.append(slice(int(low), int(high)))
+    times, codes, values = [
+      numpy.concatenate([column[part] for part in slices]) if slices
+      else numpy.zeros(0, column.dtype) for column in columns]
+    # batches written by different flushes may overlap in time
+    if len(slices) > 1 and \
+       numpy.any(chunks[1:, 2] < numpy.maximum.accumulate(chunks[:-1, 3])):
+      order = numpy.argsort(times, kind="stable")
+      times, codes, values = times[order], codes[order], values[order]
+    if channel is not None:
+      wanted = codes == names.index(channel)
+      return times[wanted], values[wanted]
+    return dict((name, (times[codes == code], values[codes == code]))
+                for code, name in enumerate(names))
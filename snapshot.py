@@ -0,0 +1,231 @@
+"""
+Readings of several devices taken at the same moment
+
+Reading power meters one after another with ask() puts the time of a
+prompt, tens of ms, between consecutive readings.  A snapshot instead arms
+every device to wait for a trigger, addresses them all to listen and sends
+one group execute trigger with itrigger on the bus's interface session, so
+that they all measure at once, and then collects the readings::
+
+  >>> from Electronics.Interfaces.GPIB.snapshot import snapshot
+  >>> snapshot(["pm 13-1", "pm 13-4", "pm 13-5"])
+  {'pm 13-1': (1712345678.123, -30.01), 'pm 13-4': (1712345678.123, -29.6),
+   'pm 13-5': (1712345678.123, -31.2)}
+
+The time with each reading is that of its bus's trigger.  Devices on
+different buses are triggered bus by bus, a few ms apart.  A device's type
+in the registry gives the command which arms it and the query, if any,
+which fetches its reading, from 'trigger_modes'; 'arm' and 'fetch' override
+them.  Armed devices hold until triggered, so a plain ask() of one would
+time out; after the readings each is returned to free run with the command
+given in 'trigger_modes' or by 'disarm'.  disarm='' leaves the devices armed,
+and arm='' then skips arming them for the next snapshot.  The interface
+session is locked from the addressing to the trigger so that no other
+transaction on the bus readdresses the listeners.
+"""
+import logging
+import threading
+import time
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+trigger_modes = {
+  "437B":   ("TR0", None, "TR3"),
+  "438":    ("TR0", None, "TR3"),
+  "E4418B": ("TRIG:SOUR BUS;INIT", "FETC?", "TRIG:SOUR IMM;INIT:CONT ON")}
+"""
+For each device type: the command which makes the device hold until a group
+execute trigger and then take a reading, the query which fetches the
+reading, or None if the device talks the reading when next addressed, and
+the command which returns the device to free run
+"""
+
+class GroupTrigger(object):
+  """
+  Takes snapshots of groups of devices
+
+  Public attributes::
+    pool          - session pool for the device sessions
+    response_size - bytes allowed for one reading
+    stats         - dict of counters: snapshots, triggers, readings, errors
+  """
+  def __init__(self, pool=None, response_size=64):
+    """
+    @param pool : session pool; default the shared pool
+    @type  pool : pool.SessionPool
+
+    @param response_size : bytes allowed for one reading
+    @type  response_size : int
+    """
+    self.pool = pool or session_pool
+    self.response_size = response_size
+    self.stats = {"snapshots": 0, "triggers": 0, "readings": 0, "errors": 0}
+    self._interfaces = {}
+    self._response = bytearray(response_size)
+    self._lock = threading.Lock()
+
+  def _mode(self, name, address, arm, fetch, disarm):
+    """
+    The arm command, fetch query and disarm command for a device.
+    """
+    try:
+      kind = registry.get(name).type
+    except KeyError:
+      known = registry.at_address(address)
+      kind = known[0].type if known else None
+    if kind not in trigger_modes and arm is None:
+      raise ValueError("no trigger mode is known for %s, a %s; give 'arm'"
+                       % (name, kind))
+    default_arm, default_fetch, default_disarm = trigger_modes.get(
+      kind, (None, None, None))
+    return (default_arm if arm is None else arm,
+            default_fetch if fetch is None else fetch,
+            default_disarm if disarm is None else disarm)
+
+  def _interface(self, bus):
+    """
+    The open interface session of a bus.
+    """
+    instr = self._interfaces.get(bus)
+    if instr is None:
+      instr = self._interfaces[bus] = self.pool.driver.gpib_open(bus)
+    return instr
+
+  def _trigger(self, bus, addresses):
+    """
+    Address the devices to listen and trigger them.
+
+    @return: time of the trigger
+    """
+    driver = self.pool.driver
+    instr = self._interface(bus)
+    try:
+      driver.gpib_lock(instr)
+      try:
+        driver.gpib_sendcmd(instr, gpib_address.listen_commands(addresses))
+        start = time.time()
+        driver.gpib_trigger(instr)
+        end = time.time()
+      finally:
+        driver.gpib_unlock(instr)
+    except Exception:
+      # a failed interface session is opened again next time
+      del self._interfaces[bus]
+      try:
+        driver.gpib_close(instr)
+      except Exception:
+        pass
+      raise
+    self.stats["triggers"] += 1
+    return (start + end)/2.
+
+  def _read(self, instr):
+    """
+    Read a reading which the device talks when addressed.
+    """
+    driver = self.pool.driver
+    count, reason = driver.gpib_read_into(instr, self._response)
+    if reason == driver.I_TERM_MAXCNT:
+      raise ValueError("reading longer than %d bytes" % self.response_size)
+    return float(bytes(self._response[:count]))
+
+  def _failed(self, name, step, details):
+    self.stats["errors"] += 1
+    module_logger.warning("GroupTrigger: %s %s failed; %s",
+                          step, name, details)
+
+  def snapshot(self, devices, arm=None, fetch=None, disarm=None):
+    """
+    Trigger devices together and collect their readings.
+
+    @param devices : device names or addresses
+    @type  devices : list of str
+
+    @param arm : command making each device wait for a trigger; default from
+                 the device's type; '' if the devices are already armed
+    @type  arm : str
+
+    @param fetch : query fetching each reading; default from the device's
+                   type; '' to read what the device talks
+    @type  fetch : str
+
+    @param disarm : command returning each device to free run after its
+                    reading; default from the device's type; '' to leave
+                    the devices armed
+    @type  disarm : str
+
+    @return: {device: (trigger time, reading)}; the reading is None if the
+             device failed
+    """
+    driver = self.pool.driver
+    plan = []
+    for name in devices:
+      try:
+        address = registry.address(name)
+      except KeyError:
+        address = name
+      plan.append((name, address) + self._mode(name, address, arm, fetch,
+                                               disarm))
+    with self._lock:
+      self.stats["snapshots"] += 1
+      results = dict((name, (None, None)) for name in devices)
+      armed = []
+      for name, address, command, query, restore in plan:
+        if command:
+          try:
+            self.pool.call(name, driver.gpib_send, command)
+          except Exception as details:
+            self._failed(name, "arming", details)
+            continue
+        armed.append((name, address, query, restore))
+      buses = {}
+      for entry in armed:
+        buses.setdefault(gpib_address.bus_of(entry[1]), []).append(entry)
+      triggered = []
+      for bus, entries in buses.items():
+        try:
+          when = self._trigger(bus, [entry[1] for entry in entries])
+        except Exception as details:
+          self._failed(bus, "triggering", details)
+          continue
+        triggered.extend((entry[0], entry[2], when) for entry in entries)
+      for name, query, when in triggered:
+        try:
+          if query:
+            value = float(self.pool.call(name, driver.gpib_prompt, query))
+          else:
+            value = self.pool.call(name, self._read)
+        except Exception as details:
+          self._failed(name, "reading", details)
+          results[name] = (when, None)
+          continue
+        self.stats["readings"] += 1
+        results[name] = (when, value)
+      for name, address, query, restore in armed:
+        if restore:
+          try:
+            self.pool.call(name, driver.gpib_send, restore)
+          except Exception as details:
+            self._failed(name, "disarming", details)
+      return results
+
+  def close(self):
+    """
+    Close the interface sessions.
+    """
+    with self._lock:
+      interfaces, self._interfaces = self._interfaces, {}
+    for instr in interfaces.values():
+      try:
+        self.pool.driver.gpib_close(instr)
+      except Exception as details:
+        module_logger.debug("GroupTrigger: closing %s failed; %s",
+                            instr, details)
+
+group_trigger = GroupTrigger()
+
+snapshot = group_trigger.snapshot
@@ -1,4 +1,4 @@
-/* /usr/local/python/sicl/src/pysicl.c 
+/* /usr/local/python/sicl/src/pysicl.c
 
    1996 Nov 12	kuiper	instr_ioTK revised
    1999 Dec  7	skjerve	added gpib_open_net sub-routine
@@ -7,478 +7,904 @@
    2003	Nov 24	kuiper	added gpib_rcv_bin to handle output from "SER?"
 			and other possible binary data
    2008 Oct 10	kuiper	converting to Python extension
+   2026 Oct 17		rewritten for Python 3 with the functions of
+			gpib_ct; reentrant, and the GIL is released
+			around every SICL call
+
+   Every call has its own message buffer, so calls from different threads
+   do not share state, and the GIL is released while SICL does I/O, so a
+   slow instrument only stalls the thread talking to it.  Messages may be
+   str or bytes; text responses are returned as str and binary data as
+   bytes.  Errors raise RuntimeError.
+
+   The module is installed in the package as _pysicl, since the package
+   already uses the name pysicl for gpib_ct.  Unlike gpib_ct, gpib_open
+   takes only SICL addresses, not device names.  gpib_ct uses this module
+   when GPIB_BACKEND is 'native'.
 */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <sicl.h>
 #include <string.h>
 #include <stdio.h>
 #include <signal.h>
-#ifndef PyDoc_STR
-#define PyDoc_VAR(name)         static char name[]
-#define PyDoc_STR(str)          (str)
-#define PyDoc_STRVAR(name, str) PyDoc_VAR(name) = PyDoc_STR(str)
-#endif
+#include <pthread.h>
 
 #define MSG_LEN 32768
-char message[MSG_LEN];
-char err_msg[256];
-int  timeout = 10000; /* default is 10 seconds */
-int  gpib_diags = 0; /* default is no diagnostic messages */
+#define READ_FORMAT "%32767t" /* at most MSG_LEN-1 characters */
+
+static int gpib_diags = 0; /* default is no diagnostic messages */
+static PyObject *srq_handlers = NULL; /* dict of SRQ handlers by session */
 
 PyDoc_STRVAR(pysicl__doc__,
 "GPIB (IEEE-488) functions based on SICL (Standard Instrument Control\n\
-Library). Depends on libsicl.so. and libpython2.4.so.");
+Library), with the same functions as gpib_ct.  Depends on libsicl.so.");
 
 PyDoc_STRVAR(OpenCommand__doc__,
-"gpib_open(address_string) -> int\n\n\
+"gpib_open(address) -> int\n\n\
 Returns a unique integer for the instrument at the specified\n\
 GPIB address. For example,\n\
->>> gpib_open(lan[158.154.1.110]:19)\n\
+>>> gpib_open('lan[158.154.1.110]:19')\n\
 4");
 
 PyDoc_STRVAR(CloseCommand__doc__,
-"gpib_close(intrument) -> response string\n\n\
+"gpib_close(instrument) -> int\n\n\
 Close the instrument\n\
 where instrument is the integer returned by gpib_open.");
 
 PyDoc_STRVAR(TimeoutCommand__doc__,
-"gpib_timeout(int milliseconds) -> response string\n\n\
-Set instrument timeout for subsequent gpib commands.");
+"gpib_timeout(instrument, milliseconds) -> True\n\n\
+Set instrument timeout for subsequent gpib commands; 0 disables it.");
 
 PyDoc_STRVAR(DiagCommand__doc__,
-"gpib_diags(1|0) -> response string\n\n\
+"gpib_diags(1|0) -> True\n\n\
 Turn diagnostic printout for gpib module on or off.");
 
 PyDoc_STRVAR(SendCommand__doc__,
-"gpib_send(instrument, command) -> response string\n\n\
+"gpib_send(instrument, command) -> int\n\n\
 Send the command string to the designated instrument.");
 
 PyDoc_STRVAR(RcvCommand__doc__,
-"gpib_rcv(instrument, termination character) -> response string\n\n\
+"gpib_rcv(instrument, term_char=10) -> response string\n\n\
 Receive from the designated instrument a response string up to the\n\
 designation termination character (an integer, e.g. 10 for LF).");
 
+PyDoc_STRVAR(ReadCommand__doc__,
+"gpib_read(instrument, lendata) -> (bytes, reason, count)\n\n\
+Read up to lendata bytes of raw data with iread.");
+
+PyDoc_STRVAR(ReadIntoCommand__doc__,
+"gpib_read_into(instrument, buffer, offset=0, nbytes=None)\n\
+  -> (count, reason)\n\n\
+Read raw data with iread directly into a writable buffer, such as a\n\
+bytearray or numpy array, starting at byte 'offset'.");
+
 PyDoc_STRVAR(PromptCommand__doc__,
 "gpib_prompt(instrument, prompt string) -> response string\n\n\
 Send the prompt string to the designated instrument and receive an\n\
 appropriate response string.");
 
+PyDoc_STRVAR(PromptManyCommand__doc__,
+"gpib_prompt_many(instrument, prompt strings) -> list of response strings\n\n\
+Send each prompt string in turn and receive its response.");
+
 PyDoc_STRVAR(LockCommand__doc__,
-"gpib_lock(instrument) -> response string\n\n\
+"gpib_lock(instrument) -> int\n\n\
 Lock the instrument to this session.");
 
 PyDoc_STRVAR(UnlockCommand__doc__,
-"gpib_unlock(instrument) -> response string\n\n\
+"gpib_unlock(instrument) -> int\n\n\
 Unlock the instrument from this session.");
 
 PyDoc_STRVAR(DevStsCommand__doc__,
-"gpib_dev_status(instrument) -> response string\n\n\
+"gpib_dev_status(instrument) -> int\n\n\
 Returns status byte for the instrument.");
 
+PyDoc_STRVAR(ClearCommand__doc__,
+"clear(instrument) -> True\n\n\
+Send a device clear and discard the formatted I/O buffers.");
+
+PyDoc_STRVAR(TriggerCommand__doc__,
+"gpib_trigger(instrument) -> int\n\n\
+Send a group execute trigger to the instrument.");
+
+PyDoc_STRVAR(SendCmdCommand__doc__,
+"gpib_sendcmd(instrument, commands) -> int\n\n\
+Send GPIB command bytes with ATN asserted on an interface session.");
+
+PyDoc_STRVAR(SetBufCommand__doc__,
+"gpib_setbuf(instrument, size, mask=I_BUF_WRITE) -> int\n\n\
+Set the size of the formatted I/O buffers selected by 'mask'.");
+
+PyDoc_STRVAR(FWriteCommand__doc__,
+"gpib_fwrite(instrument, data, end=False) -> int\n\n\
+Add bytes to the formatted write buffer with ifwrite; it is sent when it\n\
+fills, when flushed or, with 'end', at once with END on the last byte.\n\
+Returns the number of bytes taken.");
+
+PyDoc_STRVAR(FlushCommand__doc__,
+"gpib_flush(instrument, mask=I_BUF_WRITE) -> int\n\n\
+Send the formatted write buffer to the instrument.");
+
+PyDoc_STRVAR(WriteRawCommand__doc__,
+"gpib_write_raw(instrument, data, end=True) -> int\n\n\
+Send bytes unbuffered with iwrite, from any object with the buffer\n\
+protocol.  Returns the number of bytes sent.");
+
+PyDoc_STRVAR(OnSrqCommand__doc__,
+"gpib_onsrq(instrument, handler) -> int\n\n\
+Call handler(instrument) when the device requests service; None\n\
+removes the handler.");
+
+PyDoc_STRVAR(WaitHdlrCommand__doc__,
+"gpib_waithdlr(milliseconds) -> bool\n\n\
+Wait for a handler to be called; False if the time ran out.");
+
+PyDoc_STRVAR(IntrOffCommand__doc__,
+"gpib_introff() -> int\n\n\
+Defer handlers until gpib_waithdlr is called.");
+
+PyDoc_STRVAR(IntrOnCommand__doc__,
+"gpib_intron() -> int\n\n\
+Call handlers asynchronously again.");
+
+/* SICL may be interrupted by SIGALRM; it is blocked in the calling thread
+   only, for the duration of a call. */
+static void block_alarm(sigset_t *old_mask) {
+   sigset_t mask;
+
+   sigemptyset(&mask);
+   sigaddset(&mask, SIGALRM);
+   pthread_sigmask(SIG_BLOCK, &mask, old_mask);
+}
+
+static void restore_alarm(sigset_t *old_mask) {
+   pthread_sigmask(SIG_SETMASK, old_mask, NULL);
+}
+
+static PyObject * sicl_error(const char *action, int instrument, int error) {
+   if (gpib_diags) {
+      fprintf(stderr, "%s of instrument %d failed: %s\n",
+              action, instrument, igeterrstr(error));
+   }
+   PyErr_Format(PyExc_RuntimeError, "%s of instrument %d failed: %s",
+                action, instrument, igeterrstr(error));
+   return NULL;
+}
+
+/* Convert a str (as latin-1) or bytes-like message to a new bytes object */
+static PyObject * message_bytes(PyObject *message) {
+   if (PyUnicode_Check(message)) {
+      return PyUnicode_AsLatin1String(message);
+   }
+   return PyBytes_FromObject(message);
+}
+
+/* Length of a response without trailing newlines, returns and spaces */
+static Py_ssize_t stripped_length(const char *response, Py_ssize_t length) {
+   while (   length > 0
+          && (   response[length-1] == '\n'
+              || response[length-1] == '\r'
+              || response[length-1] == ' ')) {
+      length--;
+   }
+   return length;
+}
+
 static PyObject *
-OpenCommand(PyObject *self,
-		PyObject *args) {
-   int	address;
-   char *err_str;
-   char *instr;
-   int	error;
-   char *result;
+OpenCommand(PyObject *self, PyObject *args) {
+   PyObject *address;
+   PyObject *encoded;
    int	instrument;  /* NOTE: in sicl, the instrument identifier is supposed
 			to be of type INST. At present, INST is defined as
 			int in sicl.h. If this ever changes, compilation
 			should generate a warning, and another scheme will
 			have to be found to associate an instrument with
 			an integer code. */
-   if (! PyArg_Parse(args, "(s)", &instr)) {
+   int	error = 0;
+   sigset_t old_mask;
+
+   if (! PyArg_ParseTuple(args, "O:gpib_open", &address)) {
       return NULL;
    }
-   instrument=iopen (instr);
-
-   if ( instrument == 0 ) {
+   if (! (encoded = message_bytes(address))) {
+      return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   block_alarm(&old_mask);
+   instrument = iopen(PyBytes_AS_STRING(encoded));
+   if (instrument == 0) {
       error = igeterrno();
-      err_str = igeterrstr (error);
-      sprintf(err_msg,
-	 "open of HPIB address %s failed: %s", instr ,err_str);
-      PyErr_SetString(PyExc_Exception,err_msg);
-      if (gpib_diags) {
-        printf("open of HPIB address %s failed: %s\n", instr ,err_str);
-      }
-      PyErr_SetString(PyExc_Exception,err_msg);
+   }
+   restore_alarm(&old_mask);
+   Py_END_ALLOW_THREADS
+   if (instrument == 0) {
+      PyErr_Format(PyExc_RuntimeError, "open of GPIB address %s failed: %s",
+                   PyBytes_AS_STRING(encoded), igeterrstr(error));
+      Py_DECREF(encoded);
       return NULL;
-   } else {
-      itimeout (instrument, timeout);
-      return Py_BuildValue("i", instrument);
    }
+   Py_DECREF(encoded);
+   return PyLong_FromLong(instrument);
 }
 
-static PyObject * TimeoutCommand(PyObject *self,
-                PyObject *args) {
-   if (! PyArg_Parse(args, "(i)", &timeout) ) {
+static PyObject *
+CloseCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "i:gpib_close", &instrument)) {
       return NULL;
-   } else {
-      return Py_BuildValue("i", timeout);
    }
+   Py_BEGIN_ALLOW_THREADS
+   error = iclose(instrument);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("close", instrument, error);
+   }
+   {
+      PyObject *key = PyLong_FromLong(instrument);
+      if (! key || PyDict_DelItem(srq_handlers, key)) {
+         PyErr_Clear();
+      }
+      Py_XDECREF(key);
+   }
+   return PyLong_FromLong(0);
 }
 
-int gpib_dev_status(int id, int request, int *result) {
-   /* repeat until not interrupt error */
-   while ( igpibbusstatus(id, request, result) == I_ERR_INTERRUPT );
+static PyObject *
+TimeoutCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   long milliseconds;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "il:gpib_timeout", &instrument,
+                          &milliseconds)) {
+      return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   error = itimeout(instrument, milliseconds);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("setting timeout", instrument, error);
+   }
+   Py_RETURN_TRUE;
 }
 
+static PyObject *
+DiagCommand(PyObject *self, PyObject *args) {
+   int state;
 
-static PyObject * DiagCommand(PyObject *self,
-		PyObject *args) {
-   if (! PyArg_Parse(args, "(i)", &gpib_diags) ) {
+   if (! PyArg_ParseTuple(args, "p:gpib_diags", &state)) {
       return NULL;
    }
-   return Py_BuildValue("i", gpib_diags);
+   gpib_diags = state;
+   Py_RETURN_TRUE;
 }
 
-static PyObject * SendCommand(PyObject *self, PyObject *args) {
-   char          *err_str;
-   int           error;
-   int           instrument;
-   long          old_mask;
-   int           repeat;
-   unsigned long sent;
-   int           status;
-   char          *command;
-   int           com_len;
-   
-   if ( gpib_diags ) {
-      printf ("gpib_send: about to parse arguments\n");
-      fflush(stdout);
+static PyObject *
+SendCommand(PyObject *self, PyObject *args) {
+   int       instrument;
+   PyObject  *command;
+   PyObject  *encoded;
+   int       status;
+   int       error = 0;
+   sigset_t  old_mask;
+
+   if (! PyArg_ParseTuple(args, "iO:gpib_send", &instrument, &command)) {
+      return NULL;
    }
-   if (! PyArg_Parse(args, "(is#)", &instrument, &command, &com_len) ) {
+   if (! (encoded = message_bytes(command))) {
       return NULL;
    }
-   /* strcat(command,"\r\n"); HPIB messages need an EOL */
-   if ( gpib_diags ) {
-      printf ("gpib_send: length of received string is %d\n",
-        com_len);
-      fflush(stdout);
+   if (gpib_diags) {
+      fprintf(stderr, "gpib_send: sending %s to instrument %d\n",
+              PyBytes_AS_STRING(encoded), instrument);
    }
-   if ( gpib_diags ) {
-      printf ("gpib_send: sending %s to instrument %d\n",
-              command, instrument);
-      fflush(stdout);
+   Py_BEGIN_ALLOW_THREADS
+   block_alarm(&old_mask);
+   do {
+      status = iprintf(instrument, "%s", PyBytes_AS_STRING(encoded));
+      error = status < 0 ? igeterrno() : 0;
+   } while (error == I_ERR_INTERRUPT);
+   if (! error) {
+      error = iflush(instrument, I_BUF_WRITE);
    }
-   itimeout (instrument, timeout);
-   repeat = 1;
-   while ( repeat ) {
-      old_mask = sigblock( sigmask (SIGALRM) );
-      /* status = ifwrite (instrument, command, strlen(command), 1, &sent); */
-      status = iprintf(instrument, "%s", command);
-      sigsetmask (old_mask);
-      if ( status != 2 ) {
-        error = igeterrno ();
-        if ( error != I_ERR_INTERRUPT ) repeat = 0;
-      } else {
-        repeat = 0;
-      }
-    }
-    if ( status != 2 ) {
-      err_str = igeterrstr (status);
-      sprintf(err_msg,
-          "ifwrite %s to instrument %d failed: %s",
-           command, instrument, err_str);
-      fflush(stdout);
-      PyErr_SetString(PyExc_Exception, err_msg);
-      if (gpib_diags) {
-        printf("%s ifwrite to instrument %d failed: %s\n",
-               command, instrument, err_str);
-        fflush(stdout);
-      }
+   restore_alarm(&old_mask);
+   Py_END_ALLOW_THREADS
+   Py_DECREF(encoded);
+   if (error) {
+      return sicl_error("output", instrument, error);
+   }
+   return PyLong_FromLong(0);
+}
+
+static PyObject *
+RcvCommand(PyObject *self, PyObject *args, PyObject *kwargs) {
+   static char *keywords[] = {"instrument", "term_char", "format", NULL};
+   int instrument;
+   int tchar = 10;
+   const char *format = NULL;
+   char *response;
+   unsigned long cnt = 0;
+   int status;
+   sigset_t old_mask;
+   PyObject *result;
+
+   if (! PyArg_ParseTupleAndKeywords(args, kwargs, "i|iz:gpib_rcv", keywords,
+                                     &instrument, &tchar, &format)) {
       return NULL;
-   } else {
-      if (gpib_diags) {
-        printf("flushing write buffer for instrument %d\n",
-                              instrument);
-        fflush(stdout);
-      }
-      if ( status = iflush(instrument, I_BUF_WRITE) ) {
-         err_str = igeterrstr (error);
-         sprintf(err_msg,
-            "%s iflush to instrument %d failed: %s",
-            command, instrument, err_str);
-         fflush(stdout);
-         PyErr_SetString(PyExc_Exception, err_msg);
-         if (gpib_diags) {
-            printf("%s iflush to instrument %d failed: %s\n",
-               command, instrument, err_str);
-         fflush(stdout);
-         }
-         return NULL;
-      } else {
-         sprintf(message, "%s", command);
-         return Py_BuildValue("s", message);
-      }
    }
+   if (! (response = PyMem_Malloc(MSG_LEN))) {
+      return PyErr_NoMemory();
+   }
+   Py_BEGIN_ALLOW_THREADS
+   block_alarm(&old_mask);
+   itermchr(instrument, tchar);
+   while ((status = ifread(instrument, response, MSG_LEN, 0, &cnt))
+          == I_ERR_INTERRUPT); /* repeat until not interrupt error */
+   restore_alarm(&old_mask);
+   Py_END_ALLOW_THREADS
+   if (status) {
+      PyMem_Free(response);
+      return sicl_error("input", instrument, status);
+   }
+   result = PyUnicode_DecodeLatin1(response, stripped_length(response, cnt),
+                                   NULL);
+   PyMem_Free(response);
+   return result;
 }
 
-static PyObject * RcvCommand(PyObject *self,
-                PyObject *args) {
-   char *err_str;
-   int  status;
+/* iread into 'count' bytes at 'data'; the GIL must not be held */
+static int read_raw(int instrument, char *data, unsigned long count,
+                    int *reason, unsigned long *actual) {
+   int status;
+   sigset_t old_mask;
+
+   block_alarm(&old_mask);
+   while ((status = iread(instrument, data, count, reason, actual))
+          == I_ERR_INTERRUPT); /* repeat until not interrupt error */
+   restore_alarm(&old_mask);
+   return status;
+}
+
+static PyObject *
+ReadCommand(PyObject *self, PyObject *args) {
    int instrument;
-   long old_mask;
-   char *p;
-   int tchar;
-   unsigned long cnt;
-
-   if (! PyArg_Parse(args, "(ii)", &instrument, &tchar) ) {
-      PyErr_SetString(PyExc_Exception, \
-          "usage: gpib_rcv(instr_id,termination_char)");
-      return NULL;
-   }
-   if ( gpib_diags ) {
-      printf ("Setting timeout and termchar for instrument %d\n", instrument);
-      fflush(stdout);
-   }
-   itimeout (instrument, timeout);
-   itermchr (instrument, tchar);
-   if ( gpib_diags ) {
-      printf ("Saving current SIGALARM mask\n");
-      fflush(stdout);
-   }
-   old_mask = sigblock( sigmask(SIGALRM) );
-   if ( gpib_diags ) {
-      printf ("Requesting input from instrument %d\n", instrument);
-      fflush(stdout);
-   }
-   while ( ( status = ifread (instrument, message, MSG_LEN, 0, &cnt) )
-              == I_ERR_INTERRUPT ); /* repeat until not interrupt error */
-   if ( gpib_diags ) {
-      printf ("Restoring SIGALARM mask\n");
-      fflush(stdout);
-   }
-   sigsetmask (old_mask);
-   if ( status ) {
-      if ( gpib_diags ) {
-         printf ("ifread returned status = %d\n",status);
-         fflush(stdout);
-      }
-      err_str = igeterrstr (status);
-      if (gpib_diags) {
-        printf("input from instrument %d failed: %s\n", instrument, err_str);
-        fflush(stdout);
-      }
-      sprintf(err_msg,
-         "input from instrument %d failed: %s",
-         instrument, err_str);
-      PyErr_SetString(PyExc_Exception,err_msg);
+   Py_ssize_t lendata;
+   PyObject *data;
+   int status;
+   int reason = 0;
+   unsigned long count = 0;
+
+   if (! PyArg_ParseTuple(args, "in:gpib_read", &instrument, &lendata)) {
+      return NULL;
+   }
+   if (lendata <= 0) {
+      PyErr_SetString(PyExc_ValueError, "lendata must be positive");
+      return NULL;
+   }
+   /* the new bytes object is not shared until it is returned */
+   if (! (data = PyBytes_FromStringAndSize(NULL, lendata))) {
       return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   status = read_raw(instrument, PyBytes_AS_STRING(data), lendata,
+                     &reason, &count);
+   Py_END_ALLOW_THREADS
+   if (status) {
+      Py_DECREF(data);
+      return sicl_error("read", instrument, status);
+   }
+   if (_PyBytes_Resize(&data, count)) {
+      return NULL;
+   }
+   return Py_BuildValue("(Nik)", data, reason, count);
+}
+
+static PyObject *
+ReadIntoCommand(PyObject *self, PyObject *args, PyObject *kwargs) {
+   static char *keywords[] = {"instrument", "buffer", "offset", "nbytes",
+                              NULL};
+   int instrument;
+   Py_buffer buffer;
+   Py_ssize_t offset = 0;
+   PyObject *nbytes_arg = Py_None;
+   Py_ssize_t nbytes;
+   int status;
+   int reason = 0;
+   unsigned long count = 0;
+
+   if (! PyArg_ParseTupleAndKeywords(args, kwargs, "iw*|nO:gpib_read_into",
+                                     keywords, &instrument, &buffer, &offset,
+                                     &nbytes_arg)) {
+      return NULL;
+   }
+   if (nbytes_arg == Py_None) {
+      nbytes = buffer.len - offset;
    } else {
-      message[cnt] = '\0'; /* make sure it looks like a proper string */
-      while (   message[strlen(message)-1] == '\n'
-             || message[strlen(message)-1] == '\r'
-             || message[strlen(message)-1] == ' ' ) {
-         message[strlen(message) -1] = '\0';
-         cnt--;
-      }
-      if ( gpib_diags ) {
-         printf ("Received %d bytes:>%s<\n", cnt, message);
-         fflush(stdout);
-      }
-      return Py_BuildValue("s", message);
-   }
-}
-
-
-static PyObject * PromptCommand(PyObject *self, PyObject *args) {
-   char          *err_str;
-   int           error;
-   int           instrument;
-   long          old_mask;
-   int           repeat;
-   unsigned long sent;
-   int           status;
-   char          *command;
-   int           com_len;
-
-   /* There is a bug in the library.  This should work with simply the
-    * 's' format code but after the first call, that fails and using
-    * 's#' provides a work-around. */
-   if (! PyArg_Parse(args, "(is#)", &instrument, &command, &com_len) ) {
-      return NULL;
-   }
-   strcat(command,"\r\n"); /* HPIB messages need an EOL */
-   if ( gpib_diags ) {
-      printf ("gpib_prompt: length of received string is %d\n",
-        com_len);
-   }
-   if ( gpib_diags ) {
-      printf ("gpib_prompt: sending %s to instrument %d\n", 
-	      command, instrument);
-   }
-   itimeout (instrument, timeout);
-   repeat = 1;
-   while ( repeat ) {
-     old_mask = sigblock( sigmask(SIGALRM) );
-     status = ipromptf (instrument, "%s", "%8191t", command, message);
-     sigsetmask (old_mask);
-     if ( status != 2 ) {
-       error = igeterrno ();
-       if ( error != I_ERR_INTERRUPT ) repeat = 0;
-     } else {
-       repeat = 0;
-     }
-   }
-   if ( status != 2 ) {
-      err_str = igeterrstr ( error );
-      sprintf(err_msg,
-	 "ipromtf of '%s' to instrument %d failed: %s",
-	 command, instrument, err_str);
-      PyErr_SetString(PyExc_Exception, err_msg);
-      if (gpib_diags) {
-        printf("%s output to instrument %d failed: %s\n",
-	       command, instrument, err_str);
+      nbytes = PyLong_AsSsize_t(nbytes_arg);
+      if (nbytes == -1 && PyErr_Occurred()) {
+         PyBuffer_Release(&buffer);
+         return NULL;
       }
+   }
+   if (offset < 0 || nbytes <= 0 || offset + nbytes > buffer.len) {
+      PyErr_Format(PyExc_ValueError,
+                   "cannot read %zd bytes at offset %zd into %zd byte buffer",
+                   nbytes, offset, buffer.len);
+      PyBuffer_Release(&buffer);
       return NULL;
-   } else {
-      if ( gpib_diags ) {
-         printf ("gpib_prompt: received %d bytes: >%s<\n",
-	         strlen(message),message);
+   }
+   /* the buffer stays exported, so cannot move, until it is released */
+   Py_BEGIN_ALLOW_THREADS
+   status = read_raw(instrument, (char *)buffer.buf + offset, nbytes,
+                     &reason, &count);
+   Py_END_ALLOW_THREADS
+   PyBuffer_Release(&buffer);
+   if (status) {
+      return sicl_error("read", instrument, status);
+   }
+   return Py_BuildValue("(ki)", count, reason);
+}
+
+/* Send a prompt and read the response into 'response'; the GIL must not be
+   held.  Returns 0 or a SICL error number. */
+static int prompt_raw(int instrument, const char *command, char *response) {
+   int status;
+   int error;
+   sigset_t old_mask;
+
+   response[0] = '\0';
+   block_alarm(&old_mask);
+   do {
+      status = ipromptf(instrument, "%s", READ_FORMAT, command, response);
+      error = status < 0 ? igeterrno() : 0;
+   } while (error == I_ERR_INTERRUPT);
+   restore_alarm(&old_mask);
+   return error;
+}
+
+static PyObject *
+PromptCommand(PyObject *self, PyObject *args) {
+   int       instrument;
+   PyObject  *command;
+   PyObject  *encoded;
+   char      *response;
+   int       error;
+   PyObject  *result;
+
+   if (! PyArg_ParseTuple(args, "iO:gpib_prompt", &instrument, &command)) {
+      return NULL;
+   }
+   if (! (encoded = message_bytes(command))) {
+      return NULL;
+   }
+   if (! (response = PyMem_Malloc(MSG_LEN))) {
+      Py_DECREF(encoded);
+      return PyErr_NoMemory();
+   }
+   Py_BEGIN_ALLOW_THREADS
+   error = prompt_raw(instrument, PyBytes_AS_STRING(encoded), response);
+   Py_END_ALLOW_THREADS
+   Py_DECREF(encoded);
+   if (error) {
+      PyMem_Free(response);
+      return sicl_error("prompt", instrument, error);
+   }
+   result = PyUnicode_DecodeLatin1(response,
+                                   stripped_length(response, strlen(response)),
+                                   NULL);
+   PyMem_Free(response);
+   return result;
+}
+
+static PyObject *
+PromptManyCommand(PyObject *self, PyObject *args) {
+   int       instrument;
+   PyObject  *commands;
+   PyObject  *sequence;
+   PyObject  *results = NULL;
+   char      *response;
+   Py_ssize_t index;
+
+   if (! PyArg_ParseTuple(args, "iO:gpib_prompt_many", &instrument,
+                          &commands)) {
+      return NULL;
+   }
+   if (! (sequence = PySequence_Fast(commands, "prompts must be a sequence"))) {
+      return NULL;
+   }
+   if (! (response = PyMem_Malloc(MSG_LEN))) {
+      Py_DECREF(sequence);
+      return PyErr_NoMemory();
+   }
+   if (! (results = PyList_New(PySequence_Fast_GET_SIZE(sequence)))) {
+      goto done;
+   }
+   for (index = 0; index < PySequence_Fast_GET_SIZE(sequence); index++) {
+      PyObject *encoded;
+      PyObject *text;
+      int error;
+
+      encoded = message_bytes(PySequence_Fast_GET_ITEM(sequence, index));
+      if (! encoded) {
+         Py_CLEAR(results);
+         goto done;
       }
-      while (   message[strlen(message)-1] == '\n'
-             || message[strlen(message)-1] == '\r'
-             || message[strlen(message)-1] == ' ' ) {
-         message[strlen(message) -1] = '\0';
+      Py_BEGIN_ALLOW_THREADS
+      error = prompt_raw(instrument, PyBytes_AS_STRING(encoded), response);
+      Py_END_ALLOW_THREADS
+      Py_DECREF(encoded);
+      if (error) {
+         Py_CLEAR(results);
+         sicl_error("prompt", instrument, error);
+         goto done;
       }
-      if ( gpib_diags ) {
-         printf ("gpib_prompt: returns:>%s<\n", message);
+      text = PyUnicode_DecodeLatin1(response,
+                                  stripped_length(response, strlen(response)),
+                                  NULL);
+      if (! text) {
+         Py_CLEAR(results);
+         goto done;
       }
-      return Py_BuildValue("s",message);
+      PyList_SET_ITEM(results, index, text);
+   }
+done:
+   PyMem_Free(response);
+   Py_DECREF(sequence);
+   return results;
+}
+
+static PyObject *
+LockCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "i:gpib_lock", &instrument)) {
+      return NULL;
    }
+   Py_BEGIN_ALLOW_THREADS
+   while ((error = ilock(instrument))
+          == I_ERR_INTERRUPT); /* repeat until not interrupt error */
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("locking", instrument, error);
+   }
+   return PyLong_FromLong(0);
 }
 
-static PyObject * LockCommand(PyObject *self,
-                PyObject *args) {
-   char *err_str;
-   int  status;
+static PyObject *
+UnlockCommand(PyObject *self, PyObject *args) {
    int instrument;
    int error;
 
-   if (! PyArg_Parse(args, "(i)", &instrument) ) {
+   if (! PyArg_ParseTuple(args, "i:gpib_unlock", &instrument)) {
       return NULL;
    }
-   while ( ( error = ilock (instrument) )
-              == I_ERR_INTERRUPT ); /* repeat until not interrupt error */
-   if ( error ) {
-      err_str = igeterrstr(error);
-      sprintf (err_msg,
-         "locking instrument %s failed: %d",
-         instrument, err_str);
-      PyErr_SetString(PyExc_Exception, err_msg);
-      if (gpib_diags) {
-        printf ( "locking instrument %d failed: %s\n", instrument, err_str);
-      }
+   Py_BEGIN_ALLOW_THREADS
+   error = iunlock(instrument);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("unlocking", instrument, error);
+   }
+   return PyLong_FromLong(0);
+}
+
+static PyObject *
+DevStsCommand(PyObject *self, PyObject *args) {
+   int instrument;              /* instrument id        */
+   unsigned char stb;           /* status byte          */
+   int status;
+   sigset_t old_mask;
+
+   if (! PyArg_ParseTuple(args, "i:gpib_dev_status", &instrument)) {
       return NULL;
-   } else {
-      sprintf(message, "%d locked", instrument);
-      return Py_BuildValue("s",message);
    }
+   Py_BEGIN_ALLOW_THREADS
+   block_alarm(&old_mask);
+   while ((status = ireadstb(instrument, &stb))
+          == I_ERR_INTERRUPT); /* repeat until not interrupt error */
+   restore_alarm(&old_mask);
+   Py_END_ALLOW_THREADS
+   if (status) {
+      return sicl_error("status request", instrument, status);
+   }
+   return PyLong_FromLong(stb);
 }
 
-static PyObject * UnlockCommand(PyObject *self,
-                PyObject *args) {
+static PyObject *
+ClearCommand(PyObject *self, PyObject *args) {
    int instrument;
    int error;
-   char *err_str;
 
-   if (! PyArg_Parse(args, "(i)", &instrument) ) {
+   if (! PyArg_ParseTuple(args, "i:clear", &instrument)) {
       return NULL;
    }
-   if ( error = iunlock (instrument) ) {
-      err_str = igeterrstr(error);
-      sprintf (err_msg,
-         "locking instrument %d failed: %s",
-         instrument, err_str);
-      PyErr_SetString(PyExc_Exception, err_msg);
-      if (gpib_diags) {
-        printf ( "locking instrument %d failed: %s\n", instrument, err_str);
-      }
+   Py_BEGIN_ALLOW_THREADS
+   error = iclear(instrument);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("clear", instrument, error);
+   }
+   Py_RETURN_TRUE;
+}
+
+static PyObject *
+TriggerCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "i:gpib_trigger", &instrument)) {
       return NULL;
-   } else {
-      sprintf(message, "%d unlocked", instrument);
-      return Py_BuildValue("s",message);
    }
+   Py_BEGIN_ALLOW_THREADS
+   error = itrigger(instrument);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("trigger", instrument, error);
+   }
+   return PyLong_FromLong(0);
 }
 
-static PyObject * DevStsCommand(PyObject *self,
-                PyObject *args) {
-   int instrument;              /* instrument id        */
-   unsigned char stb;           /* status byte          */
-   char *err_str;
-   int  status;
+static PyObject *
+SendCmdCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   Py_buffer commands;
+   int error;
 
-   if (! PyArg_Parse(args, "(i)", &instrument) ) {
+   if (! PyArg_ParseTuple(args, "iy*:gpib_sendcmd", &instrument, &commands)) {
       return NULL;
    }
-   if ( gpib_diags ) {
-      printf ("Requesting status of device %d\n", instrument);
+   Py_BEGIN_ALLOW_THREADS
+   error = igpibsendcmd(instrument, (char *) commands.buf,
+                        (int) commands.len);
+   Py_END_ALLOW_THREADS
+   PyBuffer_Release(&commands);
+   if (error) {
+      return sicl_error("sendcmd", instrument, error);
    }
-   while ( ( status = ireadstb (instrument, &stb) )
-              == I_ERR_INTERRUPT ); /* repeat until not interrupt error */
-   if ( status ) {
-      err_str = igeterrstr (status);
-      if ( gpib_diags ) {
-         printf( "gpib_dev_status: status request of %d failed: %s\n",
-                 instrument, err_str);
-      }
-      sprintf(err_msg,
-         "status request of %d failed: %s", instrument, err_str);
-      PyErr_SetString(PyExc_Exception, err_msg);
+   return PyLong_FromLong(0);
+}
+
+static PyObject *
+SetBufCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   int size;
+   int mask = I_BUF_WRITE;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "ii|i:gpib_setbuf", &instrument, &size,
+                          &mask)) {
+      return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   error = isetbuf(instrument, mask, size);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("setting buffer size", instrument, error);
+   }
+   return PyLong_FromLong(0);
+}
+
+/* Send a buffer with ifwrite or iwrite, without the GIL */
+static PyObject *
+write_block(PyObject *args, const char *format, int end,
+            int (*function)(INST, char *, unsigned long, int,
+                            unsigned long *)) {
+   int instrument;
+   Py_buffer data;
+   unsigned long count = 0;
+   int error;
+   sigset_t old_mask;
+
+   if (! PyArg_ParseTuple(args, format, &instrument, &data, &end)) {
       return NULL;
-   } else {
-      sprintf(message,"%d", stb);
-      return Py_BuildValue("s",message);
    }
+   /* the buffer stays exported, so cannot move, until it is released */
+   Py_BEGIN_ALLOW_THREADS
+   block_alarm(&old_mask);
+   while ((error = function(instrument, (char *)data.buf, data.len, end,
+                            &count)) == I_ERR_INTERRUPT);
+   restore_alarm(&old_mask);
+   Py_END_ALLOW_THREADS
+   PyBuffer_Release(&data);
+   if (error) {
+      return sicl_error("output", instrument, error);
+   }
+   return PyLong_FromUnsignedLong(count);
+}
+
+static PyObject *
+FWriteCommand(PyObject *self, PyObject *args) {
+   return write_block(args, "iy*|p:gpib_fwrite", 0, ifwrite);
+}
+
+static PyObject *
+FlushCommand(PyObject *self, PyObject *args) {
+   int instrument;
+   int mask = I_BUF_WRITE;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "i|i:gpib_flush", &instrument, &mask)) {
+      return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   error = iflush(instrument, mask);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      return sicl_error("flush", instrument, error);
+   }
+   return PyLong_FromLong(0);
 }
 
-static PyObject * CloseCommand(PyObject *self,
-                PyObject *args) {
+static PyObject *
+WriteRawCommand(PyObject *self, PyObject *args) {
+   return write_block(args, "iy*|p:gpib_write_raw", 1, iwrite);
+}
+
+/* SRQ handler installed with ionsrq; calls the Python handler */
+static void srq_trampoline(INST instrument) {
+   PyGILState_STATE state = PyGILState_Ensure();
+   PyObject *key = PyLong_FromLong(instrument);
+   PyObject *handler = NULL;
+   PyObject *result;
+
+   if (key && srq_handlers) {
+      handler = PyDict_GetItemWithError(srq_handlers, key);
+   }
+   Py_XDECREF(key);
+   if (handler) {
+      Py_INCREF(handler);
+      result = PyObject_CallFunction(handler, "i", instrument);
+      Py_XDECREF(result);
+      Py_DECREF(handler);
+   }
+   /* an exception must not escape into SICL */
+   if (PyErr_Occurred()) {
+      PyErr_WriteUnraisable(NULL);
+   }
+   PyGILState_Release(state);
+}
+
+static PyObject *
+OnSrqCommand(PyObject *self, PyObject *args) {
    int instrument;
+   PyObject *handler;
+   PyObject *key;
    int error;
-   char *err_str;
 
-   if (! PyArg_Parse(args, "(i)", &instrument) ) {
+   if (! PyArg_ParseTuple(args, "iO:gpib_onsrq", &instrument, &handler)) {
+      return NULL;
+   }
+   if (handler != Py_None && ! PyCallable_Check(handler)) {
+      PyErr_SetString(PyExc_TypeError, "handler must be callable or None");
+      return NULL;
+   }
+   if (! (key = PyLong_FromLong(instrument))) {
       return NULL;
    }
-   if ( error=iclose (instrument)) {
-      err_str = igeterrstr(error);
-      sprintf (err_msg,
-         "closing instrument failed: %s", err_str);
-      PyErr_SetString(PyExc_Exception, err_str);
-      if (gpib_diags) {
-        printf ( "closing instrument failed: %s\n", err_str);
+   /* the handler is recorded first, since SICL may call it at once */
+   if (handler == Py_None) {
+      if (PyDict_DelItem(srq_handlers, key)) {
+         PyErr_Clear();
       }
+   } else if (PyDict_SetItem(srq_handlers, key, handler)) {
+      Py_DECREF(key);
+      return NULL;
+   }
+   Py_BEGIN_ALLOW_THREADS
+   error = ionsrq(instrument, handler == Py_None ? NULL : srq_trampoline);
+   Py_END_ALLOW_THREADS
+   if (error) {
+      if (handler != Py_None && PyDict_DelItem(srq_handlers, key)) {
+         PyErr_Clear();
+      }
+      Py_DECREF(key);
+      return sicl_error("installing SRQ handler", instrument, error);
+   }
+   Py_DECREF(key);
+   return PyLong_FromLong(0);
+}
+
+static PyObject *
+WaitHdlrCommand(PyObject *self, PyObject *args) {
+   long milliseconds;
+   int error;
+
+   if (! PyArg_ParseTuple(args, "l:gpib_waithdlr", &milliseconds)) {
+      return NULL;
+   }
+   /* a handler called here takes the GIL back in srq_trampoline */
+   Py_BEGIN_ALLOW_THREADS
+   error = iwaithdlr(milliseconds);
+   Py_END_ALLOW_THREADS
+   if (error == I_ERR_TIMEOUT) {
+      Py_RETURN_FALSE;
+   }
+   if (error) {
+      PyErr_Format(PyExc_RuntimeError, "waiting for handler failed: %s",
+                   igeterrstr(error));
       return NULL;
-   } else {
-     sprintf(message, "%d closed", instrument);
-     return Py_BuildValue("s",message);
    }
+   Py_RETURN_TRUE;
+}
+
+static PyObject *
+IntrOffCommand(PyObject *self, PyObject *args) {
+   int error;
+
+   Py_BEGIN_ALLOW_THREADS
+   error = iintroff();
+   Py_END_ALLOW_THREADS
+   return PyLong_FromLong(error);
+}
+
+static PyObject *
+IntrOnCommand(PyObject *self, PyObject *args) {
+   int error;
+
+   Py_BEGIN_ALLOW_THREADS
+   error = iintron();
+   Py_END_ALLOW_THREADS
+   return PyLong_FromLong(error);
 }
 
 /* Registration table */
 
 static struct PyMethodDef sicl_methods[] = {
-  {"gpib_open",       OpenCommand,  METH_VARARGS, OpenCommand__doc__},
-  {"gpib_close",      CloseCommand,     METH_VARARGS, CloseCommand__doc__},
-  {"gpib_timeout",    TimeoutCommand,   METH_VARARGS, TimeoutCommand__doc__},
-  {"gpib_diags",      DiagCommand,      METH_VARARGS, DiagCommand__doc__},
-  {"gpib_send",       SendCommand,      METH_VARARGS, SendCommand__doc__},
-  {"gpib_rcv",        RcvCommand,       METH_VARARGS, RcvCommand__doc__},
-  {"gpib_prompt",     PromptCommand,    METH_VARARGS, PromptCommand__doc__},
-  {"gpib_lock",       LockCommand,      METH_VARARGS, LockCommand__doc__},
-  {"gpib_unlock",     UnlockCommand,    METH_VARARGS, UnlockCommand__doc__},
-  {"gpib_dev_status", DevStsCommand,    METH_VARARGS, DevStsCommand__doc__},
+  {"gpib_open",        OpenCommand,       METH_VARARGS, OpenCommand__doc__},
+  {"gpib_close",       CloseCommand,      METH_VARARGS, CloseCommand__doc__},
+  {"gpib_timeout",     TimeoutCommand,    METH_VARARGS, TimeoutCommand__doc__},
+  {"gpib_diags",       DiagCommand,       METH_VARARGS, DiagCommand__doc__},
+  {"gpib_send",        SendCommand,       METH_VARARGS, SendCommand__doc__},
+  {"gpib_rcv",         (PyCFunction)(void (*)(void))RcvCommand,
+                       METH_VARARGS | METH_KEYWORDS, RcvCommand__doc__},
+  {"gpib_read",        ReadCommand,       METH_VARARGS, ReadCommand__doc__},
+  {"gpib_read_into",   (PyCFunction)(void (*)(void))ReadIntoCommand,
+                       METH_VARARGS | METH_KEYWORDS, ReadIntoCommand__doc__},
+  {"gpib_prompt",      PromptCommand,     METH_VARARGS, PromptCommand__doc__},
+  {"gpib_prompt_many", PromptManyCommand, METH_VARARGS,
+                       PromptManyCommand__doc__},
+  {"gpib_lock",        LockCommand,       METH_VARARGS, LockCommand__doc__},
+  {"gpib_unlock",      UnlockCommand,     METH_VARARGS, UnlockCommand__doc__},
+  {"gpib_dev_status",  DevStsCommand,     METH_VARARGS, DevStsCommand__doc__},
+  {"clear",            ClearCommand,      METH_VARARGS, ClearCommand__doc__},
+  {"gpib_trigger",     TriggerCommand,    METH_VARARGS, TriggerCommand__doc__},
+  {"gpib_sendcmd",     SendCmdCommand,    METH_VARARGS, SendCmdCommand__doc__},
+  {"gpib_setbuf",      SetBufCommand,     METH_VARARGS, SetBufCommand__doc__},
+  {"gpib_fwrite",      FWriteCommand,     METH_VARARGS, FWriteCommand__doc__},
+  {"gpib_flush",       FlushCommand,      METH_VARARGS, FlushCommand__doc__},
+  {"gpib_write_raw",   WriteRawCommand,   METH_VARARGS,
+                       WriteRawCommand__doc__},
+  {"gpib_onsrq",       OnSrqCommand,      METH_VARARGS, OnSrqCommand__doc__},
+  {"gpib_waithdlr",    WaitHdlrCommand,   METH_VARARGS, WaitHdlrCommand__doc__},
+  {"gpib_introff",     IntrOffCommand,    METH_NOARGS,  IntrOffCommand__doc__},
+  {"gpib_intron",      IntrOnCommand,     METH_NOARGS,  IntrOnCommand__doc__},
   {NULL,          NULL}
 };
 
 /* module initializer */
 
-void initpysicl() {
-  (void) Py_InitModule3("pysicl", sicl_methods, pysicl__doc__);
+static struct PyModuleDef pysicl_module = {
+  PyModuleDef_HEAD_INIT, "_pysicl", pysicl__doc__, -1, sicl_methods
+};
+
+PyMODINIT_FUNC PyInit__pysicl(void) {
+  PyObject *module = PyModule_Create(&pysicl_module);
+
+  if (! module) {
+    return NULL;
+  }
+  if (! srq_handlers && ! (srq_handlers = PyDict_New())) {
+    Py_DECREF(module);
+    return NULL;
+  }
+  PyModule_AddIntConstant(module, "I_TERM_MAXCNT", I_TERM_MAXCNT);
+  PyModule_AddIntConstant(module, "I_TERM_END", I_TERM_END);
+  PyModule_AddIntConstant(module, "I_TERM_CHR", I_TERM_CHR);
+  PyModule_AddIntConstant(module, "I_BUF_READ", I_BUF_READ);
+  PyModule_AddIntConstant(module, "I_BUF_WRITE", I_BUF_WRITE);
+  return module;
 }
@@ -0,0 +1,323 @@
+"""
+Service request (SRQ) events from many instruments
+
+Rather than poll the status byte of each instrument, an SrqDispatcher
+installs a SICL SRQ handler (ionsrq) on a session to each watched device and
+waits for handlers with iwaithdlr on one thread.  When a device requests
+service it is serial polled once (ireadstb) and its status byte is passed to
+the callbacks registered for it and used to complete waiting futures::
+
+  >>> from Electronics.Interfaces.GPIB.srq import srq_dispatcher
+  >>> srq_dispatcher.watch("pm 13-1", lambda device, stb: print(device, stb))
+  >>> future = srq_dispatcher.future("pm 13-4", mask=0x10)
+  >>> future.result(timeout=5)
+  80
+
+The dispatcher turns interrupts off (iintroff) so that handlers are called
+from its own thread, in iwaithdlr, rather than asynchronously by SICL.  A
+device is serial polled once when it is first watched, so that a request it
+made before, e.g. just after a trigger, is dispatched too.
+"""
+import logging
+import threading
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+RQS = 0x40
+"""Request service bit of the status byte"""
+
+class _Watch(object):
+  """
+  A device being watched: its session, callbacks and waiting futures
+  """
+  def __init__(self, address, session):
+    self.address = address
+    self.session = session
+    self.callbacks = []
+    self.waiters = []
+
+class SrqDispatcher(object):
+  """
+  Dispatches service requests from many devices on one thread
+
+  Public attributes::
+    pool  - session pool supplying the device sessions
+    poll  - seconds each iwaithdlr call waits, which bounds how long stop()
+            takes
+    stats - dict of counters: requests, spurious, errors
+  """
+  def __init__(self, pool=None, poll=0.1):
+    """
+    @param pool : session pool; default the shared pool
+    @type  pool : pool.SessionPool
+
+    @param poll : seconds each iwaithdlr call waits
+    @type  poll : float
+    """
+    self.pool = pool or session_pool
+    self.poll = poll
+    self.stats = {"requests": 0, "spurious": 0, "errors": 0}
+    self._watches = {}
+    self._by_instr = {}
+    self._released = []
+    self._lock = threading.Lock()
+    self._thread = None
+    self._running = False
+
+  @property
+  def driver(self):
+    return self.pool.driver
+
+  def _watch(self, device, callback=None, waiter=None):
+    """
+    Add a callback or a waiting future to a device's watch.
+
+    A new watch's session is opened and its handler installed without the
+    dispatcher lock held.  The device is then serial polled once, since SICL
+    does not call a handler installed while SRQ is already asserted, as it
+    is if the device requested service before it was watched.
+    """
+    address = registry.address(device)
+    with self._lock:
+      watch = self._watches.get(address)
+      if watch is not None:
+        self._attach(watch, callback, waiter)
+        return
+    # the pool's health check is a serial poll, which would clear the
+    # request the initial poll is to find
+    session = self.pool.checkout(address, check=False)
+    try:
+      self.driver.gpib_onsrq(session.instr, self._handler)
+    except Exception:
+      self.pool.checkin(session, broken=True)
+      raise
+    with self._lock:
+      watch = self._watches.get(address)
+      if watch is None:
+        watch = self._watches[address] = _Watch(address, session)
+        self._by_instr[session.instr] = watch
+        session = None
+      self._attach(watch, callback, waiter)
+      self._start()
+    if session is None:
+      self._poll(watch, initial=True)
+    else:
+      # another thread watched the device meanwhile
+      self._release(_Watch(address, session))
+
+  def _attach(self, watch, callback, waiter):
+    if callback is not None:
+      watch.callbacks.append(callback)
+    if waiter is not None:
+      watch.waiters.append(waiter)
+
+  def _detach(self, watch):
+    """
+    Stop dispatching to a watch.  Must be called with the dispatcher lock
+    held; the watch must then be given to _release().
+
+    @return: the watch's waiting futures
+    """
+    del self._watches[watch.address]
+    del self._by_instr[watch.session.instr]
+    waiters, watch.waiters = watch.waiters, []
+    return waiters
+
+  def _release(self, watch, waiters=()):
+    """
+    Remove a detached watch's handler and return its session to the pool.
+    """
+    for waiter in waiters:
+      waiter[0].cancel()
+    broken = False
+    try:
+      self.driver.gpib_onsrq(watch.session.instr, None)
+    except Exception as details:
+      module_logger.debug("SrqDispatcher: removing handler for %s failed; %s",
+                          watch.address, details)
+      broken = True
+    self.pool.checkin(watch.session, broken=broken)
+
+  def watch(self, device, callback):
+    """
+    Call callback(address, status byte) whenever the device requests service.
+
+    @param device : device name or SICL address
+    @type  device : str
+
+    @param callback : function of the device address and its status byte
+    @type  callback : callable
+    """
+    self._watch(device, callback=callback)
+
+  def unwatch(self, device, callback=None):
+    """
+    Remove a callback, or all callbacks and waiting futures if None.
+    """
+    address = registry.address(device)
+    with self._lock:
+      watch = self._watches.get(address)
+      if watch is None:
+        return
+      waiters = []
+      if callback is None:
+        watch.callbacks = []
+        waiters, watch.waiters = watch.waiters, []
+      elif callback in watch.callbacks:
+        watch.callbacks.remove(callback)
+      released = not watch.callbacks and not watch.waiters
+      if released:
+        self._detach(watch)
+    if released:
+      self._release(watch, waiters)
+    else:
+      for future, mask in waiters:
+        future.cancel()
+
+  def future(self, device, mask=RQS):
+    """
+    A future for the status byte at the device's next service request.
+
+    A request already pending when the device is first watched counts.
+
+    @param mask : status bits of which at least one must be set
+    @type  mask : int
+
+    @return: concurrent.futures.Future
+    """
+    future = futures.Future()
+    self._watch(device, waiter=(future, mask))
+    return future
+
+  def wait(self, device, mask=RQS, timeout=None):
+    """
+    Wait for the device to request service.
+
+    @param timeout : seconds to wait; None waits for ever
+    @type  timeout : float
+
+    @return: status byte, or None on timeout
+    """
+    future = self.future(device, mask)
+    try:
+      return future.result(timeout)
+    except futures.TimeoutError:
+      self._discard(registry.address(device), future)
+      return None
+
+  def _discard(self, address, future):
+    with self._lock:
+      watch = self._watches.get(address)
+      if watch is None:
+        return
+      watch.waiters = [waiter for waiter in watch.waiters
+                       if waiter[0] is not future]
+      if watch.callbacks or watch.waiters:
+        return
+      self._detach(watch)
+    self._release(watch)
+
+  def _handler(self, instr):
+    """
+    SRQ handler: serial poll the device and dispatch its status byte.
+    """
+    try:
+      with self._lock:
+        watch = self._by_instr.get(instr)
+      if watch is not None:
+        self._poll(watch)
+    except Exception as details:
+      # an exception must not escape into SICL
+      module_logger.error("SrqDispatcher: handler failed; %s", details)
+
+  def _poll(self, watch, initial=False):
+    """
+    Serial poll a watched device and dispatch its status byte if it is
+    requesting service.
+
+    @param initial : True for the poll of a newly watched device, which
+                     need not be requesting service
+    @type  initial : bool
+    """
+    try:
+      stb = self.driver.gpib_dev_status(watch.session.instr)
+    except Exception as details:
+      self.stats["errors"] += 1
+      module_logger.warning("SrqDispatcher: serial poll of %s failed; %s",
+                            watch.address, details)
+      return
+    if not stb & RQS:
+      if not initial:
+        # another device on the bus asserted SRQ
+        self.stats["spurious"] += 1
+      return
+    self.stats["requests"] += 1
+    with self._lock:
+      callbacks = list(watch.callbacks)
+      ready = [waiter for waiter in watch.waiters if stb & waiter[1]]
+      watch.waiters = [waiter for waiter in watch.waiters
+                       if not stb & waiter[1]]
+      if (not watch.callbacks and not watch.waiters and
+          self._watches.get(watch.address) is watch):
+        self._released.append(watch)
+    for future, mask in ready:
+      if future.set_running_or_notify_cancel():
+        future.set_result(stb)
+    for callback in callbacks:
+      try:
+        callback(watch.address, stb)
+      except Exception as details:
+        self.stats["errors"] += 1
+        module_logger.error("SrqDispatcher: callback for %s failed; %s",
+                            watch.address, details)
+
+  def _start(self):
+    if self._thread is None:
+      self._running = True
+      self._thread = threading.Thread(target=self._run, name="GPIB SRQ")
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _run(self):
+    driver = self.driver
+    driver.gpib_introff()
+    try:
+      while self._running:
+        try:
+          driver.gpib_waithdlr(max(1, int(self.poll*1000)))
+        except Exception as details:
+          module_logger.error("SrqDispatcher: waiting failed; %s", details)
+        with self._lock:
+          released, self._released = self._released, []
+          # the device may have been watched again since
+          released = [watch for watch in released
+                      if not watch.callbacks and not watch.waiters and
+                      self._watches.get(watch.address) is watch]
+          for watch in released:
+            self._detach(watch)
+        for watch in released:
+          self._release(watch)
+    finally:
+      driver.gpib_intron()
+
+  def stop(self):
+    """
+    Stop the dispatcher thread and stop watching every device.
+    """
+    with self._lock:
+      thread, self._thread = self._thread, None
+      self._running = False
+    if thread is not None:
+      thread.join()
+    with self._lock:
+      watches = [(watch, self._detach(watch))
+                 for watch in list(self._watches.values())]
+      self._released = []
+    for watch, waiters in watches:
+      self._release(watch, waiters)
+
+srq_dispatcher = SrqDispatcher()
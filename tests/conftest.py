@@ -0,0 +1,50 @@
+"""
+Test set-up: makes the package importable as Electronics.Interfaces.GPIB and
+provides a simulated bus, so that the tests need neither SICL nor hardware
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+def _install_package():
+  """
+  Put the repository on sys.path under its installed name, if it is not.
+  """
+  try:
+    import Electronics.Interfaces.GPIB
+    return
+  except ImportError:
+    pass
+  root = tempfile.mkdtemp(prefix="gpib-tests-")
+  interfaces = os.path.join(root, "Electronics", "Interfaces")
+  os.makedirs(interfaces)
+  for directory in (os.path.join(root, "Electronics"), interfaces):
+    open(os.path.join(directory, "__init__.py"), "w").close()
+  os.symlink(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+             os.path.join(interfaces, "GPIB"))
+  sys.path.insert(0, root)
+
+_install_package()
+
+@pytest.fixture
+def sim():
+  """
+  A SimBackend with the registry's devices, in use for the test.
+
+  The instruments answer in 1 ms so that tests are quick.  Pooled sessions
+  are closed afterwards, since they belong to this backend.
+  """
+  from Electronics.Interfaces.GPIB import gpib_ct
+  from Electronics.Interfaces.GPIB.pool import session_pool
+  from Electronics.Interfaces.GPIB.sim import SimBackend
+  backend = SimBackend.from_registry(turnaround=0.0001)
+  for instrument in backend.instruments.values():
+    instrument.latency = 0.001
+    instrument.latencies = {}
+  session_pool.close_all()
+  previous = gpib_ct.use_backend(backend)
+  yield backend
+  session_pool.close_all()
+  gpib_ct.use_backend(previous if previous is not None else "sicl")
@@ -0,0 +1,79 @@
+"""
+Tests of background acquisition on the simulated bus
+"""
+import time
+
+import pytest
+
+from Electronics.Interfaces.GPIB import Gpib
+from Electronics.Interfaces.GPIB.acquisition import Acquisition, RingBuffer
+from Electronics.Interfaces.GPIB.registry import registry
+
+def test_block_policy_buffer_accepts_samples_after_reopen():
+  buffer = RingBuffer(1, "block")
+  buffer.put(0., 1.)
+  buffer.close()
+  assert not buffer.put(1., 2.)
+  buffer.reopen()
+  buffer.read()
+  assert buffer.put(2., 3.)
+
+def _wait_for(condition, timeout=5.):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test_restart_after_stop(sim):
+  """
+  A stopped acquisition acquires again when started, even with the block
+  policy, whose producer stops when the buffer is closed.
+  """
+  acquisition = Acquisition("pm 13-1", "TR2", capacity=4, policy="block")
+  acquisition.start()
+  assert _wait_for(lambda: len(acquisition.buffer) == 4)
+  acquisition.stop()
+  acquisition.buffer.read()
+  acquisition.start()
+  try:
+    assert _wait_for(lambda: len(acquisition.buffer) == 4)
+    assert acquisition.errors == 0
+  finally:
+    acquisition.stop()
+
+def _no_formatted_writes(monkeypatch, sim):
+  def write(instr, data):
+    raise AssertionError("query sent through the formatted buffer")
+  monkeypatch.setattr(sim, "write", write)
+
+def test_acquisition_query_is_not_buffered(sim, monkeypatch):
+  _no_formatted_writes(monkeypatch, sim)
+  acquisition = Acquisition("pm 13-1", "TR2")
+  acquisition.start()
+  try:
+    assert _wait_for(lambda: acquisition.samples >= 2)
+    assert acquisition.errors == 0
+  finally:
+    acquisition.stop()
+
+def test_ask_array_query_is_not_buffered(sim, monkeypatch):
+  _no_formatted_writes(monkeypatch, sim)
+  device = Gpib("pm 13-1")
+  try:
+    values = device.ask_array("TR2")
+    assert values.shape == (1,)
+    assert -40. < values[0] < -20.
+  finally:
+    device.close()
+
+def test_bad_responses_are_not_polled_back_to_back(sim):
+  sim.instruments[registry.address("pm 13-1")].default = "ERROR"
+  acquisition = Acquisition("pm 13-1", "TR2")
+  acquisition.retry_delay = 0.1
+  acquisition.start()
+  try:
+    time.sleep(0.35)
+  finally:
+    acquisition.stop()
+  assert 1 <= acquisition.errors <= 5
+  assert acquisition.samples == 0
\ No newline at end of file
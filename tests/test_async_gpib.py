@@ -0,0 +1,45 @@
+"""
+Tests of AsyncGpib on the simulated bus
+"""
+import asyncio
+
+from Electronics.Interfaces.GPIB.async_gpib import AsyncGpib
+from Electronics.Interfaces.GPIB.pool import session_pool
+
+def test_operation_timeout_is_restored(sim):
+  """
+  An operation's timeout must not stay on the session for later users.
+  """
+  async def main():
+    device = AsyncGpib("pm 13-1")
+    assert (await device.ask("?ID", timeout=0.5)).strip() == "HP438A"
+    session = device.session
+    assert session.timeout is None
+    assert sim._sessions[session.instr].timeout == 10000
+    await device.close()
+    return session
+  session = asyncio.run(main())
+  with session_pool.session("pm 13-1") as pooled:
+    assert pooled is session
+    assert sim._sessions[pooled.instr].timeout == 10000
+
+def test_short_timeout_is_not_infinite(sim):
+  """
+  A timeout under 1 ms must not become SICL's 0, no timeout at all.
+  """
+  timeouts = []
+  set_timeout = sim.timeout
+  def record(instr, milliseconds):
+    timeouts.append(milliseconds)
+    return set_timeout(instr, milliseconds)
+  sim.timeout = record
+  async def main():
+    device = AsyncGpib("pm 13-1")
+    try:
+      await device.ask("?ID", timeout=0.0001)
+    except Exception:
+      pass
+    await device.close()
+  asyncio.run(main())
+  assert 0 not in timeouts
+  assert 1 in timeouts
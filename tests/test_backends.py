@@ -0,0 +1,36 @@
+"""
+Tests of the SICL calls made by the backends
+"""
+import ctypes as ct
+
+from Electronics.Interfaces.GPIB.backends import SiclBackend, I_BUF_WRITE
+
+class RecordingLibrary(object):
+  """
+  Stands in for libsicl, recording the calls made
+  """
+  def __init__(self):
+    self.calls = []
+    for name in ("iprintf", "iflush", "ipromptf"):
+      setattr(self, name, self._recorder(name))
+
+  def _recorder(self, name):
+    def call(*args):
+      self.calls.append((name,) + args)
+      return 0
+    return call
+
+def test_write_is_not_a_format_and_is_flushed():
+  library = RecordingLibrary()
+  backend = SiclBackend(library=library)
+  backend.write(3, b"OFFSET 50%")
+  assert library.calls == [("iprintf", 3, b"%s", b"OFFSET 50%"),
+                           ("iflush", 3, I_BUF_WRITE)]
+
+def test_prompt_is_not_a_format():
+  library = RecordingLibrary()
+  backend = SiclBackend(library=library)
+  backend.prompt(3, b"DUTY 50%?")
+  name, instr, writefmt, readfmt, data, response = library.calls[0]
+  assert (name, instr, writefmt, readfmt, data) == \
+         ("ipromptf", 3, b"%s", b"%t", b"DUTY 50%?")
@@ -0,0 +1,65 @@
+"""
+Tests of the query cache
+"""
+import threading
+
+from Electronics.Interfaces.GPIB import Gpib
+from Electronics.Interfaces.GPIB.cache import QueryCache
+from Electronics.Interfaces.GPIB.registry import registry
+
+address = registry.address("pm 13-1")
+
+def test_neutral_command_keeps_entries():
+  cache = QueryCache()
+  cache.ask(address, "?ID", lambda command: "HP437B")
+  cache.ask(address, "TR2", lambda command: "")
+  assert cache.get(address, "?ID") == (True, "HP437B")
+  cache.ask(address, "RE3", lambda command: "")
+  assert cache.get(address, "?ID") == (False, None)
+
+def test_response_overtaken_by_a_write_is_not_cached():
+  """
+  A query in flight when the device is written to must not cache the
+  response it got before the write.
+  """
+  cache = QueryCache()
+  sent = threading.Event()
+  written = threading.Event()
+  def prompt(command):
+    sent.set()
+    written.wait(5)
+    return "old"
+  thread = threading.Thread(target=cache.ask, args=(address, "?ID", prompt))
+  thread.start()
+  sent.wait(5)
+  cache.ask(address, "RE3", lambda command: "")
+  written.set()
+  thread.join(5)
+  assert cache.get(address, "?ID") == (False, None)
+  assert cache.stats["stale"] == 1
+
+def test_gpib_trigger_poll_keeps_identification(sim):
+  cache = QueryCache()
+  device = Gpib("pm 13-1", cache=cache)
+  try:
+    identity = device.ask("?ID")
+    device.write("TR2")
+    device.read()
+    assert cache.get(device.address, "?ID") == (True, identity)
+    device.write("RE3")
+    assert cache.get(device.address, "?ID") == (False, None)
+  finally:
+    device.close()
+
+def test_compound_command_with_a_setting_is_not_cached():
+  cache = QueryCache()
+  cache.rule(r".*", None)
+  cache.ask(address, "?ID", lambda command: "HP437B")
+  cache.ask(address, "RE3;?ID", lambda command: "HP437B")
+  assert cache.get(address, "?ID") == (False, None)
+  assert cache.get(address, "RE3;?ID") == (False, None)
+  cache.ask(address, "?ID", lambda command: "HP437B")
+  cache.ask(address, "TR0;TR2", lambda command: "")
+  assert cache.get(address, "?ID") == (True, "HP437B")
+  cache.ask(address, "?ID;?ID", lambda command: "HP437B;HP437B")
+  assert cache.get(address, "?ID;?ID") == (True, "HP437B;HP437B")
@@ -0,0 +1,45 @@
+"""
+Tests of traffic capture and replay on the simulated bus
+"""
+from Electronics.Interfaces.GPIB import capture, gpib_ct
+from Electronics.Interfaces.GPIB.registry import registry
+
+def test_capture_records_sessions_opened_before_start(sim, tmp_path):
+  path = str(tmp_path/"pm.gpibcap")
+  instr = gpib_ct.gpib_open("pm 13-1")
+  try:
+    with capture.Recorder(path):
+      gpib_ct.gpib_send_many(instr, ["TR0", "?ID"])
+      gpib_ct.gpib_rcv(instr)
+      gpib_ct.gpib_write_raw(instr, b"TR2\n")
+      gpib_ct.gpib_read(instr, 64)
+      gpib_ct.gpib_trigger(instr)
+      assert gpib_ct.gpib_prompt(instr, "?ID").strip() == "HP438A"
+  finally:
+    gpib_ct.gpib_close(instr)
+  records = capture.CaptureFile(path).records
+  assert set(record.address for record in records) == \
+         set([registry.address("pm 13-1")])
+  assert [record.operation for record in records] == [
+    capture.FWRITE, capture.FWRITE, capture.FLUSH, capture.RCV,
+    capture.WRITE_RAW, capture.READ, capture.TRIGGER, capture.PROMPT]
+  assert records[1].reason == 1 and records[4].reason == 1
+  stats = capture.replay(path)
+  assert stats["calls"] == len(records)
+  assert stats["errors"] == 0
+
+def test_replay_backend_answers_recorded_queries(sim, tmp_path):
+  path = str(tmp_path/"pm.gpibcap")
+  with capture.Recorder(path):
+    instr = gpib_ct.gpib_open("pm 13-1")
+    gpib_ct.gpib_send_many(instr, ["TR0"])
+    gpib_ct.gpib_prompt(instr, "?ID")
+    gpib_ct.gpib_close(instr)
+  previous = gpib_ct.use_backend(capture.ReplayBackend(path))
+  try:
+    instr = gpib_ct.gpib_open("pm 13-1")
+    gpib_ct.gpib_send_many(instr, ["TR0"])
+    assert gpib_ct.gpib_prompt(instr, "?ID").strip() == "HP438A"
+    gpib_ct.gpib_close(instr)
+  finally:
+    gpib_ct.use_backend(previous)
@@ -0,0 +1,42 @@
+"""
+Tests of the Gpib class on the simulated bus
+"""
+import pytest
+
+from Electronics.Interfaces.GPIB import Gpib
+from Electronics.Interfaces.GPIB.pool import session_pool
+
+def test_tmo_is_restored_on_close(sim):
+  """
+  A timeout set with tmo() must not stay on the pooled session.
+  """
+  device = Gpib("pm 13-1")
+  session = device.session
+  device.tmo(50)
+  assert sim._sessions[session.instr].timeout == 50
+  device.close()
+  assert session.timeout is None
+  assert sim._sessions[session.instr].timeout == 10000
+  other = Gpib("pm 13-1")
+  assert other.session is session
+  other.close()
+
+def test_failed_reopen_is_retried(sim, monkeypatch):
+  """
+  If no new session can be opened after a failure, the next call opens one.
+  """
+  device = Gpib("pm 13-1")
+  device.tmo(500)
+  def refuse(*args):
+    raise RuntimeError("refused")
+  monkeypatch.setattr(sim, "open", refuse)
+  monkeypatch.setattr(sim, "write", refuse)
+  with pytest.raises(RuntimeError):
+    device.write("?ID")
+  assert device.session is None
+  monkeypatch.undo()
+  assert device.ask("?ID").strip() == "HP438A"
+  assert sim._sessions[device.instrument].timeout == 500
+  device.close()
+  with pytest.raises(RuntimeError):
+    device.rsp()
@@ -0,0 +1,28 @@
+"""
+Tests of the conversion of responses to arrays
+"""
+import numpy
+import pytest
+
+from Electronics.Interfaces.GPIB.ieee488 import ascii_array
+
+@pytest.mark.parametrize("format, magnitude", [
+  ("%+.5E", 1e-30), ("%+.8E", 1e-40), ("%+.14E", 1e250), ("%+.4E", 1e-3),
+  ("%+.6E", 1e20), ("%.3f", 1.), ("%+.10E", 1e-300)])
+def test_fixed_width_list_matches_float(format, magnitude):
+  """
+  Every number must convert to the float() of its text.
+  """
+  generator = numpy.random.RandomState(22)
+  numbers = generator.uniform(0.1, 10., 5000)*magnitude
+  numbers[::2] *= -1
+  if not format.startswith("%+"):
+    numbers = abs(numbers)
+  texts = [format % number for number in numbers]
+  values = ascii_array(",".join(texts).encode("latin-1"))
+  expected = numpy.array([float(text) for text in texts])
+  assert (values == expected).all()
+
+def test_mixed_layouts():
+  values = ascii_array(b"1.5, -2.25E+01,3\n")
+  assert values.tolist() == [1.5, -22.5, 3.]
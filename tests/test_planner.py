@@ -0,0 +1,45 @@
+"""
+Tests of the poll planner on the simulated bus
+"""
+import time
+from concurrent import futures
+
+from Electronics.Interfaces.GPIB.planner import PollPlanner
+from Electronics.Interfaces.GPIB.scheduler import BusScheduler
+
+def test_rate_after_restart(sim):
+  """
+  The counts start again when the planner is restarted, so the rate is the
+  requested one.
+  """
+  scheduler = BusScheduler()
+  planner = PollPlanner([("pm 13-1", "TR2", 0.05)], scheduler=scheduler)
+  try:
+    planner.start()
+    time.sleep(0.5)
+    planner.stop()
+    time.sleep(0.5)
+    planner.start()
+    time.sleep(0.5)
+    planner.stop()
+    report, = planner.report()
+    assert 14 <= report["rate"] <= 26
+    assert 7 <= report["polls"] <= 13
+    assert report["errors"] == 0
+  finally:
+    planner.stop()
+    scheduler.shutdown()
+
+def test_cancelled_poll_is_missed(sim):
+  scheduler = BusScheduler()
+  planner = PollPlanner([("pm 13-1", "TR2", 1.)], scheduler=scheduler)
+  try:
+    entry, = planner.entries
+    future = futures.Future()
+    future.cancel()
+    entry.outstanding = True
+    planner._done(entry, time.time(), future)
+    assert entry.missed == 1 and entry.errors == 0
+    assert not entry.outstanding
+  finally:
+    scheduler.shutdown()
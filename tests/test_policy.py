@@ -0,0 +1,135 @@
+"""
+Tests of the device policy on the simulated bus
+"""
+import threading
+import time
+
+import pytest
+
+from Electronics.Interfaces.GPIB import gpib_ct
+from Electronics.Interfaces.GPIB.policy import CLOSED, OPEN, DevicePolicy, \
+     DeviceUnavailable
+from Electronics.Interfaces.GPIB.pool import SessionPool
+from Electronics.Interfaces.GPIB.registry import registry
+
+def _policy_pool(policy):
+  pool = SessionPool()
+  pool.policy = policy
+  return pool
+
+def test_stop_during_failing_probe(sim):
+  """
+  A probe which fails while stop() waits for it must not start another
+  prober, or stop() never returns.
+  """
+  # "pm 13-2" is not alive, so it is probed from the start
+  sim.instruments[registry.address("pm 13-2")].alive = False
+  policy = DevicePolicy(initial=200, probe_interval=0.01)
+  assert policy.state("pm 13-2")["state"] == OPEN
+  deadline = time.time() + 5
+  while not policy.stats["probes"] and time.time() < deadline:
+    time.sleep(0.001)
+  stopper = threading.Thread(target=policy.stop)
+  stopper.start()
+  stopper.join(5)
+  assert not stopper.is_alive()
+  assert not [thread for thread in threading.enumerate()
+              if thread.name == "GPIB policy probes"]
+
+def test_unlearned_timeout_is_not_doubled():
+  policy = DevicePolicy(initial=300, min_samples=2)
+  try:
+    assert policy.timeout("pm 13-1", attempt=1) == 300
+    for latency in (0.01, 0.02):
+      policy._succeeded(policy._devices[registry.address("pm 13-1")],
+                        latency)
+    learned = policy.timeout("pm 13-1")
+    assert learned < 300
+    assert policy.timeout("pm 13-1", attempt=1) == 2*learned
+  finally:
+    policy.stop()
+
+def test_probe_uses_short_timeout(sim):
+  sim.instruments[registry.address("pm 13-2")].alive = False
+  policy = DevicePolicy(initial=2000, probe_interval=0.01, probe_timeout=50)
+  try:
+    policy.state("pm 13-2")
+    deadline = time.time() + 5
+    while policy.stats["probes"] < 2 and time.time() < deadline:
+      time.sleep(0.001)
+    start = time.time()
+    policy.stop()
+    # stop() waits for at most the probe in progress
+    assert time.time() - start < 0.5
+  finally:
+    policy.stop()
+
+def test_timeout_adapts_to_latencies(sim):
+  policy = DevicePolicy(initial=2000, min_samples=3, minimum=50)
+  pool = _policy_pool(policy)
+  try:
+    for count in range(5):
+      pool.call("pm 13-1", gpib_ct.gpib_prompt, "?ID")
+    timeout = policy.state("pm 13-1")["timeout"]
+    assert 50 <= timeout < 2000
+  finally:
+    policy.stop()
+    pool.close_all()
+
+def test_retry_with_backoff(sim):
+  policy = DevicePolicy(retries=1, backoff=0.05, threshold=5)
+  pool = _policy_pool(policy)
+  calls = []
+  def flaky(instr):
+    calls.append(time.time())
+    if len(calls) == 1:
+      raise RuntimeError("flaky")
+    return "ok"
+  try:
+    assert pool.call("pm 13-1", flaky) == "ok"
+    assert policy.stats["retries"] == 1
+    assert calls[1] - calls[0] >= 0.025
+  finally:
+    policy.stop()
+    pool.close_all()
+
+def test_circuit_opens_and_recovers(sim):
+  instrument = sim.instruments[registry.address("pm 13-4")]
+  policy = DevicePolicy(retries=0, threshold=2, probe_interval=0.02,
+                        probe_timeout=10)
+  pool = _policy_pool(policy)
+  def fail(instr):
+    raise RuntimeError("no answer")
+  try:
+    for count in range(2):
+      with pytest.raises(RuntimeError):
+        pool.call("pm 13-4", fail)
+    assert policy.state("pm 13-4")["state"] == OPEN
+    with pytest.raises(DeviceUnavailable):
+      pool.call("pm 13-4", gpib_ct.gpib_prompt, "?ID")
+    deadline = time.time() + 5
+    while (policy.state("pm 13-4")["state"] == OPEN and
+           time.time() < deadline):
+      time.sleep(0.01)
+    assert policy.state("pm 13-4")["state"] == CLOSED
+    assert policy.stats["recovered"] == 1
+    assert pool.call("pm 13-4", gpib_ct.gpib_prompt, "?ID").strip()
+  finally:
+    policy.stop()
+    pool.close_all()
+
+def test_failing_to_open_opens_circuit(sim, monkeypatch):
+  policy = DevicePolicy(retries=1, backoff=0.001, threshold=2,
+                        probe_interval=60)
+  pool = _policy_pool(policy)
+  def refuse(address):
+    raise RuntimeError("gateway down")
+  monkeypatch.setattr(sim, "open", refuse)
+  try:
+    with pytest.raises(RuntimeError):
+      pool.call("pm 13-5", gpib_ct.gpib_prompt, "?ID")
+    assert policy.stats["failures"] == 2
+    assert policy.state("pm 13-5")["state"] == OPEN
+  finally:
+    policy.stop()
+    pool.close_all()
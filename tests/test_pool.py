@@ -0,0 +1,36 @@
+"""
+Tests of the session pool on the simulated bus
+"""
+import pytest
+
+from Electronics.Interfaces.GPIB import gpib_ct
+from Electronics.Interfaces.GPIB.pool import session_pool
+
+def test_failed_call_is_not_repeated(sim):
+  """
+  A write which fails may have reached the device, so it is not sent again
+  unless the caller asks for retries.
+  """
+  calls = []
+  def send(instr, command):
+    calls.append(command)
+    raise RuntimeError("timeout")
+  with pytest.raises(RuntimeError):
+    session_pool.call("pm 13-1", send, "TR2")
+  assert calls == ["TR2"]
+  with pytest.raises(RuntimeError):
+    session_pool.call("pm 13-1", send, "TR2", retries=1)
+  assert calls == ["TR2"]*3
+
+def test_failed_open_is_retried(sim, monkeypatch):
+  opened = sim.open
+  failures = []
+  def open_once(address):
+    if not failures:
+      failures.append(address)
+      raise RuntimeError("gateway busy")
+    return opened(address)
+  monkeypatch.setattr(sim, "open", open_once)
+  assert session_pool.call("pm 13-1", gpib_ct.gpib_prompt,
+                           "?ID").strip() == "HP438A"
+  assert len(failures) == 1
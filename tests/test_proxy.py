@@ -0,0 +1,47 @@
+"""
+Tests of the GPIB proxy, served on a Unix socket from the simulated bus
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from Electronics.Interfaces.GPIB import proxy
+
+@pytest.fixture
+def client(sim):
+  # a short path, since Unix socket paths are limited to about 100 bytes
+  directory = tempfile.mkdtemp(prefix="gpib-proxy-")
+  server = proxy.ProxyServer(os.path.join(directory, "gpib.sock")).start()
+  client = proxy.ProxyClient(server.address)
+  yield client
+  client.close()
+  server.shutdown()
+  shutil.rmtree(directory)
+
+def test_ask(client):
+  device = proxy.Gpib("pm 13-1", client)
+  assert device.ask("?ID").strip() == "HP438A"
+
+def test_write_and_read(client):
+  device = proxy.Gpib("pm 13-1", client)
+  device.write("TR2")
+  assert -40. < float(device.read()) < -20.
+  device.write("TR2")
+  data = device.readbin(64)
+  assert isinstance(data, bytes)
+  assert device.ibcnt() == len(data)
+  assert -40. < float(data) < -20.
+
+def test_write_many(client):
+  device = proxy.Gpib("pm 13-1", client)
+  assert device.write_many(["TR0", "?ID"]) == len("TR0\n?ID\n")
+  assert device.read().strip() == "HP438A"
+
+def test_unknown_operation(client):
+  with pytest.raises(RuntimeError) as error:
+    client.submit("format", "pm 13-1").result(5)
+  assert "bad request" in str(error.value)
+  # the connection is still usable
+  assert client.dev_status("pm 13-1") >= 0
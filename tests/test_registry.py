@@ -0,0 +1,34 @@
+"""
+Tests of the device registry
+"""
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.registry import DeviceRegistry
+
+conf = """
+interface {
+  minor = 0
+  board_type = "ni_pci"
+  pad = 0
+}
+device {
+  minor = 0x1
+  name = "counter"
+  pad = 0x0d
+  sad = 0x60
+}
+device {
+  minor = 0
+  name = "meter"
+  pad = 017
+}
+"""
+
+def test_load_conf_reads_hexadecimal_and_octal(tmp_path):
+  path = tmp_path/"gpib.conf"
+  path.write_text(conf)
+  registry = DeviceRegistry()
+  assert registry.load_conf(str(path)) == 2
+  assert registry.address("counter") == gpib_address.device_address(
+    "gpib1", 13, 0x60)
+  assert registry.address("meter") == gpib_address.device_address("gpib0", 15,
+                                                                   None)
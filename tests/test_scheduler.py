@@ -0,0 +1,90 @@
+"""
+Tests of the per-bus scheduler on the simulated bus
+"""
+import threading
+
+import pytest
+
+from Electronics.Interfaces.GPIB.scheduler import BusScheduler, \
+     DeadlineExceeded
+
+def test_cancelling_a_coalesced_query_leaves_the_others(sim):
+  """
+  Identical queries share one transaction but not one future.
+  """
+  scheduler = BusScheduler()
+  hold = threading.Event()
+  try:
+    # keep the bus busy so that the queries below wait together
+    blocker = scheduler.submit("pm 13-1", lambda instr: hold.wait(5))
+    first = scheduler.ask("pm 13-1", "?ID")
+    second = scheduler.ask("pm 13-1", "?ID")
+    assert first is not second
+    assert second.cancel()
+    hold.set()
+    assert first.result(5).strip() == "HP438A"
+    assert second.cancelled()
+    assert blocker.result(5)
+    metrics = scheduler.metrics()
+    assert sum(bus["coalesced"] for bus in metrics.values()) == 1
+    assert sum(bus["served"] for bus in metrics.values()) == 2
+  finally:
+    hold.set()
+    scheduler.shutdown()
+
+def test_cancelling_every_caller_skips_the_query(sim):
+  scheduler = BusScheduler()
+  hold = threading.Event()
+  try:
+    scheduler.submit("pm 13-1", lambda instr: hold.wait(5))
+    futures = [scheduler.ask("pm 13-1", "?ID") for count in range(3)]
+    assert all(future.cancel() for future in futures)
+    hold.set()
+    scheduler.ask("pm 13-1", "?ID").result(5)
+    assert sum(bus["served"] for bus in scheduler.metrics().values()) == 2
+  finally:
+    hold.set()
+    scheduler.shutdown()
+
+def test_coalesced_callers_keep_their_own_deadlines(sim):
+  """
+  A caller joining a query takes it to its own priority and deadline, and
+  only the caller whose deadline passes fails.
+  """
+  scheduler = BusScheduler()
+  hold = threading.Event()
+  running = threading.Event()
+  def block(instr):
+    running.set()
+    return hold.wait(5)
+  try:
+    scheduler.submit("pm 13-1", block)
+    running.wait(5)
+    hurried = scheduler.ask("pm 13-1", "?ID", deadline=0.01)
+    patient = scheduler.ask("pm 13-1", "?ID", priority=5)
+    threading.Event().wait(0.05)
+    hold.set()
+    assert patient.result(5).strip() == "HP438A"
+    with pytest.raises(DeadlineExceeded):
+      hurried.result(5)
+  finally:
+    hold.set()
+    scheduler.shutdown()
+
+def test_joining_caller_raises_priority(sim):
+  scheduler = BusScheduler()
+  hold = threading.Event()
+  order = []
+  try:
+    scheduler.submit("pm 13-1", lambda instr: hold.wait(5))
+    low = scheduler.submit("pm 13-1", lambda instr: order.append("low"))
+    first = scheduler.dev_status("pm 13-1")
+    joined = scheduler.dev_status("pm 13-1", priority=5)
+    joined.add_done_callback(lambda future: order.append("status"))
+    hold.set()
+    low.result(5)
+    first.result(5)
+    assert order[0] == "status"
+  finally:
+    hold.set()
+    scheduler.shutdown()
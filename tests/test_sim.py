@@ -0,0 +1,39 @@
+"""
+Tests of the simulated backend itself
+"""
+import threading
+import time
+
+from Electronics.Interfaces.GPIB import gpib_ct
+
+def test_prompt(sim):
+  instr = gpib_ct.gpib_open("pm 13-1")
+  try:
+    assert gpib_ct.gpib_prompt(instr, "?ID").strip() == "HP438A"
+  finally:
+    gpib_ct.gpib_close(instr)
+
+def test_infinite_timeout_waits_for_lock(sim):
+  """
+  A timeout of 0 is infinite in SICL, so waiting for a lock must block until
+  it is released rather than fail at once.
+  """
+  owner = gpib_ct.gpib_open("pm 13-1")
+  waiter = gpib_ct.gpib_open("pm 13-1")
+  gpib_ct.gpib_timeout(waiter, 0)
+  gpib_ct.gpib_lock(owner)
+  result = []
+  def lock():
+    try:
+      result.append(gpib_ct.gpib_lock(waiter))
+    except Exception as details:
+      result.append(details)
+  thread = threading.Thread(target=lock)
+  thread.start()
+  time.sleep(0.2)
+  assert result == []
+  gpib_ct.gpib_unlock(owner)
+  thread.join(5)
+  assert result == [0]
+  for instr in (owner, waiter):
+    gpib_ct.gpib_close(instr)
@@ -0,0 +1,53 @@
+"""
+Tests of the time series sink
+"""
+import threading
+import time
+
+import numpy
+
+from Electronics.Interfaces.GPIB import sink
+from Electronics.Interfaces.GPIB.sink import TimeSeriesSink, TimeSeriesReader
+
+def test_round_trip(tmp_path):
+  root = str(tmp_path)
+  with TimeSeriesSink(root, batch_size=16) as store:
+    for count in range(100):
+      store.put(count*0.1, "pm 13-1", "power", -30. - count)
+    store.put_many("pm 13-1", "trace", numpy.arange(100)*0.1,
+                   numpy.arange(100.))
+  reader = TimeSeriesReader(root)
+  assert reader.devices() == ["pm 13-1"]
+  times, values = reader.read("pm 13-1", 1., 2., channel="power")
+  assert numpy.allclose(times, numpy.arange(10, 20)*0.1)
+  assert numpy.allclose(values, -30. - numpy.arange(10, 20))
+
+def test_no_samples_lost_under_back_pressure(tmp_path, monkeypatch):
+  """
+  Threads putting to one device while the writer is slow must neither lose
+  nor repeat samples.
+  """
+  write = sink._Store.write
+  def slow_write(self, batch, channels):
+    time.sleep(0.001)
+    return write(self, batch, channels)
+  monkeypatch.setattr(sink._Store, "write", slow_write)
+  root = str(tmp_path)
+  store = TimeSeriesSink(root, batch_size=4, max_pending=1)
+  def produce(thread):
+    for count in range(200):
+      sample = thread*1000 + count
+      store.put(float(sample), "pm 13-1", "power", float(sample))
+  threads = [threading.Thread(target=produce, args=(thread,))
+             for thread in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  store.close()
+  assert store.stats["stalls"] > 0
+  assert store.stats["errors"] == 0
+  times, values = TimeSeriesReader(root).read("pm 13-1", channel="power")
+  expected = sorted(thread*1000. + count for thread in range(4)
+                    for count in range(200))
+  assert sorted(values) == expected
@@ -0,0 +1,71 @@
+"""
+Tests of group triggered snapshots on the simulated bus
+"""
+from Electronics.Interfaces.GPIB import Gpib
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.registry import registry
+from Electronics.Interfaces.GPIB.snapshot import GroupTrigger
+
+devices = ["pm 13-1", "pm 13-4"]
+
+def _record(sim):
+  """
+  Record the commands each meter receives and the bus commands sent.
+  """
+  received = {}
+  for name in devices:
+    instrument = sim.instruments[registry.address(name)]
+    received[name] = []
+    def receive(command, instrument=instrument, log=received[name],
+                original=instrument.receive):
+      log.append(command.decode("latin-1").strip())
+      return original(command)
+    instrument.receive = receive
+  sent = []
+  sendcmd = sim.sendcmd
+  def record(instr, data):
+    sent.append(data)
+    return sendcmd(instr, data)
+  sim.sendcmd = record
+  return received, sent
+
+def test_one_trigger_reaches_every_device(sim):
+  received, sent = _record(sim)
+  trigger = GroupTrigger()
+  try:
+    results = trigger.snapshot(devices)
+  finally:
+    trigger.close()
+  addresses = [registry.address(name) for name in devices]
+  assert sent == [gpib_address.listen_commands(addresses)]
+  assert trigger.stats["triggers"] == 1
+  assert trigger.stats["readings"] == 2
+  assert results["pm 13-1"][0] == results["pm 13-4"][0]
+  for name in devices:
+    assert sim.instruments[registry.address(name)].triggers == 1
+    assert -31. < results[name][1] < -29.
+    # armed, read on the GET, then back to free run
+    assert received[name] == ["TR0", "TR2", "TR3"]
+
+def test_devices_are_left_in_free_run(sim):
+  trigger = GroupTrigger()
+  try:
+    trigger.snapshot(devices)
+  finally:
+    trigger.close()
+  device = Gpib("pm 13-1")
+  try:
+    assert -31. < float(device.ask("TR2")) < -29.
+  finally:
+    device.close()
+
+def test_disarm_can_be_skipped(sim):
+  received, sent = _record(sim)
+  trigger = GroupTrigger()
+  try:
+    trigger.snapshot(devices, disarm="")
+    trigger.snapshot(devices, arm="", disarm="")
+  finally:
+    trigger.close()
+  for name in devices:
+    assert received[name] == ["TR0", "TR2", "TR2"]
@@ -0,0 +1,63 @@
+"""
+Tests of the SRQ dispatcher on the simulated bus
+"""
+from Electronics.Interfaces.GPIB import Gpib, RQS
+from Electronics.Interfaces.GPIB import srq
+from Electronics.Interfaces.GPIB.pool import session_pool
+from Electronics.Interfaces.GPIB.registry import registry
+from Electronics.Interfaces.GPIB.srq import SrqDispatcher, srq_dispatcher
+
+def test_request_before_wait_is_seen(sim):
+  """
+  A device which requests service as soon as it is triggered, before wait()
+  is called, must not be missed.
+  """
+  sim.instruments[registry.address("pm 13-1")].srq_after_trigger = 0
+  device = Gpib("pm 13-1")
+  try:
+    device.trigger()
+    assert device.wait(RQS, timeout=1) == RQS
+    assert device.stb & srq.RQS
+  finally:
+    device.close()
+    srq_dispatcher.stop()
+
+def test_request_before_wait_on_idle_sessions(sim):
+  """
+  Reusing a session idle long enough to be health checked must not clear
+  the request before the dispatcher sees it.
+  """
+  sim.instruments[registry.address("pm 13-1")].srq_after_trigger = 0
+  sessions = [session_pool.checkout("pm 13-1") for count in range(2)]
+  for session in sessions:
+    session_pool.checkin(session)
+    session.last_use -= 2*session_pool.check_idle
+  device = Gpib("pm 13-1")
+  try:
+    device.trigger()
+    assert device.wait(RQS, timeout=1) == RQS
+    assert device.stb & srq.RQS
+  finally:
+    device.close()
+    srq_dispatcher.stop()
+
+def test_request_while_watched(sim):
+  dispatcher = SrqDispatcher(poll=0.01)
+  seen = []
+  try:
+    dispatcher.watch("pm 13-4", lambda address, stb: seen.append(stb))
+    future = dispatcher.future("pm 13-4")
+    sim.service_request(registry.address("pm 13-4"), 0x10)
+    assert future.result(5) & 0x10
+    assert seen and seen[0] & srq.RQS
+    assert dispatcher.stats["requests"] == 1
+  finally:
+    dispatcher.stop()
+
+def test_wait_times_out(sim):
+  dispatcher = SrqDispatcher(poll=0.01)
+  try:
+    assert dispatcher.wait("pm 13-5", timeout=0.05) is None
+    assert not dispatcher._watches
+  finally:
+    dispatcher.stop()
@@ -0,0 +1,43 @@
+"""
+Tests of the gateway worker processes, which run the simulated backend
+"""
+from concurrent import futures
+
+import pytest
+
+from Electronics.Interfaces.GPIB.workers import GatewayWorkers, WorkerDied
+
+@pytest.fixture
+def workers():
+  workers = GatewayWorkers(backend="sim")
+  yield workers
+  workers.close()
+
+def test_read_into_slot(workers):
+  workers.write("pm 13-1", "TR2")
+  assert -40. < float(workers.read("pm 13-1", 64)) < -20.
+
+def test_tuple_result_is_returned(workers):
+  """
+  A gpib_ct operation returning a tuple, as gpib_read does, must be answered
+  rather than leave the caller waiting.
+  """
+  workers.write("pm 13-1", "TR2")
+  data, reason, count = workers.submit("pm 13-1", "gpib_read",
+                                       64).result(30)
+  assert count == len(data) and -40. < float(data) < -20.
+  assert workers.ask("pm 13-1", "?ID").strip() == "HP438A"
+
+def test_close_fails_unanswered_requests():
+  """
+  Requests still waiting for the worker when it is closed must fail rather
+  than leave their callers waiting.
+  """
+  workers = GatewayWorkers(backend="sim")
+  assert workers.ask("pm 13-1", "?ID").strip() == "HP438A"
+  worker, = workers._workers.values()
+  # a request the worker will never answer
+  future = futures.Future()
+  worker.pending[worker._slot()] = future
+  workers.close()
+  assert isinstance(future.exception(10), WorkerDied)
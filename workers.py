@@ -0,0 +1,389 @@
+"""
+Worker processes, one per LAN gateway
+
+With many gateways, one Python process spends its time converting and
+storing responses under the GIL.  GatewayWorkers starts a process for each
+gateway which owns the SICL sessions of the devices behind it and serves
+them with its own BusScheduler.  Requests go to a worker through a pipe;
+responses come back through a ring of slots in shared memory, and only the
+slot number is sent back through the pipe::
+
+  >>> from Electronics.Interfaces.GPIB.workers import GatewayWorkers
+  >>> workers = GatewayWorkers()
+  >>> workers.ask("pm 13-1", "?ID")
+  'HP438A'
+  >>> workers.read("pm 13-4", 1024)
+  b'...'
+  >>> workers.close()
+
+ask() and dev_status() behave as the module functions of the same names.
+A worker which dies is started again; requests it was serving fail with
+WorkerDied.  Workers are started with the 'spawn' method, so they load the
+backend named by the 'backend' argument or GPIB_BACKEND, not one set with
+gpib_ct.use_backend() in the coordinator.
+"""
+import collections
+import logging
+import multiprocessing
+import struct
+import threading
+from concurrent import futures
+from multiprocessing import shared_memory
+
+from Electronics.Interfaces.GPIB import address as gpib_address
+from Electronics.Interfaces.GPIB.registry import registry
+
+module_logger = logging.getLogger(__name__)
+
+_header = struct.Struct("<iiq")
+"""Slot header: kind of result, read termination reason, length or value"""
+
+NONE, TEXT, BYTES, INT = range(4)
+"""Kinds of result held in a slot"""
+
+class WorkerDied(RuntimeError):
+  """
+  The worker process serving a request exited
+  """
+  pass
+
+class _InSlot(object):
+  """
+  Result of a read whose data is already in the request's slot
+  """
+  def __init__(self, count, reason):
+    self.count = count
+    self.reason = reason
+
+def _serve(gateway, connection, memory_name, slot_size, backend):
+  """
+  Worker process: serve requests for the devices behind one gateway.
+  """
+  from Electronics.Interfaces.GPIB import gpib_ct
+  from Electronics.Interfaces.GPIB.pool import SessionPool
+  from Electronics.Interfaces.GPIB.scheduler import BusScheduler
+  if backend:
+    gpib_ct.use_backend(backend)
+  # spawned workers share the coordinator's resource tracker, which unlinks
+  # the memory only if the coordinator does not
+  memory = shared_memory.SharedMemory(name=memory_name)
+  scheduler = BusScheduler(pool=SessionPool())
+  send_lock = threading.Lock()
+
+  def reply(message):
+    with send_lock:
+      connection.send(message)
+
+  def store(slot, result):
+    offset = slot*slot_size
+    if isinstance(result, _InSlot):
+      _header.pack_into(memory.buf, offset, BYTES, result.reason,
+                        result.count)
+    elif result is None:
+      _header.pack_into(memory.buf, offset, NONE, 0, 0)
+    elif isinstance(result, int):
+      _header.pack_into(memory.buf, offset, INT, 0, result)
+    elif isinstance(result, (bytes, str)):
+      kind = BYTES if isinstance(result, bytes) else TEXT
+      data = result if kind == BYTES else result.encode("latin-1")
+      if _header.size + len(data) > slot_size:
+        reply((slot, "data", result))
+        return
+      start = offset + _header.size
+      memory.buf[start:start + len(data)] = data
+      _header.pack_into(memory.buf, offset, kind, 0, len(data))
+    else:
+      # e.g. the (data, reason, count) of gpib_read
+      reply((slot, "data", result))
+      return
+    reply((slot, None, None))
+
+  def finish(slot, future):
+    # every request must be answered, or its caller waits for ever and its
+    # slot is never freed
+    try:
+      store(slot, future.result())
+    except Exception as details:
+      try:
+        reply((slot, "error", "%s" % details))
+      except Exception as details:
+        module_logger.error("worker for %s: cannot reply; %s",
+                            gateway, details)
+
+  def reader(slot, nbytes):
+    start = slot*slot_size + _header.size
+    view = memory.buf[start:start + min(nbytes, slot_size - _header.size)]
+    def read(instr):
+      return _InSlot(*gpib_ct.gpib_read_into(instr, view))
+    return read
+
+  try:
+    while True:
+      request = connection.recv()
+      if request is None:
+        break
+      slot, address, operation, args = request
+      if operation == "read":
+        operation, args = reader(slot, *args), ()
+      try:
+        future = scheduler.submit(address, operation, *args)
+      except Exception as details:
+        reply((slot, "error", "%s" % details))
+        continue
+      future.add_done_callback(lambda future, slot=slot: finish(slot, future))
+  except (EOFError, KeyboardInterrupt):
+    pass
+  finally:
+    scheduler.shutdown()
+    scheduler.pool.close_all()
+    try:
+      memory.close()
+    except BufferError:
+      # views of finished reads may not have been collected yet
+      pass
+
+class _Worker(object):
+  """
+  The coordinator's side of one worker process
+  """
+  def __init__(self, owner, gateway):
+    self.owner = owner
+    self.gateway = gateway
+    self.memory = shared_memory.SharedMemory(
+      create=True, size=owner.slots*owner.slot_size)
+    self.free = collections.deque(range(owner.slots))
+    self.slot_freed = threading.Condition()
+    self.pending = {}
+    self.send_lock = threading.Lock()
+    self.process = None
+    self.connection = None
+    self.restarts = 0
+    self.start()
+
+  def start(self):
+    context = multiprocessing.get_context("spawn")
+    self.connection, child = context.Pipe()
+    self.process = context.Process(
+      target=_serve, name="GPIB %s" % self.gateway,
+      args=(self.gateway, child, self.memory.name, self.owner.slot_size,
+            self.owner.backend))
+    self.process.daemon = True
+    self.process.start()
+    child.close()
+    collector = threading.Thread(target=self._collect,
+                                 args=(self.connection, self.process),
+                                 name="GPIB %s results" % self.gateway)
+    collector.daemon = True
+    collector.start()
+
+  def _slot(self):
+    with self.slot_freed:
+      while not self.free:
+        self.slot_freed.wait()
+      return self.free.popleft()
+
+  def _release(self, slot):
+    with self.slot_freed:
+      self.free.append(slot)
+      self.slot_freed.notify()
+
+  def submit(self, address, operation, args):
+    slot = self._slot()
+    future = futures.Future()
+    with self.send_lock:
+      try:
+        self.pending[slot] = future
+        self.connection.send((slot, address, operation, args))
+      except (OSError, ValueError) as details:
+        del self.pending[slot]
+        self._release(slot)
+        raise WorkerDied("worker for %s: %s" % (self.gateway, details))
+    return future
+
+  def _result(self, slot):
+    offset = slot*self.owner.slot_size
+    kind, reason, value = _header.unpack_from(self.memory.buf, offset)
+    start = offset + _header.size
+    if kind == INT:
+      return value
+    if kind == NONE:
+      return None
+    data = bytes(self.memory.buf[start:start + value])
+    if kind == TEXT:
+      return data.decode("latin-1")
+    return data
+
+  def _collect(self, connection, process):
+    """
+    Complete futures as results arrive; restart the worker if it dies.
+
+    When the worker exits, requests it did not answer fail with WorkerDied,
+    whether it died or was stopped by close().
+    """
+    while True:
+      try:
+        slot, status, value = connection.recv()
+      except (EOFError, OSError):
+        break
+      future = self.pending.pop(slot, None)
+      if status is None:
+        result = self._result(slot)
+      elif status == "data":
+        result = value
+      self._release(slot)
+      if future is None:
+        continue
+      if status == "error":
+        future.set_exception(RuntimeError(value))
+      else:
+        future.set_result(result)
+    process.join()
+    if self.owner.closing:
+      reason = "worker for %s was closed" % self.gateway
+    else:
+      reason = "worker for %s exited with %s" % (self.gateway,
+                                                 process.exitcode)
+      module_logger.warning("GatewayWorkers: %s", reason)
+    with self.send_lock:
+      pending, self.pending = self.pending, {}
+      for slot, future in pending.items():
+        self._release(slot)
+        future.set_exception(WorkerDied(reason))
+      if self.owner.closing:
+        return
+      self.restarts += 1
+      self.start()
+
+  def stop(self):
+    try:
+      with self.send_lock:
+        self.connection.send(None)
+    except (OSError, ValueError):
+      pass
+    self.process.join(5)
+    if self.process.is_alive():
+      self.process.terminate()
+      self.process.join()
+    self.connection.close()
+    self.memory.close()
+    self.memory.unlink()
+
+class GatewayWorkers(object):
+  """
+  Serves GPIB requests from one worker process per gateway
+
+  Public attributes::
+    slots     - number of response slots per worker, which bounds the
+                requests in progress on a gateway
+    slot_size - bytes per slot; larger responses are sent through the pipe
+    backend   - GPIB_BACKEND specification for the workers, or None
+    closing   - True once close() has been called
+  """
+  def __init__(self, gateways=None, slots=32, slot_size=65536, backend=None):
+    """
+    @param gateways : gateways to start workers for now; others are started
+                      when first needed
+    @type  gateways : list of str
+
+    @param slots : response slots per worker
+    @type  slots : int
+
+    @param slot_size : bytes per slot
+    @type  slot_size : int
+
+    @param backend : GPIB_BACKEND specification; default as inherited
+    @type  backend : str
+    """
+    self.slots = slots
+    self.slot_size = slot_size
+    self.backend = backend
+    self.closing = False
+    self._workers = {}
+    self._lock = threading.Lock()
+    for gateway in gateways or []:
+      self._worker(gateway)
+
+  def _worker(self, gateway):
+    with self._lock:
+      if self.closing:
+        raise RuntimeError("workers have been closed")
+      worker = self._workers.get(gateway)
+      if worker is None:
+        worker = self._workers[gateway] = _Worker(self, gateway)
+      return worker
+
+  def submit(self, device, operation, *args):
+    """
+    Send a request to the worker for the device's gateway.
+
+    @param operation : name of a gpib_ct function taking the session ID as
+                       its first argument, or 'read'
+    @type  operation : str
+
+    @return: concurrent.futures.Future
+    """
+    address = registry.address(device)
+    worker = self._worker(gpib_address.gateway_of(address))
+    return worker.submit(address, operation, args)
+
+  def ask(self, device, request):
+    """
+    Send 'request' to 'device' and obtain 'response'.
+    """
+    try:
+      return self.submit(device, "gpib_prompt", request).result()
+    except Exception:
+      return "No response due to error"
+
+  def write(self, device, command):
+    """
+    Send a command.
+    """
+    return self.submit(device, "gpib_send", command).result()
+
+  def read(self, device, nbytes=512):
+    """
+    Read up to 'nbytes' of raw data, and at most what fits in a slot.
+
+    @return: bytes
+    """
+    return self.submit(device, "read", nbytes).result()
+
+  def dev_status(self, device):
+    """
+    Serial poll a device; -1 if that fails.
+    """
+    try:
+      return self.submit(device, "gpib_dev_status").result()
+    except Exception:
+      return -1
+
+  def stats(self):
+    """
+    State of each worker.
+
+    @return: {gateway: {'pid', 'alive', 'restarts', 'pending'}}
+    """
+    with self._lock:
+      workers = list(self._workers.values())
+    return dict((worker.gateway, {"pid": worker.process.pid,
+                                  "alive": worker.process.is_alive(),
+                                  "restarts": worker.restarts,
+                                  "pending": len(worker.pending)})
+                for worker in workers)
+
+  def close(self):
+    """
+    Stop the workers and free their shared memory.
+    """
+    with self._lock:
+      self.closing = True
+      workers, self._workers = list(self._workers.values()), {}
+    for worker in workers:
+      worker.stop()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()